@@ -58,6 +58,17 @@ require('intro.js/introjs.css')
  * ========================================================================
  */
 
+// Pages that may be cached for other visitors leave out the CSRF token, so it's fetched when first needed
+function csrfToken() {
+    if (CSRF_TOKEN) {
+        return $.Deferred().resolve(CSRF_TOKEN).promise()
+    }
+    return $.getJSON(CSRF_TOKEN_URL).then(function (data) {
+        CSRF_TOKEN = data.csrf_token
+        return CSRF_TOKEN
+    })
+}
+
 $('#themodal').on('show.bs.modal', function (event) {
     if (event.relatedTarget && event.relatedTarget.href) {
         var $modal = $(this)
@@ -93,18 +104,21 @@ $modal.on('click', 'button[type="submit"]', function (e) {
 
 $(document).on('click', '.shortcut-save', function (e) {
     var data = { slug: $('#shortcut').val(), article: $(this).data('article') }
+    var url = $(this).data('post')
     if (data.slug && data.article) {
-        var jqxhr = $.ajax({
-            url: $(this).data('post'),
-            type: 'post',
-            data: data,
-            headers: { 'X-CSRFToken': CSRF_TOKEN },
-            dataType: 'json',
-            success: function (data) {
-                utils.flash_error("Short URL created", 'success');
-                $(".shortcut-save").attr("disabled", "disabled");
-                $('#shortcut').attr('readonly', 'readonly');
-            }
+        csrfToken().then(function (token) {
+            return $.ajax({
+                url: url,
+                type: 'post',
+                data: data,
+                headers: { 'X-CSRFToken': token },
+                dataType: 'json',
+                success: function (data) {
+                    utils.flash_error("Short URL created", 'success');
+                    $(".shortcut-save").attr("disabled", "disabled");
+                    $('#shortcut').attr('readonly', 'readonly');
+                }
+            })
         })
             .fail(function (jqXHR, textStatus, errorThrown) {
                 utils.flash_error(jqXHR.responseJSON, 'danger')
@@ -114,20 +128,23 @@ $(document).on('click', '.shortcut-save', function (e) {
 });
 
 $(document).on('click', '.buy-link', function (e) {
-    var jqxhr = $.ajax({
-        url: SHOP_URL,
-        type: 'patch',
-        data: { product: this.id },
-        headers: { 'X-CSRFToken': CSRF_TOKEN },
-        dataType: 'json',
-        success: function (data) {
-            $c = $('#cart-counter')
-            $c.find('.badge').html(data.instance.total_items)
-            $c.addClass("bounce").one('animationend webkitAnimationEnd oAnimationEnd', function () {
-                $c.removeClass("bounce");
-            });
-            $c.addClass("highlight")
-        }
+    var product = this.id
+    csrfToken().then(function (token) {
+        return $.ajax({
+            url: SHOP_URL,
+            type: 'patch',
+            data: { product: product },
+            headers: { 'X-CSRFToken': token },
+            dataType: 'json',
+            success: function (data) {
+                $c = $('#cart-counter')
+                $c.find('.badge').html(data.instance.total_items)
+                $c.addClass("bounce").one('animationend webkitAnimationEnd oAnimationEnd', function () {
+                    $c.removeClass("bounce");
+                });
+                $c.addClass("highlight")
+            }
+        })
     })
         .fail(function (jqXHR, textStatus, errorThrown) {
             utils.flash_error(jqXHR.responseText)
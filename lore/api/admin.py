@@ -8,7 +8,7 @@ import subprocess
 from hashlib import sha1
 
 import requests
-from flask import Blueprint, abort, current_app, flash, g, json, redirect, request, safe_join, url_for
+from flask import Blueprint, abort, current_app, flash, g, json, jsonify, redirect, request, safe_join, url_for
 from flask_babel import lazy_gettext as _
 from flask_mongoengine.wtf import model_form
 from mongoengine import NotUniqueError, ValidationError
@@ -22,6 +22,19 @@ from lore.api.resource import (
     ResourceView,
     filterable_fields_parser,
 )
+from lore.cache import (
+    count_cache,
+    document_cache,
+    entitlement_cache,
+    file_cache,
+    filter_options_cache,
+    fragment_cache,
+    markdown_cache,
+    query_version_cache,
+    qrcode_cache,
+    slug_cache,
+)
+from lore import pagecache
 from lore.extensions import csrf
 from lore.model.world import Shortcut
 from tools.import_textalk import order_default_fields_to_return, product_default_fields_to_return, rpc_get
@@ -165,6 +178,28 @@ def import_webhook(model):
     return "OK", 200
 
 
+@admin.route("/cache_stats")
+def cache_stats():
+    """Hit, miss and size counters of the caches in this process, for monitoring"""
+    if not (g.user and g.user.admin):
+        abort(403)
+    return jsonify(
+        {
+            "count": count_cache.stats(),
+            "query_version": query_version_cache.stats(),
+            "filter_options": filter_options_cache.stats(),
+            "document": document_cache.stats(),
+            "slug": slug_cache.stats(),
+            "entitlement": entitlement_cache.stats(),
+            "file": file_cache.stats(),
+            "qrcode": qrcode_cache.stats(),
+            "markdown": markdown_cache.stats(),
+            "fragment": fragment_cache.stats(),
+            "page": pagecache.page_store.stats() if pagecache.page_store else None,
+        }
+    )
+
+
 @csrf.exempt
 @admin.route("/git_webhook", methods=["GET", "POST"])
 def git_webhook(get_json=None):
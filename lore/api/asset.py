@@ -1,18 +1,22 @@
+import hashlib
 import io
 import logging
 from time import time
 from urllib.parse import quote
+from uuid import uuid4
 
 import pyqrcode
-from flask import Blueprint, current_app, redirect, url_for, g, request, Response, flash, send_file
+from PIL import Image
+from flask import Blueprint, current_app, redirect, url_for, g, request, Response, flash
 from flask_babel import lazy_gettext as _
 from flask_mongoengine.wtf import model_form
 from mongoengine import NotUniqueError, ValidationError
-from werkzeug.exceptions import abort
+from werkzeug.exceptions import RequestedRangeNotSatisfiable, abort
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 from flask_classy import route
 
-from lore.api.pdf import fingerprint_pdf
+from lore.api.pdf import find_fingerprint_offsets, fingerprint_from_user, splice_fingerprint
 from lore.api.resource import (
     Authorization,
     FilterableFields,
@@ -27,7 +31,15 @@ from lore.api.resource import (
     set_theme,
 )
 
-from lore.model.asset import FileAccessType, FileAsset, get_google_urls
+from lore.cache import file_cache, qrcode_cache
+from lore.model.asset import (
+    FileAccessType,
+    FileAsset,
+    derivative_format,
+    get_google_urls,
+    image_derivative,
+    image_presets,
+)
 from lore.model.misc import set_lang_options, filter_is_owner
 from lore.model.shop import products_owned_by_user, user_has_asset
 from lore.model.world import Publisher, filter_authorized_by_publisher
@@ -47,6 +59,68 @@ def set_cache(rv, cache_timeout):
 
 # Inspiration
 # https://github.com/RedBeard0531/python-gridfs-server/blob/master/gridfs_server.py
+
+max_ranges = 20  # More ranges than this in one request will get the whole file instead
+
+
+def requested_ranges(length, etag, last_modified):
+    """Returns the byte ranges of the Range header as (start, stop) tuples, or None to send the whole file.
+    Raises RequestedRangeNotSatisfiable if no range is within the file."""
+    rng = request.range
+    if not rng or rng.units != "bytes" or len(rng.ranges) > max_ranges or request.method not in ("GET", "HEAD"):
+        return None
+    if_range = request.if_range
+    if if_range.etag and if_range.etag != etag:
+        return None  # Client has an old version, so needs the whole file
+    if if_range.date and if_range.date != last_modified.replace(microsecond=0, tzinfo=None):
+        return None
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:  # Suffix range, e.g. the last 500 bytes
+            start, stop = max(length + start, 0), length
+        stop = length if stop is None else min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(length=length)
+    return ranges
+
+
+def read_range(fileobj, start, stop):
+    """Reads a byte range from a GridFS or local file, seeking directly to where it starts"""
+    chunk_size = getattr(fileobj, "chunk_size", file_cache.chunk_size)
+    fileobj.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = fileobj.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def multipart_byteranges(parts, mimetype, length):
+    """Returns a multipart/byteranges body iterator, its length and content type, from (start, stop, data) parts"""
+    boundary = uuid4().hex
+    headers = []
+    for start, stop, _ in parts:
+        delimiter = f"\r\n--{boundary}" if headers else f"--{boundary}"
+        headers.append(
+            f"{delimiter}\r\nContent-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n".encode()
+        )
+    ending = f"\r\n--{boundary}--\r\n".encode()
+
+    def body():
+        for header, (_, _, data) in zip(headers, parts):
+            yield header
+            yield from data
+        yield ending
+
+    content_length = sum(len(h) + stop - start for h, (start, stop, _) in zip(headers, parts)) + len(ending)
+    return body(), content_length, f"multipart/byteranges; boundary={boundary}"
+
+
 def send_gridfs_file(
     gridfile,
     mimetype=None,
@@ -56,6 +130,7 @@ def send_gridfs_file(
     cache_timeout=2628000,
     conditional=True,
     fingerprint_user_id=None,
+    fingerprint_offsets=None,
 ):
     # Default cache timeout is 1 month in seconds
     if not mimetype:
@@ -67,6 +142,7 @@ def send_gridfs_file(
     headers = {
         "Content-Length": gridfile.length,
         "Last-Modified": gridfile.upload_date.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        "Accept-Ranges": "bytes",
     }  #
     if as_attachment:
         if not attachment_filename:
@@ -79,20 +155,63 @@ def send_gridfs_file(
             quoted_filename=quote(attachment_filename.encode("utf8"))
         )
     md5 = gridfile.md5  # as we may overwrite gridfile with own iterator, save this
+    length = gridfile.length
+    ranges = requested_ranges(length, md5, gridfile.upload_date) if conditional and add_etags else None
+    status = 200
+    uid = None
     if fingerprint_user_id:
-        gridfile = fingerprint_pdf(gridfile, fingerprint_user_id)
-    rv = Response(gridfile, headers=headers, content_type=mimetype, direct_passthrough=True)  # is an iterator
+        uid = fingerprint_from_user(fingerprint_user_id)
+        if fingerprint_offsets is None:
+            fingerprint_offsets = find_fingerprint_offsets(gridfile)
+    # Read from the local cache when possible. On a miss, a whole file is cached while it's sent from GridFS.
+    cached_path = file_cache.get(md5)
+    source = gridfile
+    if cached_path:
+        try:
+            source = open(cached_path, "rb")
+        except FileNotFoundError:
+            cached_path = None  # Evicted by another worker since it was found
+
+    def reader(start, stop):
+        if not cached_path and (start, stop) == (0, length):
+            chunks = file_cache.streaming(gridfile)
+        else:
+            chunks = read_range(source, start, stop)
+        if uid:  # Write the user hash where it belongs, if within the range
+            return splice_fingerprint(chunks, start, fingerprint_offsets, uid)
+        return chunks
+
+    if ranges:
+        body = reader(*ranges[0])
+    elif cached_path and not uid:
+        body = wrap_file(request.environ, source, file_cache.chunk_size)  # Lets the server use sendfile if it can
+    else:
+        body = reader(0, length)
+    if ranges and len(ranges) == 1:
+        start, stop = ranges[0]
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        headers["Content-Length"] = stop - start
+    elif ranges:
+        status = 206
+        body, headers["Content-Length"], mimetype = multipart_byteranges(
+            [(start, stop, reader(start, stop)) for start, stop in ranges], mimetype, length
+        )
+    rv = Response(body, status=status, headers=headers, content_type=mimetype, direct_passthrough=True)
+    if cached_path:
+        rv.call_on_close(source.close)
     set_cache(rv, cache_timeout)
     if add_etags:
         rv.set_etag(md5)
     if conditional:
-        rv.make_conditional(request)
+        # Ranges are already handled above, giving accept_ranges only keeps Werkzeug from setting it to none
+        rv.make_conditional(request, accept_ranges="bytes")
     return rv
 
 
 def authorize_and_return(fileasset_slug, as_attachment=False):
     asset = FileAsset.objects(slug=fileasset_slug).first_or_404()
-    publisher = Publisher.objects(slug=g.pub_host).first()
+    publisher = Publisher.cached(slug=g.pub_host)
     if publisher:
         # For better error pages
         set_theme(g, "publisher", publisher.theme)
@@ -129,6 +248,7 @@ def authorize_and_return(fileasset_slug, as_attachment=False):
                 as_attachment=as_attachment,
                 attachment_filename=attachment_filename,
                 fingerprint_user_id=fpid,
+                fingerprint_offsets=asset.get_fingerprint_offsets() if fpid else None,
             )
             # rv.headers['Cache-Control'] = 'private'  # Override the public cache
             return rv
@@ -174,7 +294,18 @@ class FileAssetsView(ResourceView):
     item_template = "asset/fileasset_item.html"
     form_class = model_form(
         FileAsset,
-        exclude=["md5", "source_filename", "length", "created_date", "content_type", "width", "height", "file_data"],
+        exclude=[
+            "md5",
+            "source_filename",
+            "length",
+            "created_date",
+            "content_type",
+            "width",
+            "height",
+            "file_data",
+            "fingerprint_offsets",
+            "metadata_status",
+        ],
         base_class=ImprovedBaseForm,
         converter=ImprovedModelConverter(),
     )
@@ -197,7 +328,7 @@ class FileAssetsView(ResourceView):
     item_arg_parser = prefillable_fields_parser(["slug", "owner", "access_type", "tags", "length"])
 
     def index(self, **kwargs):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         r = ListResponse(
@@ -211,7 +342,8 @@ class FileAssetsView(ResourceView):
         if not (g.user and g.user.admin):
             r.query = r.query.filter(filter_is_owner() | filter_authorized_by_publisher(publisher))
 
-        r.finalize_query()
+        # The asset list is browsed with "show more", so we don't need to count all files
+        r.finalize_query(count_total=False)
 
         # This will re-order so that any selected files are guaranteed to show first
         if r.args["select"] and len(r.args["select"]) > 0:
@@ -227,7 +359,7 @@ class FileAssetsView(ResourceView):
 
     @route("<path:id>", methods=["GET"])
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         if id == "post":
@@ -243,7 +375,7 @@ class FileAssetsView(ResourceView):
 
     @route("<path:id>", methods=["PATCH"])
     def patch(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         fileasset = FileAsset.objects(slug=id).first_or_404()
@@ -265,7 +397,7 @@ class FileAssetsView(ResourceView):
         return redirect(r.args["next"] or url_for("assets.FileAssetsView:get", id=fileasset.slug))
 
     def post(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         r = ItemResponse(FileAssetsView, [("fileasset", None)], method="post")
@@ -302,7 +434,7 @@ class FileAssetsView(ResourceView):
 
     @route("<path:id>", methods=["DELETE"])
     def delete(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
         fileasset = FileAsset.objects(slug=id).first_or_404()
         r = ItemResponse(FileAssetsView, [("fileasset", fileasset)], method="delete")
@@ -324,16 +456,45 @@ def link(fileasset):
     return authorize_and_return(fileasset)
 
 
-@current_app.route("/asset/qr/<code>.svg")
-def qrcode(code):
-    host = current_app.config["DEFAULT_HOST"].upper()
-    code = code.upper()
-    # Uppercase letters give a more compact QR code
-    qr = pyqrcode.create(f"HTTPS://{host}/+{code}", error="L")
-    out = io.BytesIO()
-    qr.svg(out, scale=5)
-    out.seek(0)
-    return send_file(out, attachment_filename="qrcode.svg", mimetype="image/svg+xml")
+qrcode_formats = {"svg": "image/svg+xml", "png": "image/png"}
+qrcode_quiet_zone = 4  # Blank modules around the code, as required by the QR standard
+
+
+def render_qrcode(host, code, scale=5, fmt="svg"):
+    """Returns the bytes and ETag of a QR code linking to the shortcut code at host, as SVG or PNG, rendering it only
+    if not recently rendered"""
+
+    def render():
+        # Uppercase letters give a more compact QR code
+        qr = pyqrcode.create(f"HTTPS://{host.upper()}/+{code.upper()}", error="L")
+        out = io.BytesIO()
+        if fmt == "svg":
+            qr.svg(out, scale=scale)
+        else:
+            # pyqrcode needs pypng for PNG, so draw the modules with Pillow instead
+            size = len(qr.code) + 2 * qrcode_quiet_zone
+            img = Image.new("1", (size, size), 1)
+            for y, row in enumerate(qr.code):
+                for x, module in enumerate(row):
+                    if module:
+                        img.putpixel((x + qrcode_quiet_zone, y + qrcode_quiet_zone), 0)
+            img.resize((size * scale, size * scale), Image.NEAREST).save(out, "PNG", optimize=True)
+        data = out.getvalue()
+        return data, hashlib.md5(data).hexdigest()
+
+    return qrcode_cache.get_or_set((host.upper(), code.upper(), scale, fmt), render)
+
+
+@current_app.route("/asset/qr/<code>.png", defaults={"fmt": "png"})
+@current_app.route("/asset/qr/<code>.svg", defaults={"fmt": "svg"})
+def qrcode(code, fmt):
+    """Sends a QR code for a shortcut. It only depends on the host and the code, so it can be cached for long."""
+    scale = min(max(request.args.get("scale", 5, type=int), 1), 40)
+    data, etag = render_qrcode(current_app.config["DEFAULT_HOST"], code, scale, fmt)
+    rv = Response(data, mimetype=qrcode_formats[fmt])
+    set_cache(rv, 31536000)  # A year
+    rv.set_etag(etag)
+    return rv.make_conditional(request)
 
 
 @current_app.route("/asset/download/<path:fileasset>")
@@ -359,6 +520,34 @@ def image(slug):
 
 @current_app.route("/asset/image/thumbs/<path:slug>")
 def image_thumb(slug):
-    return image(slug.lower())  # thumbs temporarily out of play
-    # asset = FileAsset.objects(slug=slug).first_or_404()
-    # return send_gridfs_file(asset.file_data.thumbnail, mimetype=asset.content_type)
+    """Sends an image resized to the preset given as argument, in the best format the client accepts"""
+    slug = slug.lower()
+    preset = request.args.get("preset", None)
+    if preset not in image_presets:
+        return image(slug)
+    asset = FileAsset.objects(slug=slug).first_or_404()
+    fmt = derivative_format(asset.content_type, request.accept_mimetypes)
+    if not fmt or not asset.file_data_exists():
+        return image(slug)
+    gridfile = asset.file_data.get()
+    try:
+        fileobj = image_derivative(gridfile, preset, fmt)
+    except Exception as e:
+        # E.g. a corrupt image, or a format Pillow can read the header of but not decode
+        logger.warning(f"Can't render {preset} of image {slug}, sending the original: {e}")
+        return image(slug)
+    length = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(0)
+    rv = Response(
+        wrap_file(request.environ, fileobj, file_cache.chunk_size),
+        content_type=fmt[0],
+        headers={
+            "Content-Length": length,
+            "Last-Modified": gridfile.upload_date.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        },
+        direct_passthrough=True,
+    )
+    rv.vary.add("Accept")  # As the format depends on it
+    set_cache(rv, 2628000)
+    rv.set_etag(f"{gridfile.md5}.{preset}.{fmt[2]}")
+    return rv.make_conditional(request)
@@ -288,7 +288,7 @@ def sso():
 @auth_app.route("/logout", subdomain="<pub_host>")
 def logout():
     # Clears logged in flag to effectively log out from all domains, even if session is only cleared in current domain.
-    publisher = Publisher.objects(slug=g.pub_host).first()
+    publisher = Publisher.cached(slug=g.pub_host)
     set_lang_options(publisher)
 
     logout_user()
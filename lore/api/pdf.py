@@ -1,5 +1,9 @@
+import mmap
+import os
 import re
-from hashlib import md5
+from concurrent.futures import ProcessPoolExecutor
+
+from lore.model.fingerprint import find_fingerprint_offsets, fingerprint_from_user
 
 """
 PDF fingerprint
@@ -42,78 +46,64 @@ def hex(s):
     return ' '.join(x.encode('hex') for x in s)
 
 # rb = bytes regex
-pdf_id = re.compile(rb'trailer\s+<<.*?ID\[<(.{12})')  # may be multiline
-doc_id = re.compile(rb'<xmpMM:DocumentID>xmp.did:(.{12})')  # wouldn't be multiline
-font_id = re.compile(rb'/FontFamily\(([^)]{12})')  # wouldn't be multiline
 font_id_find = re.compile(rb'/FontFamily\(([0-9A-F]{12})')  # Only look for hex characters
+# The pdf_id, doc_id and font_id patterns of lore.model.fingerprint in one, only matching uppercase hex as written
+fingerprint_find = re.compile(
+    rb"trailer\s+<<.*?ID\[<(?P<pdf_id>[0-9A-F]{12})"
+    rb"|<xmpMM:DocumentID>xmp.did:(?P<doc_id>[0-9A-F]{12})"
+    rb"|/FontFamily\((?P<font_id>[0-9A-F]{12})"
+)
+fingerprint_kinds = ["pdf_id", "doc_id", "font_id"]
+
+
+def splice_fingerprint(chunks, start, offsets, uid):
+    """Yields chunks of bytes, starting at file position start, with uid written at each of offsets"""
+    pos = start
+    for data in chunks:
+        end = pos + len(data)
+        hits = [o for o in offsets if o < end and o + len(uid) > pos]
+        if hits:
+            data = bytearray(data)
+            for o in hits:
+                lo, hi = max(o, pos), min(o + len(uid), end)
+                data[lo - pos : hi - pos] = uid[lo - o : hi - o]
+            data = bytes(data)
+        yield data
+        pos = end
+
+
+def fingerprint_pdf(file_object, user_id, offsets=None, chunk_size=256 * 1024):
+    """Generator that will fingerprint a PDF. Finds the offsets to fingerprint first, unless already given."""
+    uid = fingerprint_from_user(user_id)
+    if offsets is None:
+        offsets = find_fingerprint_offsets(file_object)
+        file_object.seek(0)
+    return splice_fingerprint(iter(lambda: file_object.read(chunk_size), b""), 0, offsets, uid)
 
-window_size = 512  # size in bytes of the sliding window
 
+def scan_fingerprints(path):
+    """Returns the possible fingerprints in a PDF file, as a dict of value to the set of fingerprint kinds (pdf_id,
+    doc_id, font_id) it was found as. The file is memory-mapped and scanned once with all patterns combined, so each
+    occurrence is only matched once."""
+    found = {}
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return found  # Can't map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for m in fingerprint_find.finditer(data):
+                found.setdefault(m.group(m.lastgroup).decode(), set()).add(m.lastgroup)
+    return found
 
-def fingerprint_from_user(user_id):
-    return md5(str(user_id).encode()).hexdigest()[:12].upper().encode()  # first 12 chars of hexdigest
 
-
-def fingerprint_pdf(file_object, user_id):
-    """Generator that will fingerprint a PDF"""
-    uid = fingerprint_from_user(user_id)
-    print("Fingerprinting uid %s as hash %s" % (user_id, uid))
-    pdf_id_num, doc_id_num, font_id_num = 0, 0, 0
-    window = file_object.read(window_size * 2)
-    buf = window  # just to start with a buffer that equals true
-    do_yield = True
-    while buf:
-        if not pdf_id_num:
-            m = pdf_id.search(window)
-            if m:
-                window = window[:m.start(1)] + uid + window[m.start(1) + 12:]
-                pdf_id_num += 1
-            # print window[m.start(0) : window.find('\n', m.start(1))]
-        if not doc_id_num:
-            m = doc_id.search(window)
-            if m:
-                window = window[:m.start(1)] + uid + window[m.start(1) + 12:]
-                doc_id_num += 1
-            # print window[m.start(0) : window.find('\n', m.start(1))]
-        if not font_id_num:
-            m = font_id.search(window)
-            if m:
-                window = window[:m.start(1)] + uid + window[m.start(1) + 12:]
-                font_id_num += 1
-            # print window[m.start(0) : window.find('\n', m.start(1))]
-
-        # We use a sliding window which means we can't yield every loop,
-        # it would duplicate half window in the output
-        if do_yield:
-            yield window
-        do_yield = not do_yield
-        buf = file_object.read(window_size)
-        window = window[window_size:] + buf
+def scan_fingerprints_in(paths, processes=None):
+    """Scans many PDF files in parallel, returning a dict of path to the result of scan_fingerprints"""
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return dict(zip(paths, executor.map(scan_fingerprints, paths, chunksize=4)))
 
 
 def get_fingerprints(file):
-    fingerprints = []
-    with open(file, 'rb') as f:
-        window = f.read(window_size * 2)
-        buf = window  # just to start with a buffer that equals true
-        while buf:
-            # Todo - if we find something, it's often found twice as the window
-            # overlaps, so fix this
-            m = pdf_id.search(window)
-            if m:
-                print("Found %s in %s" % (m.group(1), window[m.start(0): window.find('\n', m.start(1))]))
-                fingerprints.append(m.group(1))
-            m = doc_id.search(window)
-            if m:
-                print("Found %s in %s" % (m.group(1), window[m.start(0): window.find('\n', m.start(1))]))
-                fingerprints.append(m.group(1))
-            m = font_id_find.search(window)
-            if m:
-                print("Found %s in %s" % (m.group(1), window[m.start(0): window.find('\n', m.start(1))]))
-                fingerprints.append(m.group(1))
-            buf = f.read(window_size)
-            window = window[window_size:] + buf
-    return fingerprints
+    return [fp.encode() for fp in scan_fingerprints(file).keys()]
+
 
 # obj = re.compile(r'\d+ \d+ obj\s+<<(.+?)>>(stream(.*?)endstream)?\s+endobj', re.DOTALL)
 # linearized = re.compile(r'<<\s*/Linearized.+?>>', re.DOTALL)
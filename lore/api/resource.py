@@ -8,6 +8,8 @@
 
   :copyright: (c) 2014 by Helmgast AB
 """
+import base64
+import hashlib
 import itertools
 import logging
 import math
@@ -19,9 +21,21 @@ import types
 from itertools import chain
 from typing import Dict, Sequence
 
-from flask import Response, abort, current_app, flash, g, render_template, request, session, url_for
+from flask import (
+    Response,
+    abort,
+    current_app,
+    flash,
+    g,
+    has_request_context,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from flask.json import jsonify
-from flask_babel import lazy_gettext as _
+from bson import json_util
+from flask_babel import get_locale, lazy_gettext as _
 from flask_classy import FlaskView
 from flask_mongoengine import BaseQuerySet, Pagination
 from flask_mongoengine.wtf import model_form
@@ -29,7 +43,8 @@ from flask_mongoengine.wtf.fields import JSONField, ModelSelectField, ModelSelec
 from flask_mongoengine.wtf.models import ModelForm
 from flask_mongoengine.wtf.orm import ModelConverter, converts
 from jinja2 import TemplatesNotFound
-from mongoengine import InvalidQueryError, OperationError, Q, ReferenceField
+from mongoengine import Document, OperationError, Q, ReferenceField
+from mongoengine.base import BaseField
 from mongoengine.errors import NotUniqueError, ValidationError
 from mongoengine.queryset.visitor import QNode
 from pymongo.errors import OperationFailure
@@ -45,12 +60,29 @@ from wtforms.widgets import HTMLString, Select, html5, html_params
 from wtforms.widgets.core import HiddenInput
 from sentry_sdk import start_span
 
-from lore.model.misc import METHODS, extract, localized_field_labels, safe_next_url
+from lore.cache import (
+    cached_count,
+    collection_version,
+    filter_options_cache,
+    query_fingerprint,
+    query_version_cache,
+)
+from lore.model.misc import (
+    METHODS,
+    extract,
+    localized_field_labels,
+    prefetch_references,
+    safe_next_url,
+    slugs_to_ids,
+    sort_key_fields,
+    SortKeyField,
+)
 from lore.model.world import EMBEDDED_TYPES, Article
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
 
 objid_matcher = re.compile(r"^[0-9a-fA-F]{24}$")
+cursor_matcher = re.compile(r"^[0-9a-zA-Z_\-]+=*$")
 full_objid_matcher = re.compile(r'^ObjectId("[0-9a-fA-F]{24}")$')
 
 
@@ -155,7 +187,21 @@ mime_types = {"html": "text/html", "json": "application/json", "csv": "text/csv"
 #     return type(model_class.__name__ + 'Args', (baseform,), arg_fields)
 
 common_args = frozenset(
-    ["debug", "as_user", "render", "out", "intent", "view", "next", "q", "action", "method", "order_by"]
+    [
+        "debug",
+        "as_user",
+        "render",
+        "out",
+        "intent",
+        "view",
+        "next",
+        "q",
+        "action",
+        "method",
+        "order_by",
+        "after",
+        "before",
+    ]
 )
 
 re_operators = re.compile(
@@ -167,6 +213,16 @@ re_operators = re.compile(
 )
 
 
+# Operators that take a list of values
+list_operators = frozenset(["in", "nin", "all", "not__in", "not__nin", "not__all"])
+
+
+def reference_document_type(field):
+    """Returns the referenced model of a ReferenceField, or ListField of ReferenceFields"""
+    field = getattr(field, "field", field)
+    return field.document_type if isinstance(field, ReferenceField) else None
+
+
 def prefillable_fields_parser(fields=None, **kwargs):
     fields = frozenset(fields or [])
     forbidden = fields & common_args
@@ -244,6 +300,66 @@ def set_theme(obj, type, *paths):
     return None
 
 
+# Fields that hold when a document was last modified, in order of preference
+timestamp_fields = ("updated", "updated_at")
+# Headers of a conditional response that also apply to its JSON rendering
+validator_headers = ("ETag", "Last-Modified", "Cache-Control")
+
+
+def timestamp_field(document_type):
+    """Returns the field of a model that holds when a document was last modified, if it has one"""
+    return next((document_type._fields[f] for f in timestamp_fields if f in document_type._fields), None)
+
+
+def document_version(doc):
+    """Returns when a document was last modified and its version, or None if it doesn't track modifications"""
+    field = timestamp_field(type(doc))
+    updated = getattr(doc, field.name, None) if field else None
+    return (updated, (doc.pk, updated)) if updated else None
+
+
+def resource_version(value):
+    """Returns when a resource was last modified and its version, if it's a document, a queryset or a non-empty list
+    of documents that track modifications, otherwise None"""
+    if isinstance(value, Document):
+        return document_version(value)
+    elif isinstance(value, BaseQuerySet):
+        return query_version(value, current_app.config.get("QUERY_VERSION_TTL", 0))
+    elif isinstance(value, list) and value and all(isinstance(v, Document) for v in value):
+        item_versions = [document_version(v) for v in value]
+        if None in item_versions:
+            return None
+        return max(v[0] for v in item_versions), [v[1] for v in item_versions]
+    return None
+
+
+def is_versionable(value):
+    return isinstance(value, (Document, BaseQuerySet)) or (
+        isinstance(value, list) and value and all(isinstance(v, Document) for v in value)
+    )
+
+
+def query_version(query, ttl=0):
+    """Returns the latest modification and count of all documents matching a query (ignoring skip and limit), or
+    None if the model doesn't track modifications. The latest modification is read from the top of the index on the
+    timestamp field, and the count goes through cached_count(), so it re-uses the count of the pagination. Re-uses
+    the result for the same query shape for ttl seconds, or until the collection is written to by this process."""
+    field = timestamp_field(query._document)
+    if not field:
+        return None
+
+    def latest():
+        cursor = query._collection.find(query._query, {field.db_field: 1}).sort(field.db_field, -1).limit(1)
+        updated = next(cursor, {}).get(field.db_field)
+        return updated, (query._document.__name__, updated, cached_count(query, ttl))
+
+    if not ttl:
+        return latest()
+    collection = query._document._get_collection_name()
+    key = (collection, collection_version(collection), query_fingerprint(query))
+    return query_version_cache.get_or_set(key, latest, ttl)
+
+
 class ResourceResponse(Response):
     arg_parser = {
         # none should remain for subsequent requests
@@ -255,6 +371,8 @@ class ResourceResponse(Response):
     }
 
     json_fields = frozenset([])
+    # Attributes that responses set themselves after __init__, besides resources and themes
+    managed_attributes = frozenset(["template", "auth", "pagination", "filter_options", "action_url", "form"])
 
     def __init__(self, resource_view, queries, method, formats=None, extra_args=None):
         # Can be set from Model
@@ -279,6 +397,8 @@ class ResourceResponse(Response):
         self.args = self.parse_args(self.arg_parser, extra_args or {})
         self.auth = None
         super(ResourceResponse, self).__init__()  # init a blank flask Response
+        # Anything set later, besides managed_attributes, is content set by the view
+        self._response_attributes = frozenset(self.__dict__)
 
     def set_theme(self, type, *paths):
         # Check if we have a theme arg, it should overrule the current theme
@@ -316,17 +436,71 @@ class ResourceResponse(Response):
                 rv[k] = arg
         return rv
 
+    def best_type(self):
+        """The mime type we will render, from render arg or what the client accepts"""
+        if self.args["render"]:
+            return mime_types[self.args["render"]]
+        return request.accept_mimetypes.best_match([mime_types[m] for m in self.formats])
+
+    def validators(self):
+        """Returns when the resources of the response were last modified, and a version that changes with them.
+        Only the resources named in resource_queries are versioned: documents and non-empty lists of documents give
+        their own timestamps, querysets the latest timestamp and count of their results. Returns None, which disables
+        conditional GET, if any resource can't be versioned, or if the view has set other content on the response
+        that isn't a resource, e.g. results it built itself."""
+        for name, value in self.__dict__.items():
+            if name.startswith("_") or name.endswith("_theme") or name in self.resource_queries:
+                continue
+            if name not in self._response_attributes and name not in self.managed_attributes:
+                if not is_versionable(value):
+                    return None
+        last_modified, versions = None, []
+        for name in self.resource_queries:
+            version = resource_version(getattr(self, name))
+            if version is None:
+                return None
+            versions.append(version[1])
+            if version[0] and (not last_modified or version[0] > last_modified):
+                last_modified = version[0]
+        return (last_modified, versions) if versions else None
+
+    def not_modified(self, best_type):
+        """Sets a weak ETag and Last-Modified from the validators of the resources, and returns True if the client
+        already has this version, so that it can get a 304 without rendering. The ETag also depends on the user,
+        locale, themes and format of the response, as they change the output for the same resources. Pages with a
+        cart are not validated, as they show its items, which the resources don't version. Clients must revalidate
+        before re-using a page, and only for the same visitor, e.g. not show the anonymous page after login."""
+        if request.method not in ("GET", "HEAD") or self.method not in ("get", "list") or self.args["intent"]:
+            return False
+        if self.status_code != 200 or self.args["debug"] or self.args.get("random") or session.get("_flashes"):
+            return False
+        if session.get("cart_id"):
+            return False
+        validators = self.validators()
+        if not validators:
+            return False
+        last_modified, versions = validators
+        user = g.user.pk if g.get("user") else None
+        themes = tuple(getattr(g.get(f"{t}_theme"), "name", None) for t in ("publisher", "world", "article"))
+        version = (versions, user, str(get_locale()), themes, best_type, current_app.config.get("VERSION"))
+        self.set_etag(hashlib.sha1(repr(version).encode("utf-8")).hexdigest(), weak=True)
+        if last_modified:
+            self.last_modified = last_modified
+        self.cache_control.private = True
+        self.cache_control.no_cache = True
+        self.make_conditional(request)
+        return self.status_code == 304
+
     def render(self):
         with start_span(op="render", description="render()") as span:
             if not self.auth:
                 abort(403, _("Authorization not performed"))
 
-            if self.args["render"]:
-                best_type = mime_types[self.args["render"]]
-            else:
-                best_type = request.accept_mimetypes.best_match([mime_types[m] for m in self.formats])
-
+            best_type = self.best_type()
             span.set_tag("Content-Type", best_type)
+            if self.not_modified(best_type):
+                span.set_tag("not_modified", True)
+                return self
 
             if best_type == "text/html":
                 template_args = self.get_template_args()
@@ -346,7 +520,11 @@ class ResourceResponse(Response):
                     for one_flash in flashes:
                         rv["errors"].append(one_flash[1])  # Message
                     session["_flashes"] = []
-                return jsonify(rv), self.status
+                response = jsonify(rv)
+                for header in validator_headers:
+                    if header in self.headers:
+                        response.headers[header] = self.headers[header]
+                return response, self.status
             else:  # csv
                 # Too chatty in log, this happens a lot
                 # logger.warn(
@@ -493,8 +671,11 @@ class ListResponse(ResourceResponse):
             "view": lambda x: x.lower() if x.lower() in ["card", "table", "list", "index"] else None,
             "order_by": lambda x: [],  # Will be replaced by fields using a filterable_arg_parser
             "q": lambda x: x,
+            "after": lambda x: x if cursor_matcher.match(x) else None,
+            "before": lambda x: x if cursor_matcher.match(x) else None,
         },
     )
+    json_fields = frozenset(["pagination"])
     method = "list"
     pagination, filter_options = None, {}
 
@@ -518,25 +699,108 @@ class ListResponse(ResourceResponse):
     def query(self, x):
         setattr(self, self.resource_queries[0], x)
 
+    def projected_fields(self):
+        """Returns the names of the fields to load, if the view declares list_fields and we render its list template.
+        list_fields is a list of field names, or a dict from the view arg to such lists, with None as default.
+        JSON responses always get all fields, as API clients can't know what a template needs."""
+        fields = getattr(self.resource_view, "list_fields", None)
+        if not fields or self.template != self.resource_view.list_template or self.best_type() == mime_types["json"]:
+            return None
+        if isinstance(fields, dict):
+            fields = fields.get(self.args["view"], fields.get(None))
+        fields = set(fields or [])
+        if fields and self.pagination and self.pagination.keyset:
+            fields.add(self.pagination.keyset[0].split(".", 1)[0])  # Needed to create cursors
+        if fields and timestamp_field(self.model):
+            fields.add(timestamp_field(self.model).name)  # Needed for conditional GET
+        return fields
+
+    def filter_document_type(self, key):
+        """Returns the referenced model if the filter key compares a reference field by value"""
+        match = re_operators.search(key)
+        if match and match.group(1) in ("exists", "not__exists", "size", "not__size"):
+            return None
+        return reference_document_type(self.model._fields.get(key.split("__", 1)[0], None))
+
+    def get_filter_options(self):
+        """Gets filter options for all filterable fields. Options that support facets are found with counts
+        in one $facet aggregation over the current query. Those results are cached per filter, until the TTL
+        expires or the model (or a model it references) is written to."""
+        options, facets = {}, {}
+        collections = [self.model._get_collection_name()]
+        for name in self.filterable_fields.filter_dict.keys():
+            # Fields may be composite like field.subfield, which we don't support with filter options
+            name = name.split(".", 1)[0]
+            field = self.model._fields.get(name, None)
+            options_func = getattr(field, "filter_options", None)
+            if not options_func:
+                continue
+            facet = options_func.facet(field) if hasattr(options_func, "facet") else None
+            if facet:
+                facets[name] = facet
+                ref_field = getattr(field, "field", field)  # Unwrap ListFields
+                if isinstance(ref_field, ReferenceField):
+                    collections.append(ref_field.document_type._get_collection_name())
+            else:
+                # E.g. date options, that only depend on current date
+                options[name] = options_func(self.query)
+        if facets:
+            ttl = current_app.config.get("FILTER_OPTIONS_TTL", 0)
+            key = (
+                self.model.__name__,
+                tuple(facets.keys()),
+                str(get_locale()),  # Labels may be translated
+                collection_version(*collections),
+                query_fingerprint(self.query),
+            )
+            if ttl:
+                options.update(filter_options_cache.get_or_set(key, lambda: self.facet_options(facets), ttl))
+            else:
+                options.update(self.facet_options(facets))
+        return options
+
+    def facet_options(self, facets):
+        pipeline = [{"$facet": facets}]
+        if self.query._query:
+            pipeline.insert(0, {"$match": self.query._query})
+        try:
+            with start_span(op="db", description=f"{self.model.__name__} $facet {list(facets.keys())}"):
+                result = next(self.query._collection.aggregate(pipeline), {})
+        except OperationFailure as of:
+            # E.g. text search without text index, which will be handled later. Fall back to one query per field.
+            logger.warning(f"Failed $facet on {self.model.__name__}: {of}")
+            return {name: self.model._fields[name].filter_options(self.query) for name in facets}
+        rv = {}
+        for name in facets:
+            field = self.model._fields[name]
+            rv[name] = field.filter_options.from_facet(field, result.get(name, []))
+        return rv
+
     # queryable fields
     # sortable?
     # filterable?
 
     def finalize_query(
-        self, aggregation=None, paginate=True, select_related=True
+        self, aggregation=None, paginate=True, select_related=True, count_total=True, prefetch=None
     ):  # also filter by authorization, paginate
         """Prepares an original query based on request args provided, such as
-        ordering, filtering, pagination etc"""
+        ordering, filtering, pagination etc. If count_total is False, the total
+        number of results is not counted, only if there is a next page or not.
+        prefetch is a list of reference paths to dereference in batch on the page, see prefetch_references(),
+        and defaults to the prefetch attribute of the view. If set, it replaces select_related."""
+
+        if prefetch is None:
+            prefetch = getattr(self.resource_view, "prefetch", None)
 
         # Start instrumentation (avoid using with: to not change the whole code/indentation)
         span = start_span(op="db", description=f"{self.resource_view}.finalize_query()")
         span.set_tag("paginate", paginate)
-        span.set_tag("select_related", select_related)
+        span.set_tag("select_related", select_related and not prefetch)
 
         if aggregation is None:
             aggregation = []
 
-        self.pagination = ResponsePagination(self)
+        self.pagination = ResponsePagination(self, count_total=count_total)
 
         # Apply text search
         if self.args["q"]:
@@ -545,43 +809,43 @@ class ListResponse(ResourceResponse):
 
         # Apply filters
         if self.args["fields"]:
-            built_query = None
+            # Reference fields can be filtered by slug, resolve all slugs with one query per referenced model
+            slugs = {}
             for k, values in self.args["fields"].lists():
                 # Field name is string until first __ (operators are after)
-                val = values[0]
-                q = None
-                field = self.model._fields.get(k.split("__", 1)[0], None)
-                if field and isinstance(field, ReferenceField):
-                    if isinstance(val, str) and objid_matcher.match(val):
-                        q = Q(**{k: val})
-                    else:
-                        try:
-                            instance = field.document_type.objects(slug=val).only("id").first()
-                        except InvalidQueryError:
-                            instance = None
-                        if instance:
-                            q = Q(**{k: instance.id})
+                document_type = self.filter_document_type(k)
+                if document_type:
+                    slugs.setdefault(document_type, set()).update(
+                        v for v in values if not (isinstance(v, str) and objid_matcher.match(v))
+                    )
+            slug_ids = {document_type: slugs_to_ids(document_type, s) for document_type, s in slugs.items() if s}
+
+            built_query = None
+            for k, values in self.args["fields"].lists():
+                document_type = self.filter_document_type(k)
+                if document_type:
+                    ids = slug_ids.get(document_type, {})
+                    # Unknown slugs are ignored
+                    values = [ids.get(v, v) for v in values if objid_matcher.match(v) or v in ids]
+                if not values:
+                    continue
+                match = re_operators.search(k)
+                op = match.group(1) if match else None
+                if op in list_operators:
+                    q = Q(**{k: values})
+                elif len(values) > 1 and not op:
+                    q = Q(**{f"{k}__in": values})  # Multiple values of same field means any of them
                 else:
-                    # if k.endswith("__size"):
-                    #     values = [int(v) for v in values]
-                    # q = Q(**{k: })
-                    q = Q(**{k: val})
-                    # if len(values) > 1:  # multiple values for this field, combine with or
-                    #     for v in values[1:]:
-                    #         q = q._combine(Q(**{k: self.slug_to_id(field, v)}), QNode.OR)
-                if q:
-                    built_query = built_query._combine(q, QNode.AND) if built_query else q
-
-            self.query = self.query.filter(built_query)
-
-        # Populate filter options, options may be reduced by current query
-        for field in self.filterable_fields.filter_dict.keys():
-            # Fields may be composite like field.subfield, which we don't support with filter options
-            field = field.split(".", 1)[0]
-            fieldObj = self.model._fields.get(field, None)
-            if fieldObj and hasattr(fieldObj, "filter_options"):
-                # Popupate all filter options per field
-                self.filter_options[field] = fieldObj.filter_options(self.query)
+                    q = Q(**{k: values[0]})
+                built_query = built_query._combine(q, QNode.AND) if built_query else q
+
+            if built_query:
+                self.query = self.query.filter(built_query)
+
+        # Populate filter options, options may be reduced by current query. Not used when rendering JSON.
+        self.filter_options = {}
+        if self.best_type() != mime_types["json"]:
+            self.filter_options = self.get_filter_options()
 
         # Filterable fields
 
@@ -589,8 +853,14 @@ class ListResponse(ResourceResponse):
         if self.args["order_by"]:  # is a list
             sort_aggregation = []
             order_by = []
+            sort_keys = sort_key_fields(self.model)
             for ob in self.args["order_by"]:
                 parts = ob.split(".")
+                sort_key = sort_keys.get(ob.lstrip("-+"))
+                if sort_key:
+                    # Sort by the indexed, denormalized copy instead of a lookup
+                    order_by.append(f"{'-' if ob.startswith('-') else ''}{sort_key.name}")
+                    continue
                 if len(parts) > 1:
                     field = self.model._fields.get(parts[0].lstrip("-+"), None)
                     # Allow sort by reference fields by doing aggregation lookup on them for sorting
@@ -621,11 +891,23 @@ class ListResponse(ResourceResponse):
                 )
                 aggregation += sort_aggregation
             else:
-                self.query = self.query.order_by(*self.args["order_by"])
+                self.query = self.query.order_by(*order_by)
 
         if self.args["random"] > 0:
             aggregation.append({"$sample": {"size": self.args["random"]}})
 
+        if not aggregation:
+            # Cursors only work with simple sorts, not sorting by lookups or random
+            self.query = self.pagination.apply_cursor(self.query)
+
+        # Only load the fields needed to render the list
+        projected_fields = self.projected_fields()
+        if projected_fields:
+            if aggregation:
+                aggregation.append({"$project": {self.model._fields[f].db_field: 1 for f in projected_fields}})
+            else:
+                self.query = self.query.only(*projected_fields)
+
         try:
             self.query = self.pagination.apply_to_query(self.query)
         except OperationFailure as of:
@@ -641,20 +923,104 @@ class ListResponse(ResourceResponse):
             qs = query_representation(query=self.query, aggregation=aggregation)
             agg_results = self.query._collection.aggregate(aggregation, cursor={})
             # Note, turns query into a static list
-            self.query = [self.model._from_son(a) for a in agg_results]
+            self.query = self.pagination.trim([self.model._from_son(a) for a in agg_results])
         else:
             span.set_tag("aggregation", False)
             qs = query_representation(self.query)
-            if select_related:
+            if select_related and not prefetch:
                 self.query.select_related()
+            # Note, turns query into a static list if not counting total
+            self.query = self.pagination.trim(self.query)
+        if prefetch:
+            # Querysets cache their results, so the page will render the same, prefetched documents
+            prefetch_references(self.query, prefetch)
+        if projected_fields and not aggregation and self.args["debug"] and current_app.debug:
+            warn_on_unprojected_access()
+            for item in self.query:
+                item._projected_fields = projected_fields | {"id"}
         logger.debug(qs)
         span.set_data("mongo_query", qs)
         # End instrumentation
         span.finish()
 
 
+# Sort fields that can be paginated with cursors, besides SortKeyFields. Field names are same as in DB for these.
+keyset_fields = frozenset(["created_date", "created", "updated", "names.0.name"])
+
+
+def encode_cursor(key, value, pk):
+    return base64.urlsafe_b64encode(json_util.dumps([key, value, pk]).encode()).decode()
+
+
+def decode_cursor(token, key):
+    """Returns the sort value and id encoded in a cursor token, if it was made for the sort key"""
+    try:
+        cursor_key, value, pk = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+    except (TypeError, ValueError):
+        abort(400, _("Invalid cursor"))
+    if cursor_key != key:
+        abort(400, _("Invalid cursor"))
+    return value, pk
+
+
+def keyset_value(item, key):
+    """Gets a value by dotted path from a document, where numbers index lists"""
+    value = item
+    for part in key.split("."):
+        if value is None:
+            break
+        if part.isdigit():
+            value = value[int(part)] if len(value) > int(part) else None
+        else:
+            value = getattr(value, part, None)
+    return value
+
+
+_original_field_get = None
+
+
+def warn_on_unprojected_access():
+    """Logs a warning when the current request reads a field of a document that was loaded without it, which would
+    otherwise silently give the default value. Only used in debug mode, as it slows all field access. MongoEngine
+    fields are patched once per process, but only warn in requests that called this.
+    The patch is undone by stop_warning_on_unprojected_access()."""
+    global _original_field_get
+    g.unprojected_warned = set()
+    if _original_field_get is not None:
+        return  # Already patched
+    _original_field_get = original_get = BaseField.__get__
+
+    def __get__(self, instance, owner):
+        if instance is not None:
+            projected = getattr(instance, "_projected_fields", None)
+            if projected and self.name not in projected and has_request_context():
+                warned, key = g.get("unprojected_warned", None), (owner.__name__, self.name)
+                if warned is not None and key not in warned:
+                    warned.add(key)
+                    logger.warning(f"{owner.__name__}.{self.name} was accessed but is not in list_fields of the view")
+        return original_get(self, instance, owner)
+
+    BaseField.__get__ = __get__
+
+
+def stop_warning_on_unprojected_access():
+    """Restores the MongoEngine fields patched by warn_on_unprojected_access()"""
+    global _original_field_get
+    if _original_field_get is not None:
+        BaseField.__get__ = _original_field_get
+        _original_field_get = None
+
+
 class ResponsePagination(Pagination):
-    def __init__(self, r):
+    """Paginates a ListResponse query. By default it counts all matching documents, to be able to show page numbers,
+    but counts are cached per query shape for PAGINATION_COUNT_TTL seconds. With count_total=False, it will instead
+    fetch one item more than the page size to know if there is a next page, without counting at all.
+
+    If the query is sorted by one of keyset_fields, it also offers next and previous cursors. A cursor given as
+    after= or before= arg continues from the sort value of the first or last item, instead of skipping over all
+    previous items, which keeps deep pages as fast as the first. Cursor pages don't count the total."""
+
+    def __init__(self, r, count_total=True):
 
         per_page = int(r.args["per_page"])
         page = int(r.args["page"])
@@ -672,9 +1038,18 @@ class ResponsePagination(Pagination):
 
         self.page = page
         self.per_page = per_page
-        self.count = 0
+        self.count = 0 if count_total else None  # None means total is unknown
         self.response = r
         self.skip = (page - 1) * per_page
+        self.keyset = None  # (key, direction) if we can use cursors
+        self.cursor_mode = None  # after or before if paginating by cursor
+        self._has_more = False
+        self._items = None
+
+    @property
+    def fetch_size(self):
+        # In has next mode, we fetch one extra item which is only used to tell if there is a next page
+        return self.per_page if self.count is not None else self.per_page + 1
 
     def apply_to_aggregation(self, pipeline):
         # Below comment from base.py in MongoEngine:
@@ -683,21 +1058,98 @@ class ResponsePagination(Pagination):
         # keeping limit stage right after sort stage is more efficient. But this leads to wrong set of documents
         # for a skip stage that might succeed these. So we need to maintain more documents in memory in such a
         # case (https://stackoverflow.com/a/24161461).
-        if self.per_page and {"$limit": self.per_page + (self.skip or 0)} not in pipeline:
-            pipeline.append({"$limit": self.per_page + (self.skip or 0)})
+        if self.per_page and {"$limit": self.fetch_size + (self.skip or 0)} not in pipeline:
+            pipeline.append({"$limit": self.fetch_size + (self.skip or 0)})
         if self.skip and {"$skip": self.skip} not in pipeline:
             pipeline.append({"$skip": self.skip})
         return pipeline
 
+    def apply_cursor(self, query):
+        ordering = query._ordering
+        if ordering is None:
+            ordering = query._get_order_by(self.response.model._meta.get("ordering") or [])
+        if len(ordering) != 1 or not (
+            ordering[0][0] in keyset_fields or isinstance(self.response.model._fields.get(ordering[0][0]), SortKeyField)
+        ):
+            return query
+        key, direction = ordering[0]
+        self.keyset = (key, direction)
+        field = key.replace(".", "__")
+        token = self.response.args.get("after") or self.response.args.get("before")
+        if not token:
+            # Sort ties by id so that the item a cursor is made from has an exact position
+            sign = "-" if direction < 0 else ""
+            return query.order_by(f"{sign}{key}", f"{sign}id")
+
+        value, pk = decode_cursor(token, key)
+        self.cursor_mode = "after" if self.response.args.get("after") else "before"
+        self.count, self.skip = None, 0
+        # Going forward in descending order, or backward in ascending order, means looking for lower values
+        op = "lt" if (direction < 0) == (self.cursor_mode == "after") else "gt"
+        q = Q(**{f"{field}__{op}": value}) | Q(**{field: value, f"pk__{op}": pk})
+        if value is None and op == "gt":
+            q = q | Q(**{f"{field}__ne": None})  # None sorts lowest but can't be compared with $gt
+        sign = "-" if op == "lt" else ""
+        return query.filter(q).order_by(f"{sign}{key}", f"{sign}id")
+
     def apply_to_query(self, query):
-        self.count = query.count()
-        return query.skip(self.skip).limit(self.per_page)
+        if self.count is not None:
+            self.count = cached_count(query, current_app.config.get("PAGINATION_COUNT_TTL", 0))
+        return query.skip(self.skip).limit(self.fetch_size)
+
+    def trim(self, items):
+        """In has next mode, removes the extra item fetched and returns the page as a list"""
+        if self.count is not None:
+            self._items = items
+            return items
+        items = list(items)
+        self._has_more = len(items) > self.per_page
+        items = items[: self.per_page]
+        if self.cursor_mode == "before":
+            items.reverse()  # We fetched backwards from the cursor
+        self._items = items
+        return items
+
+    def cursor(self, item):
+        return encode_cursor(self.keyset[0], keyset_value(item, self.keyset[0]), item.pk)
+
+    @property
+    def has_next(self):
+        if self.count is not None:
+            return self.page < self.pages
+        return self.cursor_mode == "before" or self._has_more
+
+    @property
+    def has_prev(self):
+        if self.cursor_mode == "before":
+            return self._has_more
+        return self.cursor_mode == "after" or self.page > 1
+
+    @property
+    def next_cursor(self):
+        if self.keyset and self._items is not None and self.has_next:
+            items = list(self._items)  # A QuerySet will use it's result cache
+            return self.cursor(items[-1]) if items else None
+        return None
+
+    @property
+    def prev_cursor(self):
+        if self.keyset and self._items is not None and self.cursor_mode and self.has_prev:
+            items = list(self._items)
+            return self.cursor(items[0]) if items else None
+        return None
 
     @property
     def pages(self):
         """The total number of pages"""
+        if self.count is None:
+            return self.page + 1 if self.has_next else self.page
         return int(math.ceil(self.count / float(self.per_page)))
 
+    @property
+    def total(self):
+        return self.count
+
     def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
         """Iterates over the page numbers in the pagination.  The four
         parameters control the thresholds how many numbers should be produced
@@ -1170,7 +1622,7 @@ class ImprovedModelConverter(ModelConverter):
         kwargs.update(unacceptable)
         return MapFormField(unbound_field, **kwargs)
 
-    @converts("ReferenceField")
+    @converts("ReferenceField", "IdentityMappedReferenceField")
     def conv_Reference(self, model, field, kwargs):
         kwargs["allow_blank"] = not field.required
         return ModelSelectField(model=field.document_type, **kwargs)
@@ -104,7 +104,19 @@ class ProductsView(ResourceView):
     access_policy = ProductAccessPolicy()
     model = Product
     list_template = "shop/product_list.html"
-    filterable_fields = FilterableFields(Product, ["created", "type", "world", "price", "product_number"])
+    filterable_fields = FilterableFields(
+        Product,
+        [
+            "created",
+            "type",
+            "world",
+            ("world.title_i18n.sv", Product.world.verbose_name),
+            "price",
+            "product_number",
+        ],
+    )
+    # Lists only show the feature image, publisher and world are dereferenced from cache
+    prefetch = ["images[0]"]
     item_template = "shop/product_item.html"
     item_arg_parser = prefillable_fields_parser(["created", "type", "world", "price"])
     form_class = model_form(Product, base_class=ImprovedBaseForm, exclude=["slug"], converter=ImprovedModelConverter())
@@ -112,7 +124,7 @@ class ProductsView(ResourceView):
     # form_class.stock_count = IntegerField(label=_("Remaining Stock"), validators=[InputRequired(), NumberRange(min=-1)])
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
         products = Product.objects(publisher=publisher).order_by("type", "-created")
         r = ListResponse(ProductsView, [("products", products), ("publisher", publisher)])
@@ -122,13 +134,13 @@ class ProductsView(ResourceView):
         r.auth_or_abort(res=publisher)
         r.finalize_query()
         if r.args.get("fields", None) and r.args["fields"].get("world", None):
-            world = World.objects(slug=r.args["fields"].get("world", "")).first()
+            world = World.cached(slug=r.args["fields"].get("world", ""))
             r.world = world
 
         return r
 
     def my_products(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
         # products = Product.objects().order_by('type', '-created')
 
@@ -157,7 +169,7 @@ class ProductsView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         if id == "post":
@@ -180,7 +192,7 @@ class ProductsView(ResourceView):
         return r
 
     def post(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         r = ItemResponse(ProductsView, [("product", None), ("publisher", publisher)], method="post")
@@ -206,7 +218,7 @@ class ProductsView(ResourceView):
         #     fa.append(FileAsset.objects(id=i).first())
         # print fa
 
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         product = Product.objects(slug=id).first_or_404()
@@ -391,6 +403,7 @@ class OrdersView(ResourceView):
     access_policy = OrdersAccessPolicy()
     model = Order
     list_template = "shop/order_list.html"
+    prefetch = ["user"]
     filterable_fields = FilterableFields(
         Order, [("id", _("ID")), "external_key", "created", "updated", "status", "total_price", "total_items",],
     )
@@ -406,7 +419,7 @@ class OrdersView(ResourceView):
     )
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         orders = Order.objects().order_by("-updated")  # last updated will show paid highest
@@ -435,7 +448,7 @@ class OrdersView(ResourceView):
         return r
 
     def my_orders(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         orders = Order.objects(user=g.user).order_by("-created")  # last created shown first
@@ -454,7 +467,7 @@ class OrdersView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         # TODO we dont support new order creation outside of cart yet
@@ -469,7 +482,7 @@ class OrdersView(ResourceView):
     @route("/key/<key>", methods=["GET", "PATCH"])
     def key(self, key):
         # Custom authentication
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         order = Order.objects(external_key=key).get_or_404()  # get_or_404 handles exception if not a valid object ID
@@ -501,7 +514,7 @@ class OrdersView(ResourceView):
 
     @route("/buy", methods=["PATCH"])
     def buy(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -539,7 +552,7 @@ class OrdersView(ResourceView):
     # Post means go to next step, patch means to stay
     @route("/cart", methods=["GET", "PATCH", "POST"])
     def cart(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -569,7 +582,7 @@ class OrdersView(ResourceView):
 
     @route("/details", methods=["GET", "POST"])
     def details(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -620,7 +633,7 @@ class OrdersView(ResourceView):
 
     @route("/pay", methods=["GET", "POST"])
     def pay(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -118,7 +118,7 @@ class UsersView(ResourceView):
     )
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         users = User.objects().order_by("-username")
@@ -132,7 +132,7 @@ class UsersView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         user = None
@@ -155,7 +155,7 @@ class UsersView(ResourceView):
         return r
 
     def patch(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = Publisher.cached(slug=g.pub_host)
         set_lang_options(publisher)
 
         # get_or_404 handles exception if not a valid object ID
@@ -194,7 +194,9 @@ class PublishersView(ResourceView):
     filterable_fields = FilterableFields(Publisher, ["title", "owner", "created_date"])
     item_template = "world/publisher_item.html"
     item_arg_parser = prefillable_fields_parser(["title", "owner", "created_date"])
-    form_class = model_form(Publisher, base_class=ImprovedBaseForm, converter=ImprovedModelConverter())
+    form_class = model_form(
+        Publisher, base_class=ImprovedBaseForm, exclude=["updated"], converter=ImprovedModelConverter()
+    )
 
     def index(self):
         r = ListResponse(PublishersView, [("publishers", Publisher.objects())])
@@ -208,7 +210,7 @@ class PublishersView(ResourceView):
             r = ItemResponse(PublishersView, [("publisher", None)], extra_args={"intent": "post"})
             r.auth_or_abort(res=None)
         else:
-            publisher = Publisher.objects(slug=id).first_or_404()
+            publisher = Publisher.cached_or_404(slug=id)
             r = ItemResponse(PublishersView, [("publisher", publisher)])
             r.auth_or_abort()
         return r
@@ -227,7 +229,7 @@ class PublishersView(ResourceView):
         return redirect(r.args["next"] or url_for("world.PublishersView:get", id=publisher.slug))
 
     def patch(self, id):
-        publisher = Publisher.objects(slug=id).first_or_404()
+        publisher = Publisher.cached_or_404(slug=id)
 
         r = ItemResponse(PublishersView, [("publisher", publisher)], method="patch")
         r.auth_or_abort()
@@ -254,11 +256,13 @@ class WorldsView(ResourceView):
     filterable_fields = FilterableFields(World, ["title_i18n.sv", "publisher", "creator", "created_date"])
     item_template = "world/world_item.html"
     item_arg_parser = prefillable_fields_parser(["title_i18n.sv", "publisher", "creator", "created_date"])
-    form_class = model_form(World, base_class=ImprovedBaseForm, exclude=["slug"], converter=ImprovedModelConverter())
+    form_class = model_form(
+        World, base_class=ImprovedBaseForm, exclude=["slug", "updated"], converter=ImprovedModelConverter()
+    )
     # @route('/worlds/')
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
         owned_worlds = World.objects(publisher=publisher).order_by("-publishing_year", "-created")
         distinct_world_associations = Topic.objects().aggregate(
@@ -306,7 +310,7 @@ class WorldsView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
 
         if id == "post":
             set_lang_options(publisher)
@@ -315,7 +319,7 @@ class WorldsView(ResourceView):
             r.set_theme("world")  # Will pick from args if exist
             r.auth_or_abort(res=publisher)  # check auth scoped to publisher, as we want to create new
         else:
-            world = World.objects(slug=id).first_or_404()
+            world = World.cached_or_404(slug=id)
             if "intent" not in request.args:
                 # Redirect to home if we are just doing a get
                 return redirect(url_for("world.ArticlesView:world_home", world_=world.slug))
@@ -328,7 +332,7 @@ class WorldsView(ResourceView):
         return r
 
     def post(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         set_lang_options(publisher)
 
         r = ItemResponse(WorldsView, [("world", None), ("publisher", publisher)], method="post")
@@ -346,8 +350,8 @@ class WorldsView(ResourceView):
         return redirect(r.args["next"] or url_for("world.WorldsView:get", pub_host=publisher.slug, id=world.slug))
 
     def patch(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=id).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
+        world = World.cached_or_404(slug=id)
         set_lang_options(world, publisher)
 
         r = ItemResponse(WorldsView, [("world", world), ("publisher", publisher)], method="patch")
@@ -406,19 +410,40 @@ class ArticlesView(ResourceView):
         ],
     )
     # list_arg_parser = filterable_fields_parser(["title", "type", "creator.realname", "created_date", "tags", "status", "world"])
+    # Fields used by the article list template, others are not loaded. Only the list view shows content.
+    list_fields = {
+        None: [
+            "slug",
+            "type",
+            "world",
+            "publisher",
+            "creator",
+            "created_date",
+            "title",
+            "description",
+            "status",
+            "language",
+            "translations_i18n",
+            "cloudinary",
+            "images",
+        ]
+    }
+    list_fields["list"] = list_fields[None] + ["content"]
+    # All images are needed to pick the feature image, world and publisher are dereferenced from cache
+    prefetch = ["creator", "images"]
     item_template = "world/article_item.html"
     item_arg_parser = prefillable_fields_parser(["title", "type", "creator", "created_date", "theme", "cloudinary"])
     form_class = model_form(
         Article,
         base_class=ArticleBaseForm,
-        exclude=["slug", "feature_image", "featured"],
+        exclude=["slug", "feature_image", "featured", "updated"],
         converter=ImprovedModelConverter(),
     )
 
     @route("/", route_base="/")
     def publisher_home(self):
         # Explicitly take pub_host as argument, not g variable
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         world = WorldMeta(publisher)
         articles = (
             Article.objects(publisher=publisher).filter(type="blogpost").order_by("-sort_priority", "-created_date")
@@ -445,7 +470,7 @@ class ArticlesView(ResourceView):
 
     @route("/<not(en,sv):world_>/", route_base="/")
     def world_home(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         if world_ == "post":
             set_lang_options(publisher)
             r = ItemResponse(WorldsView, [("world", None), ("publisher", publisher)], extra_args={"intent": "post"})
@@ -454,7 +479,7 @@ class ArticlesView(ResourceView):
         if world_ == "meta":
             return redirect(url_for("world.ArticlesView:publisher_home", pub_host=publisher.slug))
         else:
-            world = World.objects(slug=world_).first_or_404()
+            world = World.cached_or_404(slug=world_)
             set_lang_options(world, publisher)
 
             r = ItemResponse(WorldsView, [("world", world), ("publisher", publisher)])
@@ -474,7 +499,7 @@ class ArticlesView(ResourceView):
 
     @route("/search", route_base="/")
     def search(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         world = WorldMeta(publisher)
         articles = Article.objects(publisher=publisher)
         set_lang_options(publisher)
@@ -494,7 +519,7 @@ class ArticlesView(ResourceView):
 
     @route("/mentions", route_base="/")
     def mentions(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         world = WorldMeta(publisher)
         articles = Article.objects(publisher=publisher)
         set_lang_options(publisher)
@@ -514,8 +539,8 @@ class ArticlesView(ResourceView):
 
     @route("/articles/")  # Needed to give explicit route to index page, as route base shows world_item
     def index(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
+        world = World.cached_or_404(slug=world_) if world_ != "meta" else WorldMeta(publisher)
         set_lang_options(world, publisher)
 
         if world_ == "meta":
@@ -540,9 +565,9 @@ class ArticlesView(ResourceView):
         return r
 
     def topics(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).comment("Current publisher").first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         if world_ != "meta":
-            world = World.objects(slug=world_).comment("Current world").first_or_404()
+            world = World.cached_or_404(slug=world_)
             topic_path = f"{publisher.slug}/{world.slug}"
         else:
             world = WorldMeta(publisher)
@@ -588,8 +613,8 @@ class ArticlesView(ResourceView):
         return r
 
     def blog(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
+        world = World.cached_or_404(slug=world_) if world_ != "meta" else WorldMeta(publisher)
         set_lang_options(world, publisher)
 
         if world_ == "meta":
@@ -617,7 +642,7 @@ class ArticlesView(ResourceView):
         return r
 
     def random(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         # world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
         # articles = Article.objects(
         #     world=if_not_meta(world),
@@ -626,7 +651,7 @@ class ArticlesView(ResourceView):
         #     created_date__lte=datetime.utcnow(),
         # )
         if world_ != "meta":
-            world = World.objects(slug=world_).comment("Current world").first_or_404()
+            world = World.cached_or_404(slug=world_)
             topic_path = f"{publisher.slug}/{world.slug}"
         else:
             world = WorldMeta(publisher)
@@ -644,13 +669,13 @@ class ArticlesView(ResourceView):
             return redirect(url_for("world.ArticlesView:index", pub_host=publisher.slug, world_=world.slug))
 
     def feed(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
         query = filter_published()
         if world_ == "meta":
             world = WorldMeta(publisher)
             query = Q(publisher=publisher) & query
         else:
-            world = World.objects(slug=world_).first_or_404()
+            world = World.cached_or_404(slug=world_)
             query = Q(world=world) & query
 
         feed = AtomFeed(_("Recent Articles in ") + world.title, feed_url=request.url, url=request.url_root)
@@ -665,7 +690,7 @@ class ArticlesView(ResourceView):
                     url=url_for(
                         "world.ArticlesView:get", world_=world.slug, id=article.slug, _external=True, _scheme=""
                     ),
-                    updated=article.created_date,
+                    updated=article.updated or article.created_date,
                     published=article.created_date,
                     categories=[{"term": getattr(article.world or article.publisher, "title", "None")}],
                 )
@@ -673,9 +698,9 @@ class ArticlesView(ResourceView):
 
     def get(self, world_, id):
 
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
 
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        world = World.cached_or_404(slug=world_) if world_ != "meta" else WorldMeta(publisher)
 
         set_lang_options(world, publisher)
 
@@ -748,8 +773,8 @@ class ArticlesView(ResourceView):
         return r
 
     def post(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
+        world = World.cached_or_404(slug=world_) if world_ != "meta" else WorldMeta(publisher)
         set_lang_options(world, publisher)
 
         r = ItemResponse(ArticlesView, [("article", None), ("world", world), ("publisher", publisher)], method="post")
@@ -777,8 +802,8 @@ class ArticlesView(ResourceView):
         )
 
     def patch(self, world_, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
+        world = World.cached_or_404(slug=world_) if world_ != "meta" else WorldMeta(publisher)
         article = Article.objects(slug=id).first_or_404()
         set_lang_options(world, publisher)
 
@@ -805,8 +830,8 @@ class ArticlesView(ResourceView):
         )
 
     def delete(self, world_, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher = Publisher.cached_or_404(slug=g.pub_host)
+        world = World.cached_or_404(slug=world_) if world_ != "meta" else WorldMeta(publisher)
         article = Article.objects(slug=id).first_or_404()
         set_lang_options(world, publisher)
 
@@ -150,6 +150,9 @@ def configure_logging(app):
 
 def configure_extensions(app):
     from . import extensions
+    from .cache import file_cache
+    from .dbstats import init_dbstats
+    from .pagecache import init_pagecache
 
     # URL and routing
     prefix = app.config.get("URL_PREFIX", "")
@@ -196,6 +199,15 @@ def configure_extensions(app):
     # Debug toolbar, will stop if DEBUG_TB_ENABLED = False or if not else if DEBUG=False
     extensions.toolbar.init_app(app)
 
+    # Database command stats, registered after the toolbar so that they are complete when the toolbar shows them
+    init_dbstats(app)
+
+    # Local disk cache of GridFS files, if ASSET_CACHE_DIR is set
+    file_cache.init_app(app)
+
+    # Pages for anonymous visitors, if PAGE_CACHE is set. Before blueprints, so cached pages skip loading the user
+    init_pagecache(app)
+
     # TODO this is a hack to allow authentication via source db admin,
     # will likely break if connection is recreated later
     # mongocfg =   app.config['MONGODB_SETTINGS']
@@ -232,7 +244,7 @@ def configure_extensions(app):
         extensions.AutolinkedImage(),
     ]
 
-    app.md = markdown.Markdown(extensions=md_extensions)
+    app.md = extensions.MarkdownRenderer(extensions=md_extensions)
 
     app.jinja_env.filters["markdown"] = extensions.build_md_filter(extensions=md_extensions)
     app.jinja_env.filters["md2plain"] = extensions.build_md_filter(output_format="plain", stripTopLevelTags=False)
@@ -245,6 +257,7 @@ def configure_extensions(app):
     app.jinja_env.filters["filter_by_all_scopes"] = extensions.filter_by_all_scopes
     app.jinja_env.filters["filter_by_any_scopes"] = extensions.filter_by_any_scopes
     app.jinja_env.add_extension("jinja2.ext.do")  # "do" command in jinja to run code
+    app.jinja_env.add_extension(extensions.FragmentCacheExtension)  # "cache" blocks in templates
     app.jinja_loader = extensions.enhance_jinja_loader(app)
     app.json_encoder = extensions.MongoJSONEncoder
     if not app.debug:
@@ -339,6 +352,7 @@ def configure_hooks(app):
         if not app.config["PRODUCTION"]:
             ph = re.sub(r"\.test$", "", ph)
         g.pub_host = ph
+        g.identity_map = {}  # Documents loaded in this request, see CachedDocumentMixin
         lang = values.pop("lang", None) if values else None
         g.lang = lang
 
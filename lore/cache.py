@@ -0,0 +1,420 @@
+"""
+    lore.cache
+    ~~~~~~~~~~~~~~~~
+
+    Small in-process caches used to avoid repeating expensive database work
+    between requests, and the bookkeeping needed to invalidate them when
+    documents are written.
+
+    Invalidation is based on a version number per collection, bumped by
+    MongoEngine signals whenever a document in that collection is saved or
+    deleted. Cache keys that include the version of the collections they
+    depend on are thereby never served stale after a write from this process.
+    Writes that bypass signals (e.g. QuerySet.update()) or come from other
+    processes are only bounded by the TTL of each cache.
+
+    File contents from GridFS are cached on local disk by FileCache instead,
+    which needs no invalidation as files are keyed by their md5.
+
+    :copyright: (c) 2014 by Helmgast AB
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from time import monotonic
+
+from bson import json_util
+from flask import current_app, g, has_request_context
+from mongoengine import signals
+
+logger = current_app.logger if current_app else logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache where each entry expires after a TTL (in seconds).
+    A ttl of None means entries only leave the cache by eviction or invalidation. If given, on_remove(key, value)
+    is called, while holding the lock of the cache, for each entry that leaves it for any reason."""
+
+    def __init__(self, maxsize=1024, ttl=None, on_remove=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _removed(self, key, entry):
+        if self.on_remove and entry is not _MISSING:
+            self.on_remove(key, entry[1])
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires is None or expires > monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self._removed(key, entry)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            replaced = self._data.get(key, _MISSING)
+            self._data[key] = (monotonic() + ttl if ttl else None, value)
+            self._data.move_to_end(key)
+            self._removed(key, replaced)
+            while len(self._data) > self.maxsize:
+                self._removed(*self._data.popitem(last=False))
+        return value
+
+    def get_or_set(self, key, func, ttl=None):
+        """Returns cached value for key, or calls func() and caches the result"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.set(key, func(), ttl)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._removed(key, self._data.pop(key, _MISSING))
+
+    def clear(self):
+        with self._lock:
+            data, self._data = self._data, OrderedDict()
+            for key, entry in data.items():
+                self._removed(key, entry)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+_collection_versions = defaultdict(int)
+
+
+def collection_version(*collections):
+    """Returns a tuple of the current write version of each collection name, to include in cache keys"""
+    return tuple(_collection_versions[c] for c in collections)
+
+
+def bump_collection_version(collection):
+    _collection_versions[collection] += 1
+
+
+def identity_map():
+    """Returns the identity map of the current request, where documents are stored by (class name, field, value),
+    so that the same document is only loaded once per request. Outside of requests, nothing is remembered."""
+    if not has_request_context():
+        return {}
+    if "identity_map" not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def _on_document_write(sender, **kwargs):
+    try:
+        collection = sender._get_collection_name()
+    except AttributeError:
+        return  # Embedded documents have no collection
+    if collection:
+        bump_collection_version(collection)
+    if has_request_context() and "identity_map" in g:
+        for key in [k for k in g.identity_map if k[0] == sender._class_name]:
+            del g.identity_map[key]
+
+
+# Connect to all senders, i.e. all Document classes
+signals.post_save.connect(_on_document_write)
+signals.post_delete.connect(_on_document_write)
+signals.post_bulk_insert.connect(_on_document_write)
+
+
+def query_fingerprint(queryset):
+    """Returns a hashable, normalized representation of the filter of a queryset,
+    ignoring sorting, skip and limit."""
+    try:
+        return json_util.dumps(queryset._query, sort_keys=True)
+    except (TypeError, ValueError):
+        return repr(queryset._query)
+
+
+class KeyLocks(object):
+    """Gives one lock per key, so that when several threads miss the cache for the same key at once, only the first
+    computes the value while the others wait for it and then find it cached."""
+
+    def __init__(self):
+        self._locks = {}  # key -> [lock, number of threads using it]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+count_cache = LRUCache(maxsize=2048)
+
+
+def cached_count(queryset, ttl):
+    """Counts the documents matching a queryset, re-using recent counts for the same query shape.
+    Unfiltered querysets use the collection metadata count instead, which doesn't scan anything."""
+    if not queryset._query:
+        return queryset._collection.estimated_document_count()
+    if not ttl:
+        return queryset.count()
+    collection = queryset._document._get_collection_name()
+    key = (collection, collection_version(collection), query_fingerprint(queryset))
+    return count_cache.get_or_set(key, queryset.count, ttl)
+
+
+filter_options_cache = LRUCache(maxsize=1024)
+# Latest update and count of list results, for conditional GET
+query_version_cache = LRUCache(maxsize=2048)
+document_cache = LRUCache(maxsize=1024)
+slug_cache = LRUCache(maxsize=4096)
+entitlement_cache = LRUCache(maxsize=4096)
+# Resized images, when there is no disk cache to keep them in
+derivative_cache = LRUCache(maxsize=128)
+# Rendered QR codes for shortcuts, as printed material makes them requested in bursts
+qrcode_cache = LRUCache(maxsize=512)
+# Rendered Markdown, keyed by a hash of the text and the Markdown configuration
+markdown_cache = LRUCache(maxsize=2048)
+# Output of template blocks in {% cache %}, see FragmentCacheExtension
+fragment_cache = LRUCache(maxsize=1024)
+
+
+# Cache keys are the md5 of a file, optionally followed by the name of a derivative of it, e.g. <md5>.card.webp
+re_cache_key = re.compile(r"^([0-9a-f]{32})(\.[a-z0-9_.]+)?$")
+
+
+class FileCache(object):
+    """A size-capped cache of GridFS file contents in a local directory, keyed by their md5 so that entries never go
+    stale, as a replaced file gets a new key. Derivatives of a file, e.g. resized images, are stored under its md5 with
+    a suffix. Least recently used files are removed when the total size passes max_bytes. Several processes can share
+    the directory, but each keeps its own index and size count, so the cap is approximate. Disabled until init_app()
+    is given an ASSET_CACHE_DIR."""
+
+    chunk_size = 256 * 1024
+
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 0
+        self.max_file_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._index = OrderedDict()  # key -> file size, least recently used first
+        self._streaming = set()  # Keys being cached by streaming() in this process
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        directory = app.config.get("ASSET_CACHE_DIR", None)
+        if not directory:
+            return
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = app.config.get("ASSET_CACHE_MAX_BYTES", 0)
+        self.max_file_bytes = min(app.config.get("ASSET_CACHE_MAX_FILE_BYTES", 0) or self.max_bytes, self.max_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    @property
+    def enabled(self):
+        return bool(self.directory and self.max_bytes)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        """Indexes files already in the directory, e.g. from before a restart, oldest access first"""
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if re_cache_key.match(name):
+                    st = os.stat(os.path.join(root, name))
+                    entries.append((st.st_mtime, name, st.st_size))
+        with self._lock:
+            self._index.clear()
+            self.size = 0
+            for _, key, size in sorted(entries):
+                self._add(key, size)
+            self._evict()
+
+    def _add(self, key, size):
+        self.size += size - self._index.get(key, 0)
+        self._index[key] = size
+        self._index.move_to_end(key)
+
+    def _remove(self, key):
+        if key in self._index:
+            self.size -= self._index.pop(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass  # Already removed, e.g. by another process
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+            self.evictions += 1
+
+    def get(self, key):
+        """Returns the path of the cached file with this key, or None"""
+        if not self.enabled or not key:
+            return None
+        path = self.path(key)
+        with self._lock:
+            try:
+                os.utime(path)  # Marks it as recently used also for the index of other processes after restart
+                if key not in self._index:  # Added by another process
+                    self._add(key, os.path.getsize(path))
+                    self._evict()
+                self._index.move_to_end(key)
+                self.hits += 1
+                return path
+            except OSError:
+                if key in self._index:  # Evicted by another process
+                    self.size -= self._index.pop(key)
+                self.misses += 1
+                return None
+
+    def _writing(self, key, chunks, md5=None):
+        """Writes chunks of bytes to the file of key, yielding each chunk once written. The generator returns the path
+        of the file, or None if md5 is given and doesn't match. A partial file, e.g. if the generator is closed before
+        the last chunk, is removed."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name in the same directory, so that the rename into place is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            digest = hashlib.md5()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for data in chunks:
+                    if md5:
+                        digest.update(data)
+                    f.write(data)
+                    size += len(data)
+                    yield data
+            if md5 and digest.hexdigest() != md5:
+                logger.warning(f"Not caching {key}, content doesn't match md5")
+                os.remove(tmp_path)
+                return None
+            os.replace(tmp_path, path)
+        except BaseException:  # Also GeneratorExit
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._add(key, size)
+            self._evict()
+            return path if key in self._index else None
+
+    def _write(self, key, chunks, md5=None):
+        """Writes chunks of bytes to the file of key, returning its path, or None if md5 is given and doesn't match"""
+        writing = self._writing(key, chunks, md5)
+        while True:
+            try:
+                next(writing)
+            except StopIteration as done:
+                return done.value
+
+    def put(self, gridfile):
+        """Copies a GridFS file into the cache and returns its path, or None if it doesn't fit.
+        The content is verified against the md5 so that a partial or corrupt read is never cached."""
+        md5 = gridfile.md5
+        if not self.enabled or not md5 or not re_cache_key.match(md5) or gridfile.length > self.max_file_bytes:
+            return None
+        gridfile.seek(0)
+        try:
+            return self._write(md5, iter(lambda: gridfile.read(self.chunk_size), b""), md5=md5)
+        finally:
+            gridfile.seek(0)
+
+    def store(self, key, data):
+        """Stores bytes under a key, e.g. a derivative of a file, and returns its path, or None if it doesn't fit"""
+        if not self.enabled or not re_cache_key.match(key) or len(data) > self.max_file_bytes:
+            return None
+        return self._write(key, [data])
+
+    def fetch(self, gridfile):
+        """Returns the path of a cached copy of a GridFS file, caching it first if missing. Returns None if the file
+        can't be cached, in which case it should be read from GridFS."""
+        if not self.enabled:
+            return None
+        return self.get(gridfile.md5) or self.put(gridfile)
+
+    def streaming(self, gridfile):
+        """Yields the chunks of a GridFS file, from the start, and caches the file as they are read, so that a miss
+        can be sent without waiting for the file to be cached. The file is only read from GridFS, if it can't be
+        cached, or if another request in this process is already caching it."""
+        md5 = gridfile.md5
+        gridfile.seek(0)
+        chunks = iter(lambda: gridfile.read(self.chunk_size), b"")
+        cacheable = self.enabled and md5 and re_cache_key.match(md5) and gridfile.length <= self.max_file_bytes
+        with self._lock:
+            caching = cacheable and md5 not in self._streaming
+            if caching:
+                self._streaming.add(md5)
+        if not caching:
+            yield from chunks
+            return
+        try:
+            yield from self._writing(md5, chunks, md5=md5)
+        finally:
+            with self._lock:
+                self._streaming.discard(md5)
+
+    def delete(self, key):
+        """Removes a file from the cache, and if the key is an md5, all derivatives of it"""
+        if not self.enabled or not key or not re_cache_key.match(key):
+            return
+        with self._lock:
+            for k in [k for k in self._index if k.startswith(key)]:
+                self._remove(k)
+            # Also those only indexed by other processes
+            directory = os.path.dirname(self.path(key))
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    if name.startswith(key):
+                        self._remove(name)
+
+    def stats(self):
+        return {
+            "size": len(self._index),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+file_cache = FileCache()
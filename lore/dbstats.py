@@ -0,0 +1,168 @@
+"""
+    lore.dbstats
+    ~~~~~~~~~~~~~~~~
+
+    Collects statistics about the MongoDB commands each request sends, using a
+    pymongo CommandListener. This includes the queries made outside of
+    ListResponse.finalize_query(), e.g. by dereferencing, access checks and
+    context processors.
+
+    The statistics are given as a Server-Timing header, as a log line per
+    request, and in the debug toolbar. As collecting adds some time to every
+    command, it is only done for all requests if DB_STATS_ENABLED, otherwise
+    only for requests that show the debug toolbar. Requests that make many finds of single
+    documents by id in the same collection, which is the typical sign of
+    dereferencing in a loop (N+1 queries), are logged as warnings.
+
+    :copyright: (c) 2014 by Helmgast AB
+"""
+import logging
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from pymongo import monitoring
+
+logger = current_app.logger if current_app else logging.getLogger(__name__)
+
+# Keys that differ between identical commands
+volatile_keys = frozenset(["lsid", "$clusterTime", "$db", "$readPreference", "txnNumber", "getMore"])
+
+
+class CommandRecord(object):
+    __slots__ = ["name", "collection", "command", "fingerprint", "single_id", "duration_ms", "docs", "failed"]
+
+    def __init__(self, name, collection, command):
+        self.name = name
+        self.collection = collection
+        self.command = {k: v for k, v in command.items() if k not in volatile_keys}
+        # Identical commands are built the same way, so the key order is the same and repr is enough
+        self.fingerprint = repr(self.command)
+        query_filter = command.get("filter") or {}
+        # E.g. find_one(id) or dereferencing a ReferenceField
+        self.single_id = (
+            name == "find" and list(query_filter.keys()) == ["_id"] and not isinstance(query_filter["_id"], dict)
+        )
+        self.duration_ms = 0.0
+        self.docs = 0
+        self.failed = False
+
+
+class QueryStats(object):
+    """The commands sent during one request"""
+
+    def __init__(self):
+        self.commands = []
+        self._pending = {}
+
+    @property
+    def count(self):
+        return len(self.commands)
+
+    @property
+    def duration_ms(self):
+        return sum(c.duration_ms for c in self.commands)
+
+    @property
+    def docs(self):
+        return sum(c.docs for c in self.commands)
+
+    def repeated(self):
+        """Returns the number of times each command was sent, for commands sent more than once"""
+        counts = Counter(c.fingerprint for c in self.commands)
+        return {fp: n for fp, n in counts.items() if n > 1}
+
+    def n_plus_one(self, threshold):
+        """Returns collections that got more than threshold finds of a single document by id"""
+        counts = Counter(c.collection for c in self.commands if c.single_id)
+        return {coll: n for coll, n in counts.items() if n > threshold}
+
+    def server_timing(self):
+        return f'db;dur={self.duration_ms:.1f};desc="{self.count} queries, {self.docs} docs"'
+
+    def log_line(self):
+        return (
+            f"db_stats path={request.path} queries={self.count} db_ms={self.duration_ms:.1f} "
+            f"db_docs={self.docs} repeated={sum(n - 1 for n in self.repeated().values())}"
+        )
+
+
+def reply_docs(reply):
+    """Returns the number of documents in a command reply. Cheaper than measuring the reply size, which would mean
+    encoding it again to BSON."""
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+    return 0
+
+
+def query_stats():
+    """Returns the query stats of the current request, if collecting"""
+    return g.get("query_stats", None) if has_request_context() else None
+
+
+class CommandCollector(monitoring.CommandListener):
+    """Adds each command sent from within a request to the QueryStats of that request.
+    Pymongo calls listeners in the thread that sends the command, so the request context is available."""
+
+    def started(self, event):
+        stats = query_stats()
+        if stats is not None:
+            collection = event.command.get(event.command_name)
+            if event.command_name == "getMore":
+                collection = event.command.get("collection")
+            if not isinstance(collection, str):
+                collection = None
+            stats._pending[event.request_id] = CommandRecord(event.command_name, collection, event.command)
+
+    def succeeded(self, event):
+        stats = query_stats()
+        record = stats._pending.pop(event.request_id, None) if stats is not None else None
+        if record:
+            record.duration_ms = event.duration_micros / 1000
+            record.docs = reply_docs(event.reply)
+            stats.commands.append(record)
+
+    def failed(self, event):
+        stats = query_stats()
+        record = stats._pending.pop(event.request_id, None) if stats is not None else None
+        if record:
+            record.duration_ms = event.duration_micros / 1000
+            record.failed = True
+            stats.commands.append(record)
+
+
+collector = CommandCollector()
+_registered = False
+
+
+def init_dbstats(app):
+    """Collects query stats for each request if DB_STATS_ENABLED, or else for requests that show the debug toolbar.
+    Has to be called before connecting to the database, as pymongo only adds listeners to clients created after they
+    are registered."""
+    global _registered
+    collect_all = app.config.get("DB_STATS_ENABLED", False)
+    if not collect_all and not (app.debug and app.config.get("DEBUG_TB_ENABLED", app.debug)):
+        return
+    if not _registered:
+        monitoring.register(collector)
+        _registered = True
+
+    @app.before_request
+    def start_query_stats():
+        if collect_all or "debug" in request.args:  # Same condition as for showing the toolbar
+            g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = query_stats()
+        if stats is None:
+            return response
+        response.headers.add("Server-Timing", stats.server_timing())
+        logger.info(stats.log_line())
+        threshold = app.config.get("DB_STATS_N_PLUS_ONE", 10)
+        for collection, n in stats.n_plus_one(threshold).items():
+            logger.warning(
+                f"Possible N+1 queries: {n} finds by id in '{collection}' for {request.path}, "
+                f"consider prefetching the references"
+            )
+        return response
@@ -44,6 +44,29 @@ class Config(object):
     URL_PREFIX = None  # Set to /something to add that as URL prefix globally for the app
     CLOUDINARY_DOMAIN = None
     SENTRY_SAMPLE_RATE = 0.2
+    PAGINATION_COUNT_TTL = 60  # Seconds to re-use counts of list results, 0 to always count
+    QUERY_VERSION_TTL = 60  # Seconds to re-use the latest update and count of list results for ETags, 0 to always query
+    FILTER_OPTIONS_TTL = 300  # Seconds to re-use filter options that are queried from database
+    DOCUMENT_CACHE_TTL = 60  # Seconds to re-use publishers and worlds fetched by slug or id
+    ENTITLEMENT_CACHE_TTL = 60  # Seconds to re-use the products and files a user owns, for access checks
+    DB_STATS_ENABLED = False  # Collect stats on database commands of all requests, not only when showing debug toolbar
+    DB_STATS_N_PLUS_ONE = 10  # Warn if a request finds more single documents by id than this in one collection
+    ASSET_CACHE_DIR = None  # Local directory to cache files from GridFS in, None to always read from GridFS
+    ASSET_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB, least recently used files are removed above this
+    ASSET_CACHE_MAX_FILE_BYTES = 64 * 1024 * 1024  # 64 MB, larger files are always read from GridFS
+    MARKDOWN_SHARED_MIN_LENGTH = 5000  # Markdown longer than this is kept rendered in the database, None to disable
+    FRAGMENT_CACHE_TTL = 300  # Default seconds to cache {% cache %} blocks in templates, 0 to disable
+    PAGE_CACHE = None  # Cache pages for anonymous visitors, "memory" per process or "mongo" shared, None to disable
+    PAGE_CACHE_TTL = {  # Seconds to cache the pages of each endpoint, others are never cached
+        "world.ArticlesView:publisher_home": 300,
+        "world.ArticlesView:world_home": 300,
+        "world.ArticlesView:get": 300,
+        "world.ArticlesView:blog": 300,
+        "world.ArticlesView:topics": 300,
+        "world.ArticlesView:feed": 600,
+    }
+    PAGE_CACHE_VARY = []  # Request headers that pages may vary on, responses varying on others are not cached
+    ASYNC_FILE_METADATA = False  # Fetch metadata of remote files with tasks instead of on save, needs flask run-tasks
 
 
 class SecretConfig(object):
@@ -1,4 +1,6 @@
+import hashlib
 import re
+import threading
 import types
 from operator import attrgetter
 
@@ -10,21 +12,27 @@ from bson.objectid import ObjectId
 from io import StringIO
 
 from flask import abort, request, session, current_app, g, render_template
-from flask_babel import Babel
+from flask_babel import Babel, get_locale
 from flask_mongoengine import Pagination, MongoEngine
 from flask.json import JSONEncoder, load
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_debugtoolbar.panels.route_list import RouteListDebugPanel
 from flask_wtf import CSRFProtect
-from jinja2 import Undefined, evalcontextfilter
+from jinja2 import Undefined, evalcontextfilter, nodes
+from jinja2.ext import Extension
 import markdown
 from markdown.treeprocessors import Treeprocessor
 from markupsafe import Markup
 from mongoengine import Document, QuerySet
+from mongoengine.base import get_document
+from mongoengine.errors import NotRegistered
+from mongoengine.connection import get_db
 from speaklater import _LazyString
 from werkzeug.routing import Rule, BaseConverter
 from werkzeug.urls import url_decode
 
+from lore.cache import collection_version, fragment_cache, markdown_cache
+
 toolbar = DebugToolbarExtension()
 
 
@@ -200,7 +208,10 @@ class MongoJSONEncoder(JSONEncoder):
         elif isinstance(o, ObjectId):
             return str(o)
         elif isinstance(o, Pagination):
-            return {"page": o.page, "per_page": o.per_page, "pages": o.pages, "total": o.total}
+            rv = {"page": o.page, "per_page": o.per_page, "pages": o.pages, "total": o.total}
+            if getattr(o, "keyset", None):
+                rv.update(next_cursor=o.next_cursor, prev_cursor=o.prev_cursor)
+            return rv
         if isinstance(o, _LazyString):  # i18n Babel uses lazy strings, need to be treated as string here
             return str(o)
         return JSONEncoder.default(self, o)
@@ -362,18 +373,96 @@ def unmark_element(element, stream=None):
     return stream.getvalue()
 
 
+rendered_markdown_ttl = 30 * 24 * 3600  # Seconds to keep rendered Markdown in the database after rendering it
+
+
+class MarkdownRenderer(object):
+    """Converts Markdown to HTML with one configuration, re-using earlier results for the same text. Results are kept
+    in process by markdown_cache, and texts longer than MARKDOWN_SHARED_MIN_LENGTH also in the database for all
+    processes, keyed by a hash of the configuration and the text (after escaping, if escaped). Unlike
+    markdown.Markdown, it can be shared between threads, as each thread (or greenlet, if gevent has patched
+    threading) converts with its own markdown.Markdown instance, which is reset between uses."""
+
+    _indexed = False
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._local = threading.local()
+        # Extension instances have no stable repr, so they are named by class
+        config = {
+            k: [e if isinstance(e, str) else type(e).__name__ for e in v] if k == "extensions" else v
+            for k, v in kwargs.items()
+        }
+        self.config_key = repr(sorted(config.items()))
+
+    def key(self, text):
+        return hashlib.sha1(f"{self.config_key}\0{text}".encode("utf-8")).hexdigest()
+
+    def converter(self):
+        """Returns the Markdown instance of this thread, creating it on first use, as creating one registers all
+        extensions and patterns again"""
+        md = getattr(self._local, "md", None)
+        if md is None:
+            md = markdown.Markdown(**self.kwargs)
+            if self.kwargs.get("stripTopLevelTags") is False:
+                md.stripTopLevelTags = False  # This is not read by Markdown __init__ so set manually
+            self._local.md = md
+        return md
+
+    def render(self, text):
+        md = self.converter()
+        try:
+            return md.convert(text)
+        finally:
+            md.reset()  # Clears state from this text, e.g. references and footnotes
+
+    def shared_store(self, text):
+        """Returns the database collection to keep the rendered text in, or None if too short to be worth it"""
+        min_length = current_app.config.get("MARKDOWN_SHARED_MIN_LENGTH") if current_app else None
+        if not min_length or len(text) < min_length:
+            return None
+        store = get_db()["rendered_markdown"]
+        if not MarkdownRenderer._indexed:
+            store.create_index("created", expireAfterSeconds=rendered_markdown_ttl)
+            MarkdownRenderer._indexed = True
+        return store
+
+    def convert(self, text, escape=False):
+        """Returns the HTML of Markdown text, escaping any HTML in it first if escape is True"""
+        text = str(jinja2.escape(text) if escape else text)
+        key = self.key(text)
+        html = markdown_cache.get(key)
+        if html is None:
+            store = self.shared_store(text)
+            rendered = store.find_one({"_id": key}, ["html"]) if store else None
+            html = rendered["html"] if rendered else self.render(text)
+            if store and not rendered:
+                store.replace_one({"_id": key}, {"html": html, "created": datetime.utcnow()}, upsert=True)
+            markdown_cache.set(key, html)
+        return html
+
+    def persist(self, text, escape=False):
+        """Renders text ahead of time, e.g. when its document is saved, if it is long enough to be stored"""
+        if text and self.shared_store(text):
+            self.convert(text, escape)
+
+
+def persist_markdown(*texts, escape=False):
+    """Renders texts with the app's Markdown configuration, so that they are ready when first shown"""
+    if current_app and hasattr(current_app, "md"):
+        for text in texts:
+            current_app.md.persist(text, escape)
+
+
 def build_md_filter(**kwargs):
+    renderer = MarkdownRenderer(**kwargs)
+
     @evalcontextfilter
     def markdown_filter(eval_ctx, stream):
         if not stream:
             return Markup("")
         else:
-            # We are creating a Markdown instance for each call, as it is not thread safe
-            md = markdown.Markdown(**kwargs)
-            if kwargs.get("stripTopLevelTags") is False:
-                md.stripTopLevelTags = False # This is not read by Markdown __init__ so set manually
-            markup = jinja2.escape(stream) if eval_ctx.autoescape else stream
-            return Markup(md.convert(markup))
+            return Markup(renderer.convert(stream, escape=eval_ctx.autoescape))
 
     return markdown_filter
 
@@ -400,6 +489,47 @@ def currentyear(nada):
     # return datetime.utcnow().strftime('%Y')
 
 
+class FragmentCacheExtension(Extension):
+    """Caches the output of a template block, for blocks that cost more than the rest of their page:
+
+        {% cache "publisher_worlds", 300, tags=["World", "FileAsset"] %} ... {% endcache %}
+
+    The key can be any value with a stable str(), and is combined with the host, locale and themes of the request.
+    Tags name the models (or collections) that the block shows, and the block is rendered again after any document
+    of those is saved or deleted. The TTL defaults to FRAGMENT_CACHE_TTL, which disables the cache if 0. Blocks
+    with per-user content need the user in their key."""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        ttl, tags = nodes.Const(None), nodes.List([])
+        while parser.stream.skip_if("comma"):
+            if parser.stream.current.test("name:tags") and parser.stream.look().test("assign"):
+                parser.stream.skip(2)
+                tags = parser.parse_expression()
+            else:
+                ttl = parser.parse_expression()
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cached_block", [key, ttl, tags]), [], [], body).set_lineno(lineno)
+
+    def _cached_block(self, key, ttl, tags, caller):
+        if ttl is None:
+            ttl = current_app.config.get("FRAGMENT_CACHE_TTL", 0)
+        if not ttl:
+            return caller()
+        collections = []
+        for tag in tags:
+            try:
+                collections.append(get_document(tag)._get_collection_name())
+            except NotRegistered:
+                collections.append(tag)
+        themes = tuple(getattr(g.get(f"{t}_theme"), "name", None) for t in ("publisher", "world", "article"))
+        cache_key = (str(key), g.get("pub_host"), str(get_locale()), themes, collection_version(*collections))
+        return fragment_cache.get_or_set(cache_key, caller, ttl)
+
+
 def dict_without(value, *args):
     return {k: value[k] for k in list(value.keys()) if k not in args}
 
@@ -7,6 +7,7 @@
 import hashlib
 import logging
 import mimetypes
+from collections import Counter, defaultdict
 from io import BytesIO, StringIO
 from datetime import datetime
 
@@ -15,6 +16,7 @@ import os.path
 from urllib.parse import urlparse, quote, unquote
 
 from bson import ObjectId
+from pymongo import ReturnDocument
 from flask import request, current_app, g, url_for
 from flask_babel import gettext, lazy_gettext as _
 
@@ -32,17 +34,23 @@ from mongoengine import (
     NULLIFY,
     DENY,
     CASCADE,
+    signals,
 )
 from mongoengine import ValidationError, EmbeddedDocument
+from mongoengine.connection import get_db
+from mongoengine.fields import GridFSProxy
 from mongoengine.queryset import Q
 from werkzeug.utils import secure_filename
 
 from .misc import Choices, reference_options, choice_options, numerical_options, distinct_options
-from .misc import slugify
+from .misc import IdentityMappedReferenceField, register_sort_keys, slugify, SortKeyField
 from .user import User, Group
 import magic
 import re
+from lore.cache import KeyLocks, derivative_cache, file_cache
+from lore.model.fingerprint import FingerprintOffsetFinder, find_fingerprint_offsets
 from lore.model.misc import extract
+from lore.model.task import PermanentError, enqueue, task
 
 try:
     from PIL import Image, ImageOps
@@ -59,6 +67,12 @@ FileAccessType = Choices(
     user=_("User unique and product required"),
 )  # Access given through some product, also user specific
 
+# Metadata of remote files that is not known yet, unset when known
+MetadataStatus = Choices(
+    pending=_("Pending"),  # To be fetched by the fetch_file_metadata task
+    failed=_("Failed"),  # The remote file couldn't be fetched or has a forbidden type
+)
+
 allowed_mimetypes = {
     "application/pdf": "pdf",
     "application/rtf": "rtf",
@@ -188,6 +202,18 @@ def get_google_urls(url=None, id=None):
     return urls
 
 
+def filename_from_response(r, url):
+    """Returns the filename of a remote file from the Content-Disposition header of a response, or else the URL"""
+    # Content-Disposition	examples
+    # attachment;filename="anon_2d-1200px.png";filename*=UTF-8''anon_2d-1200px.png
+    # inline;filename="v_rldstr_dets-grenar-20200423.pdf";filename*=UTF-8\'\'v%C3%A4rldstr%C3%A4dets-grenar-20200423.pdf
+    fname, fnameutf = extract(
+        r.headers.get("content-disposition", ""), r'filename="(.*?)";(?:filename\*=UTF-8\'\'([^;]+))?', groups=2
+    )
+    fnameutf = unquote(fnameutf)
+    return fnameutf or fname or os.path.basename(urlparse(url).path)
+
+
 def sniff_remote_file(url):
     metadata = get_gdrive_metadata(url)  # Returns None if wasn't Google URL or didn't work
     if metadata is not None:
@@ -198,14 +224,7 @@ def sniff_remote_file(url):
     headers = {"Range": "bytes=0-100"}
     r = requests.get(url, headers=headers)
     content_type = r.headers.get("content-type", "")
-    # Content-Disposition	examples
-    # attachment;filename="anon_2d-1200px.png";filename*=UTF-8''anon_2d-1200px.png
-    # inline;filename="v_rldstr_dets-grenar-20200423.pdf";filename*=UTF-8\'\'v%C3%A4rldstr%C3%A4dets-grenar-20200423.pdf
-    fname, fnameutf = extract(
-        r.headers.get("content-disposition", ""), r'filename="(.*?)";(?:filename\*=UTF-8\'\'([^;]+))?', groups=2
-    )
-    fnameutf = unquote(fnameutf)
-    fname = fnameutf or fname or os.path.basename(urlparse(url).path)
+    fname = filename_from_response(r, url)
     length = int(extract(r.headers.get("content-range", ""), r"bytes \d+-\d+\/(.*)", 0))
     width, height = (0, 0)
     try:
@@ -216,6 +235,41 @@ def sniff_remote_file(url):
     return {"fname": fname, "content_type": content_type, "w": width, "h": height, "length": length, "response": r}
 
 
+def fetch_remote_metadata(url, timeout=30):
+    """Downloads a remote file to find all its metadata, unlike sniff_remote_file. The md5 is computed and image
+    dimensions are read from the header as the file streams in, so it is never held in memory."""
+    metadata = get_gdrive_metadata(url)
+    if metadata is not None:
+        return metadata
+
+    md5, length, header, image = hashlib.md5(), 0, b"", None
+    with requests.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        content_type = r.headers.get("content-type", "").split(";")[0].strip()
+        for block in r.iter_content(upload_block_size):
+            if not length and content_type not in allowed_mimetypes:
+                # E.g. application/octet-stream, so guess from the file header as with uploads
+                content_type = magic.from_buffer(block[:1024], mime=True)
+            md5.update(block)
+            length += len(block)
+            if content_type.startswith("image/") and not image and len(header) < max_image_header:
+                header += block
+                image = image_header(header)
+        fname = filename_from_response(r, url)
+    width, height = (0, 0)
+    if image:
+        content_type, width, height = image
+    return {
+        "fname": fname,
+        "content_type": content_type,
+        "md5": md5.hexdigest(),
+        "w": width,
+        "h": height,
+        "length": length,
+        "response": r,
+    }
+
+
 class Attachment(EmbeddedDocument):
     source_url = URLField(verbose_name=_("Source File URL"))
     filename = StringField(
@@ -285,22 +339,174 @@ def cloudinary_url(url, format=None, transform="", **kwargs):
         return url
 
 
+# Local equivalents of cloudinary_transforms, as the (width, height) that images are shrunk to fit within
+image_presets = {
+    "wide": (2400, None),
+    "center": (1600, None),
+    "card": (800, None),
+    "icon": (200, None),
+    "thumb": (250, 250),
+    "fix": (None, None),  # Only re-encoded
+}
+
+# Formats for image derivatives, in order of preference, used if Pillow can write them and the client accepts them
+derivative_formats = [("image/avif", "AVIF", "avif"), ("image/webp", "WEBP", "webp")]
+# Images of other types, e.g. GIFs which may be animated, are always sent as is
+resizable_formats = {"image/jpeg": ("image/jpeg", "JPEG", "jpg"), "image/png": ("image/png", "PNG", "png")}
+derivative_quality = 80
+upload_block_size = 255 * 1024  # Same as the GridFS chunk size
+max_image_header = 4 * 1024 * 1024  # Images with more metadata than this before the size are not accepted
+derivative_locks = KeyLocks()
+
+
+def image_header(data):
+    """Returns the (content type, width, height) of an image from the start of its data, as only the header is read
+    when opening it. Returns None if the header is not complete, and raises ValidationError if it's invalid."""
+    try:
+        img = Image.open(BytesIO(data))
+    except (OSError, SyntaxError):
+        return None
+    except Exception as e:
+        # E.g. DecompressionBombError or struct.error from a malformed header
+        raise ValidationError("Invalid image: %s" % e)
+    return Image.MIME.get(img.format), img.width, img.height
+
+
+def derivative_format(content_type, accept_mimetypes=None):
+    """Returns the (mimetype, Pillow format, extension) that a derivative of an image should be written as,
+    picking the first of derivative_formats that the client explicitly accepts, else the format of the image itself.
+    Returns None if the image can't be resized."""
+    if not Image or content_type not in resizable_formats:
+        return None
+    Image.init()
+    accepted = {mimetype for mimetype, quality in accept_mimetypes or [] if quality > 0}
+    for fmt in derivative_formats:
+        if fmt[0] in accepted and fmt[1] in Image.SAVE:
+            return fmt
+    return resizable_formats[content_type]
+
+
+def render_derivative(fileobj, preset, fmt):
+    """Returns the bytes of an image resized to fit the preset, without enlarging it, and written in format fmt"""
+    width, height = image_presets[preset]
+    img = Image.open(fileobj)
+    img = ImageOps.exif_transpose(img)  # Rotate according to the camera, as the EXIF data is not kept
+    if width or height:
+        img.thumbnail((width or img.width, height or img.height), Image.LANCZOS)
+    if fmt[1] == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    out = BytesIO()
+    if fmt[1] == "PNG":
+        img.save(out, fmt[1], optimize=True)
+    else:
+        img.save(out, fmt[1], quality=derivative_quality)
+    return out.getvalue()
+
+
+def image_derivative(gridfile, preset, fmt):
+    """Returns a file object with a derivative of an image in GridFS, rendering it if not already cached.
+    Derivatives are kept in the disk cache if enabled, else in memory, keyed by the md5 of the image, the preset and
+    the format. Concurrent requests for the same derivative wait for the first one to render it."""
+    key = f"{gridfile.md5}.{preset}.{fmt[2]}"
+    with derivative_locks(key):
+        path = file_cache.get(key)
+        if path:
+            return open(path, "rb")
+        data = derivative_cache.get(key)
+        if data is None:
+            source = file_cache.fetch(gridfile)
+            if source:
+                with open(source, "rb") as f:
+                    data = render_derivative(f, preset, fmt)
+            else:
+                data = render_derivative(gridfile, preset, fmt)
+            path = file_cache.store(key, data)
+            if path:
+                return open(path, "rb")
+            derivative_cache.set(key, data)
+        return BytesIO(data)
+
+
+class BlobProxy(GridFSProxy):
+    """A GridFS file that is stored once per content (md5 and length), and shared by all FileAssets with that content.
+    The GridFS file counts the FileAssets using it, and deleting through the proxy only drops this reference, and the
+    file with the last one. Files stored before they were shared count as used once, until collapse_blobs() is run."""
+
+    _indexed = set()
+
+    @property
+    def files(self):
+        files = get_db(self.db_alias)[f"{self.collection_name}.files"]
+        if files.full_name not in BlobProxy._indexed:
+            files.create_index([("md5", 1), ("length", 1)])
+            BlobProxy._indexed.add(files.full_name)
+        return files
+
+    def share(self, grid_id):
+        """Returns the id of a stored file with the same content as the newly written file grid_id, adding a reference
+        to it and removing the new file. Returns grid_id, with one reference, if the content is new."""
+        new = self.files.find_one({"_id": grid_id}, ["md5", "length"])
+        if new.get("md5"):
+            existing = self.files.find_one_and_update(
+                # A file without references may be deleted by release() at any moment, so it is never shared
+                {"md5": new["md5"], "length": new["length"], "_id": {"$ne": grid_id}, "refcount": {"$gt": 0}},
+                {"$inc": {"refcount": 1}},
+                projection=["_id"],
+            )
+            if existing:
+                self.fs.delete(grid_id)
+                return existing["_id"]
+        self.files.update_one({"_id": grid_id}, {"$set": {"refcount": 1}})
+        return grid_id
+
+    def release(self, grid_id):
+        """Drops a reference to a stored file, and removes the file if it was the last"""
+        self.files.update_one({"_id": grid_id, "refcount": {"$exists": False}}, {"$set": {"refcount": 1}})
+        blob = self.files.find_one_and_update(
+            {"_id": grid_id, "refcount": {"$gt": 0}},
+            {"$inc": {"refcount": -1}},
+            projection=["md5", "refcount"],
+            return_document=ReturnDocument.AFTER,
+        )
+        if blob and blob["refcount"] <= 0:
+            self.fs.delete(grid_id)
+            file_cache.delete(blob.get("md5"))
+
+    def put(self, file_obj, **kwargs):
+        super().put(file_obj, **kwargs)
+        self.grid_id = self.share(self.grid_id)
+
+    def delete(self):
+        if self.grid_id is not None:
+            self.release(self.grid_id)
+        self.grid_id = None
+        self.gridout = None
+        self._mark_as_changed()
+
+
+class BlobField(FileField):
+    """A FileField with files shared by content, see BlobProxy"""
+
+    proxy_class = BlobProxy
+
+
 class FileAsset(Document):
     slug = StringField(max_length=99, unique=True)
     meta = {
-        "indexes": ["slug", "md5", {"fields": ["$slug", "$title", "$description", "$tags"]}],
+        "indexes": ["slug", "md5", {"fields": ["$slug", "$title", "$description", "$tags"]}, "sort_publisher_title"],
         # 'auto_create_index': True
     }
 
     title = StringField(max_length=99, verbose_name=_("Title"))
     description = StringField(max_length=500, verbose_name=_("Description"))
     owner = ReferenceField(User, reverse_delete_rule=NULLIFY, verbose_name=_("User"))
-    file_data = FileField(verbose_name=_("File data"))
+    file_data = BlobField(verbose_name=_("File data"))
     access_type = StringField(
         choices=FileAccessType.to_tuples(), default=FileAccessType.public, verbose_name=_("Access type")
     )
     tags = ListField(StringField(max_length=60), verbose_name=_("Tags"))
-    publisher = ReferenceField("Publisher", verbose_name=_("Publisher"))
+    publisher = IdentityMappedReferenceField("Publisher", verbose_name=_("Publisher"))
+    sort_publisher_title = SortKeyField("publisher.title")
 
     # Variables reflecting the underlying file object, updates on clean
     source_filename = StringField(max_length=60, verbose_name=_("Filename"))
@@ -310,6 +516,9 @@ class FileAsset(Document):
     width = IntField()
     height = IntField()
     md5 = StringField()
+    # Byte offsets where PDFs are fingerprinted per user, None if not yet found
+    fingerprint_offsets = ListField(IntField(), default=None)
+    metadata_status = StringField(choices=MetadataStatus.to_tuples(), verbose_name=_("Metadata status"))
 
     # Optional data about source
     source_file_url = URLField(verbose_name=_("Source File URL"))
@@ -317,7 +526,8 @@ class FileAsset(Document):
     # Alternative filename when downloaded
     # TODO DEPRECATE
     attachment_filename = StringField(max_length=60, verbose_name=_("Filename when downloading"))
-    tmp_file_obj = None
+    new_grid_id = None  # A new file in GridFS, set by set_file, to replace file_data with when saved
+    replaced_grid_id = None  # The file replaced by new_grid_id, released once the asset is saved
 
     # def delete(self):
     #     if self.file_data:
@@ -325,23 +535,32 @@ class FileAsset(Document):
     #         self.file_data = None
     #     super(FileAsset, self).delete(clean=False)
 
+    def save(self, *args, **kwargs):
+        """Saves the asset. A new file written to GridFS by set_file is removed again if the asset fails validation
+        or can't be written, and the asset keeps its current file. The file it replaces is released after saving, see
+        _release_replaced_file."""
+        try:
+            rv = super(FileAsset, self).save(*args, **kwargs)
+        except Exception:
+            if self.new_grid_id:
+                if self.file_data.grid_id == self.new_grid_id:
+                    self.file_data.grid_id = self.replaced_grid_id
+                self.file_data.release(self.new_grid_id)
+                self.new_grid_id = self.replaced_grid_id = None
+            raise
+        self.new_grid_id = self.replaced_grid_id = None
+        return rv
+
     def is_image(self):
         return self.content_type.startswith("image/")
 
-    @classmethod
-    def create_md5(cls, file_obj):
-        block_size = 256 * 128
-        md5 = hashlib.md5()
-        for chunk in iter(lambda: file_obj.read(block_size), b""):
-            md5.update(chunk)
-        file_obj.seek(0)  # reset
-        return md5.hexdigest()
-
     def feature_url(self, **kwargs):
         kwargs["_external"] = True
         format = kwargs.pop("format", None)
         transform = kwargs.pop("transform", "")
 
+        if not self.source_file_url and format in image_presets and not current_app.config.get("CLOUDINARY_DOMAIN"):
+            kwargs["preset"] = format  # Resize it ourselves
         source_url = self.source_file_url or url_for("image_thumb", slug=self.slug, **kwargs)
         return cloudinary_url(source_url, format=format, transform=transform)
 
@@ -367,7 +586,7 @@ class FileAsset(Document):
 
     @property
     def thumb_url(self):
-        return self.feature_url(transform="w_250,h_250,c_limit")
+        return self.feature_url(format="thumb", transform="w_250,h_250,c_limit")
 
     def aspect_ratio(self):
         if self.height:
@@ -376,50 +595,87 @@ class FileAsset(Document):
             return 1.0
 
     def set_file(self, file_obj, filename, update_file=True):
+        """Reads a new file for this asset in one pass: the type is sniffed from the first block, image dimensions
+        are read from the header without decoding pixels, and the data is written to GridFS (unless update_file is
+        False) while GridFS computes the md5. The new GridFS file replaces the current one when the asset is
+        cleaned, and is removed again if the file is invalid or a duplicate."""
         assert file_obj
         assert filename
 
+        block = file_obj.read(upload_block_size)
         # Guess content type using file header instead of metadata
-        content_type = magic.from_buffer(file_obj.read(1024), mime=True)
-        file_obj.seek(0)
+        content_type = magic.from_buffer(block[:1024], mime=True)
         if content_type not in allowed_mimetypes:
             raise ValidationError(gettext("Files of type %(mimetype)s are not allowed.", mimetype=content_type))
 
-        # Check MD5 hash to avoid uploading duplicates
-        md5 = FileAsset.create_md5(file_obj)
-        if not md5:
-            raise ValidationError("No MD5 from file_obj")
-
-        # Check if we already have this file in data
-        if self.file_data:
-            # We have data, first check if
-            existing_md5 = self.file_data.get().md5
-            update_file = md5 != existing_md5  # Don't update file if md5 is same
-
-        # Check if other files have same MD5
-        existing = FileAsset.objects(md5=md5, id__ne=(self.id or ObjectId(b"notaobjectid")))  # needs to be 12 bytes
-        if existing.count() > 0:
-            raise ValidationError("Identical file already uploaded with name %s" % existing.get(0))
-
-        # Check if valid image and get width/height if so
-        if content_type.startswith("image/"):
-            try:
-                img = Image.open(file_obj)
-                content_type = Image.MIME[img.format]
+        is_image = content_type.startswith("image/")
+        header, image = b"", None
+        finder = FingerprintOffsetFinder() if content_type == "application/pdf" else None
+        grid_in = self.file_data.fs.new_file(content_type=content_type, filename=filename) if update_file else None
+        md5 = hashlib.md5() if not grid_in else None
+        try:
+            while block:
+                if grid_in:
+                    grid_in.write(block)
+                else:
+                    md5.update(block)
+                if finder:
+                    finder.feed(block)
+                if is_image and not image and len(header) < max_image_header:
+                    header += block
+                    image = image_header(header)
+                block = file_obj.read(upload_block_size)
+
+            # Check if valid image and get width/height if so
+            if is_image:
+                if not image:
+                    raise ValidationError("Invalid image: couldn't read image header")
+                content_type, self.width, self.height = image
                 # Check type again, may have changed
                 if content_type not in allowed_mimetypes:
                     raise ValidationError("Not an allowed image type")
-                self.width, self.height = img.size
-            except Exception as e:
-                raise ValidationError("Invalid image: %s" % e)
-            file_obj.seek(0)
-        else:
-            self.width, self.height = 400, 400  # Default sizing for non images, which will get an SVG icon
+            else:
+                self.width, self.height = 400, 400  # Default sizing for non images, which will get an SVG icon
+
+            if grid_in:
+                grid_in.content_type = content_type
+                grid_in.close()
+                md5 = grid_in.md5
+            else:
+                md5 = md5.hexdigest()
+            if not md5:
+                raise ValidationError("No MD5 from file_obj")
+
+            # Check if other files of the publisher have same MD5. Other publishers may have the file, and share it.
+            existing = (
+                FileAsset.objects(
+                    md5=md5, publisher=self.publisher, id__ne=(self.id or ObjectId(b"notaobjectid"))  # needs 12 bytes
+                )
+                .only("slug")
+                .first()
+            )
+            if existing:
+                raise ValidationError("Identical file already uploaded with name %s" % existing)
+        except Exception:
+            if grid_in:
+                # Roll back the file written so far
+                if grid_in.closed:
+                    self.file_data.fs.delete(grid_in._id)
+                else:
+                    grid_in.abort()
+            raise
+
+        # Check if we already have this file in data, then we don't need the new copy
+        if grid_in and self.file_data_exists() and self.file_data.get().md5 == md5:
+            self.file_data.fs.delete(grid_in._id)
+            grid_in = None
+
         self.source_filename = filename
         self.content_type = content_type
-        # Sync means we will re-create all fields but not actually change the file_obj
-        if update_file:
-            self.tmp_file_obj = file_obj
+        self.fingerprint_offsets = finder.offsets if finder else None
+        # Sync means we will re-create all fields but not actually change the file
+        if grid_in:
+            self.new_grid_id = self.file_data.share(grid_in._id)
 
     @classmethod
     def make_slug(cls, filename, content_type):
@@ -431,9 +687,13 @@ class FileAsset(Document):
         return name + "." + allowed_mimetypes[content_type]
 
     def clean(self):
-        self.length = 0
         self.created_date = datetime.utcnow()
-        self.md5 = ""
+        url_changed = bool(self.source_file_url) and "source_file_url" in getattr(self, "_changed_fields", [])
+        if not self.source_file_url or self.file_data_exists() or url_changed:
+            # Metadata of remote files is otherwise kept, as it may have been fetched by a task
+            self.length = 0
+            self.md5 = ""
+        async_metadata = current_app and current_app.config.get("ASYNC_FILE_METADATA", False)
 
         new_file_obj = request.files.get("file_data", None) if request else None
         # This assumes there is a file upload
@@ -446,18 +706,19 @@ class FileAsset(Document):
             # A cloudinary URL
             return
         elif (self.source_file_url and not self.file_data) and not (self.source_filename and self.content_type):
-            metadata = sniff_remote_file(self.source_file_url)
-            self.source_filename = metadata["fname"]
-            self.content_type = metadata["content_type"]
-            if self.content_type not in allowed_mimetypes:
-                raise ValidationError(
-                    f"Asset {self.source_file_url} has forbidden content type {self.content_type}. "
-                    + f"Check URL for correctness. Response: {metadata['response']}"
-                )
-            self.width, self.height = metadata["w"], metadata["h"]
-            self.length = metadata["length"]
-            if "md5" in metadata:
-                self.md5 = metadata["md5"]
+            guessed_filename = os.path.basename(urlparse(self.source_file_url).path)
+            if async_metadata and guess_content_type(guessed_filename):
+                # Guess from the URL for now, fetch_file_metadata will fetch the actual metadata after saving
+                self.source_filename = guessed_filename
+                self.content_type = guess_content_type(guessed_filename)
+                self.metadata_status = MetadataStatus.pending
+            else:
+                self.set_remote_metadata(sniff_remote_file(self.source_file_url))
+        elif self.source_file_url and not self.file_data and (url_changed or (not self.length and async_metadata)):
+            # Filename and content type are given, e.g. by an import or when editing the URL, but not the rest of the
+            # metadata. A new URL is fetched even if the previous one failed.
+            if url_changed or self.metadata_status != MetadataStatus.failed:
+                self.metadata_status = MetadataStatus.pending
         if not self.source_filename or not self.content_type:
             raise ValidationError("No filename or content type created for FileAsset, aborting")
 
@@ -468,10 +729,12 @@ class FileAsset(Document):
             # Generate slug first time
             self.slug = FileAsset.make_slug(self.title or self.source_filename, self.content_type)
 
-        if self.tmp_file_obj:
-            # We have received a file obj
-            self.file_data.replace(self.tmp_file_obj, content_type=self.content_type, filename=self.source_filename)
-            self.tmp_file_obj = None
+        if self.new_grid_id and self.file_data.grid_id != self.new_grid_id:
+            # We have received a new file, already written to GridFS by set_file, that replaces the old one. The old
+            # one is still used by the stored asset, so it's released after saving.
+            self.replaced_grid_id = self.file_data.grid_id
+            self.file_data.grid_id = self.new_grid_id
+            self.file_data._mark_as_changed()
 
         fs = self.file_data.get() if self.file_data else None
         if fs:
@@ -489,6 +752,20 @@ class FileAsset(Document):
         ):  # Don't overwrite owner as it may mean admins overwrite original uploader
             self.owner = g.user
 
+    def set_remote_metadata(self, metadata):
+        """Sets the metadata of a remote file, as returned by sniff_remote_file or fetch_remote_metadata"""
+        self.source_filename = self.source_filename or metadata["fname"]
+        self.content_type = metadata["content_type"]
+        if self.content_type not in allowed_mimetypes:
+            raise ValidationError(
+                f"Asset {self.source_file_url} has forbidden content type {self.content_type}. "
+                + f"Check URL for correctness. Response: {metadata['response']}"
+            )
+        self.width, self.height = metadata["w"], metadata["h"]
+        self.length = metadata["length"]
+        if metadata.get("md5"):
+            self.md5 = metadata["md5"]
+
     def get_attachment_filename(self):
         filename = self.attachment_filename if self.attachment_filename is not None else self.source_filename
         return filename
@@ -499,6 +776,14 @@ class FileAsset(Document):
     def file_data_exists(self):
         return self.file_data and self.file_data.grid_id is not None
 
+    def get_fingerprint_offsets(self):
+        """Returns where to fingerprint this PDF, finding and storing the offsets first if uploaded before they
+        were stored"""
+        if self.fingerprint_offsets is None and self.file_data_exists():
+            self.fingerprint_offsets = find_fingerprint_offsets(self.file_data.get())
+            FileAsset.objects(id=self.id).update_one(set__fingerprint_offsets=self.fingerprint_offsets)
+        return self.fingerprint_offsets
+
     def get_mimetype(self):
         return mimetypes.guess_type(self.source_filename)[0]
 
@@ -506,6 +791,74 @@ class FileAsset(Document):
         return "%s" % (self.title or self.slug)
 
 
+@task
+def fetch_file_metadata(asset_id):
+    """Fetches the metadata of a remote FileAsset that is pending it. HTTP errors are raised, to be retried."""
+    fa = FileAsset.objects(id=asset_id).first()
+    if not fa or fa.metadata_status != MetadataStatus.pending:
+        return
+    try:
+        fa.set_remote_metadata(fetch_remote_metadata(fa.source_file_url))
+    except ValidationError as e:
+        FileAsset.objects(id=asset_id).update_one(set__metadata_status=MetadataStatus.failed)
+        raise PermanentError(str(e)) from e
+    # Only update the metadata fields, as clean() would have the asset wait for metadata again
+    FileAsset.objects(id=asset_id).update_one(
+        set__source_filename=fa.source_filename,
+        set__content_type=fa.content_type,
+        set__width=fa.width,
+        set__height=fa.height,
+        set__length=fa.length,
+        set__md5=fa.md5,
+        unset__metadata_status=True,
+    )
+
+
+def _queue_metadata_fetch(sender, document, **kwargs):
+    if document.metadata_status == MetadataStatus.pending:
+        enqueue("fetch_file_metadata", key=str(document.id), asset_id=str(document.id))
+
+
+def _release_replaced_file(sender, document, **kwargs):
+    if document.replaced_grid_id and document.replaced_grid_id != document.file_data.grid_id:
+        document.file_data.release(document.replaced_grid_id)  # Removes the file unless shared
+    document.replaced_grid_id = None
+
+
+signals.post_save.connect(_queue_metadata_fetch, sender=FileAsset)
+signals.post_save.connect(_release_replaced_file, sender=FileAsset)
+
+
+def collapse_blobs():
+    """Points FileAssets with the same content to one stored file and removes the copies, as if the files had been
+    shared since uploaded, and sets the refcount of all files used by FileAssets. Files not used by any FileAsset are
+    left as they are. Meant to be run once, as a migration, as the counts are not exact if files change meanwhile.
+    Returns the number of copies removed and their total size."""
+    blobs = BlobProxy(db_alias=FileAsset.file_data.db_alias, collection_name=FileAsset.file_data.collection_name)
+    assets = FileAsset._get_collection()
+    refs = Counter(a["file_data"] for a in assets.find({"file_data": {"$ne": None}}, ["file_data"]))
+    by_content = defaultdict(list)
+    for f in blobs.files.find({"_id": {"$in": list(refs)}}, ["md5", "length"]).sort("uploadDate", 1):
+        by_content[(f.get("md5"), f["length"])].append(f["_id"])
+
+    removed, size = 0, 0
+    for (md5, length), ids in by_content.items():
+        if not md5:
+            # Can't tell if the content is the same
+            for grid_id in ids:
+                blobs.files.update_one({"_id": grid_id}, {"$set": {"refcount": refs[grid_id]}})
+            continue
+        keep, copies = ids[0], ids[1:]
+        if copies:
+            assets.update_many({"file_data": {"$in": copies}}, {"$set": {"file_data": keep}})
+            for grid_id in copies:
+                refs[keep] += refs.pop(grid_id)
+                blobs.fs.delete(grid_id)
+            removed += len(copies)
+            size += length * len(copies)
+        blobs.files.update_one({"_id": keep}, {"$set": {"refcount": refs[keep]}})
+    return removed, size
+
 # Regsister delete rule here becaue in User, we haven't imported FileAsset so won't work from there
 FileAsset.register_delete_rule(User, "images", NULLIFY)
 FileAsset.register_delete_rule(Group, "images", NULLIFY)
@@ -525,6 +878,7 @@ FileAsset.length.filter_options = numerical_options(
 )
 FileAsset.tags.filter_options = distinct_options("tags", FileAsset)
 FileAsset.access_type.filter_options = choice_options("access_type", FileAsset.access_type.choices)
+register_sort_keys(FileAsset)
 
 MimeTypes = Choices({"image/jpeg": "JPEG", "image/png": "PNG", "image/gif": "GIF"})
 IMAGE_FILE_ENDING = {"image/jpeg": "jpg", "image/png": "png", "image/gif": "gif"}
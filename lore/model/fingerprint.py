@@ -0,0 +1,62 @@
+"""
+    lore.model.fingerprint
+    ~~~~~~~~~~~~~~~~
+
+    Fingerprints of users, and where to write them in PDFs that users
+    download. Kept with the models as users are indexed by fingerprint and
+    file assets store the offsets when uploaded, see lore.api.pdf for the
+    fingerprint format and how PDFs are served.
+
+    :copyright: (c) 2014 by Helmgast AB
+"""
+import re
+from hashlib import md5
+
+# rb = bytes regex
+pdf_id = re.compile(rb"trailer\s+<<.*?ID\[<(.{12})")  # may be multiline
+doc_id = re.compile(rb"<xmpMM:DocumentID>xmp.did:(.{12})")  # wouldn't be multiline
+font_id = re.compile(rb"/FontFamily\(([^)]{12})")  # wouldn't be multiline
+
+window_size = 512  # size in bytes of the sliding window
+
+
+def fingerprint_from_user(user_id):
+    return md5(str(user_id).encode()).hexdigest()[:12].upper().encode()  # first 12 chars of hexdigest
+
+
+class FingerprintOffsetFinder(object):
+    """Finds the byte offsets of the 12 bytes to replace with the user hash, for the first match of each of pdf_id,
+    doc_id and font_id, from blocks of a file fed in order. Each block is searched together with the end of the
+    previous one, so that a match across two blocks is still found."""
+
+    patterns = [pdf_id, doc_id, font_id]
+    overlap = window_size * 2
+
+    def __init__(self):
+        self.found = {}
+        self._tail = b""
+        self._pos = 0  # File position of the start of _tail
+
+    def feed(self, data):
+        if len(self.found) == len(self.patterns):
+            return
+        block = self._tail + data
+        for pattern in self.patterns:
+            if pattern not in self.found:
+                m = pattern.search(block)
+                if m:
+                    self.found[pattern] = self._pos + m.start(1)
+        self._tail = block[-self.overlap :]
+        self._pos += len(block) - len(self._tail)
+
+    @property
+    def offsets(self):
+        return sorted(self.found.values())
+
+
+def find_fingerprint_offsets(file_object, block_size=1024 * 1024):
+    """Returns the sorted byte offsets where a PDF should be fingerprinted, reading the file once in large blocks"""
+    finder = FingerprintOffsetFinder()
+    for block in iter(lambda: file_object.read(block_size), b""):
+        finder.feed(block)
+    return finder.offsets
@@ -12,28 +12,33 @@ import logging
 import re
 import unicodedata
 import urllib.request, urllib.parse, urllib.error
-from collections import namedtuple, OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
 from datetime import timedelta, date
 from urllib.parse import urlparse
 import hashlib
+import copy
+from functools import partial
 import dateutil
 
 
 import flask_mongoengine
 from babel import Locale
-from bson import ObjectId
+from bson import DBRef, ObjectId
+from bson.errors import InvalidId
 from dateutil.relativedelta import *
 from flask import current_app
-from flask import g, request, url_for
+from flask import abort, g, request, url_for
 from flask.json import load
 from flask_babel import lazy_gettext as _, get_locale, format_date, format_timedelta
 from jinja2 import TemplateNotFound
-from mongoengine import EmbeddedDocument, StringField, ReferenceField
+from mongoengine import EmbeddedDocument, InvalidQueryError, ListField, StringField, ReferenceField, signals
+from mongoengine.base import BaseDocument, BaseList
 from mongoengine.base.fields import BaseField
 from mongoengine.queryset import Q
 from mongoengine.queryset.transform import STRING_OPERATORS
 from slugify import slugify as ext_slugify
 
+from lore.cache import collection_version, document_cache, identity_map, slug_cache
 from lore.extensions import configured_locales, configured_langs
 from nltk.corpus import stopwords
 import pyphen
@@ -73,6 +78,211 @@ default_translated_strings = {l: "" for l in configured_langs.keys()}
 configured_langs_tuples = [(lang, locale.language_name.capitalize()) for lang, locale in configured_langs.items()]
 
 
+class CachedDocumentMixin(object):
+    """Adds lookups of documents by id or slug that first check the identity map of the current request,
+    then a process wide cache of the raw documents, before querying the database. Meant for small documents
+    that are read on most requests, like Publisher and World."""
+
+    @classmethod
+    def cached(cls, id=None, slug=None):
+        field, value = ("id", id) if id is not None else ("slug", slug)
+        if not value:
+            return None
+        if field == "id" and not isinstance(value, ObjectId):
+            try:
+                value = ObjectId(value)
+            except (InvalidId, TypeError):
+                return None
+        idmap = identity_map()
+        key = (cls._class_name, field, value)
+        if key in idmap:
+            return idmap[key]
+        ttl = current_app.config.get("DOCUMENT_CACHE_TTL", 0) if current_app else 0
+        cache_key = key + collection_version(cls._get_collection_name())
+        son = document_cache.get(cache_key) if ttl else None
+        if son is None:
+            son = cls.objects(**{field: value}).as_pymongo().first() or {}  # Empty means not found
+            if ttl:
+                document_cache.set(cache_key, son, ttl)
+        # Each request gets its own instance, so changes to it don't leak into the cache
+        doc = cls._from_son(copy.deepcopy(son)) if son else None
+        idmap[key] = doc
+        if doc:
+            idmap[(cls._class_name, "id", doc.id)] = doc
+            idmap[(cls._class_name, "slug", doc.slug)] = doc
+        return doc
+
+    @classmethod
+    def cached_or_404(cls, id=None, slug=None):
+        doc = cls.cached(id=id, slug=slug)
+        if doc is None:
+            abort(404)
+        return doc
+
+
+def slugs_to_ids(document_type, slugs):
+    """Resolves slugs to ids of document_type with one query for all slugs not already cached in the process.
+    Returns a dict from slug to id, without slugs that couldn't be found."""
+    ttl = current_app.config.get("DOCUMENT_CACHE_TTL", 0) if current_app else 0
+    version = collection_version(document_type._get_collection_name())
+    rv, missing = {}, set()
+    for slug in slugs:
+        pk = slug_cache.get((document_type._class_name, slug) + version) if ttl else None
+        if pk is None:
+            missing.add(slug)
+        elif pk:  # False means we know it doesn't exist
+            rv[slug] = pk
+    if missing:
+        try:
+            found = {d["slug"]: d["_id"] for d in document_type.objects(slug__in=list(missing)).only("slug").as_pymongo()}
+        except InvalidQueryError:
+            found = {}  # document_type has no slug
+        for slug in missing:
+            if ttl:
+                slug_cache.set((document_type._class_name, slug) + version, found.get(slug, False), ttl)
+        rv.update(found)
+    return rv
+
+
+class IdentityMappedReferenceField(ReferenceField):
+    """A ReferenceField that dereferences through CachedDocumentMixin.cached(), if the referenced
+    document supports it, so that it's the same instance as other lookups in the request"""
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance._data.get(self.name)
+        if (
+            isinstance(value, DBRef)
+            and getattr(instance._fields[self.name], "_auto_dereference", True)
+            and issubclass(self.document_type, CachedDocumentMixin)
+        ):
+            doc = self.document_type.cached(id=value.id)
+            if doc is not None:
+                instance._data[self.name] = doc
+        return super(IdentityMappedReferenceField, self).__get__(instance, owner)
+
+
+class SortKeyField(StringField):
+    """A denormalized copy of a field of a referenced document, e.g. SortKeyField("creator.realname"), so that lists
+    can be sorted by it using an index instead of a $lookup. ListResponse sorts by it when asked to sort by its source.
+    Needs register_sort_keys() on the document class to be kept current, and backfill_sort_keys() for existing data."""
+
+    def __init__(self, source, **kwargs):
+        self.source = source
+        self.reference, self.path = source.split(".", 1)
+        super(SortKeyField, self).__init__(**kwargs)
+
+    def value_from(self, ref_doc):
+        """Returns the sort key from the referenced document, or None if it's missing or not dereferenced"""
+        value = ref_doc if isinstance(ref_doc, BaseDocument) else None
+        for part in self.path.split("."):
+            if value is None:
+                break
+            value = value.get(part) if isinstance(value, dict) else getattr(value, part, None)
+        return str(value) if value is not None else None
+
+
+def sort_key_fields(document_class):
+    """Returns the SortKeyFields of document_class by their source path"""
+    return {f.source: f for f in document_class._fields.values() if isinstance(f, SortKeyField)}
+
+
+def _update_own_sort_keys(sender, document, **kwargs):
+    changed = set(document._get_changed_fields())
+    for field in sort_key_fields(sender).values():
+        # Avoid dereferencing on every save, only when the reference changed or the key is missing
+        if document._created or field.reference in changed or document._data.get(field.name) is None:
+            setattr(document, field.name, field.value_from(getattr(document, field.reference)))
+
+
+def _update_referring_sort_keys(document_class, field, sender, document, created=False, **kwargs):
+    ref_type = document_class._fields[field.reference].document_type
+    if created or not isinstance(document, ref_type):
+        return
+    root = ref_type._fields[field.path.split(".", 1)[0]].db_field
+    if any(c.split(".", 1)[0] == root for c in document._get_changed_fields()):
+        value = field.value_from(document)
+        document_class.objects(**{field.reference: document, f"{field.name}__ne": value}).update(
+            **{f"set__{field.name}": value}
+        )
+
+
+def register_sort_keys(document_class):
+    """Keeps the SortKeyFields of document_class current when it is saved, and when a referenced document is
+    saved with changes to the source field. Writes that bypass signals need backfill_sort_keys()."""
+    signals.pre_save.connect(_update_own_sort_keys, sender=document_class)
+    for field in sort_key_fields(document_class).values():
+        # Connect to all senders, as the referenced document class may not be defined yet
+        signals.post_save.connect(partial(_update_referring_sort_keys, document_class, field), weak=False)
+
+
+def backfill_sort_keys(document_class):
+    """Sets all SortKeyFields of document_class from their referenced documents, with one update per referenced
+    document. Returns the number of updated documents."""
+    updated = 0
+    for field in sort_key_fields(document_class).values():
+        for ref_doc in document_class.objects(**{f"{field.reference}__ne": None}).distinct(field.reference):
+            updated += document_class.objects(**{field.reference: ref_doc}).update(
+                **{f"set__{field.name}": field.value_from(ref_doc)}
+            )
+    return updated
+
+
+re_prefetch_path = re.compile(r"^(\w+)(?:\[(\d+)\])?$")
+
+
+def prefetch_references(documents, paths):
+    """Dereferences the reference fields named by paths on all documents, with one $in query per referenced
+    document type instead of one query per reference. A path is a field name, where list fields can have an index
+    to only fetch that item, e.g. ["creator", "images[0]"]. Other items of such a list are left as DBRefs, so only
+    use an index if nothing else reads the list. Fetched documents are shared through the request identity map."""
+    documents = [d for d in documents if d is not None]
+    targets = []  # (document, field name, list index or None, referenced document type, DBRef)
+    for path in paths:
+        match = re_prefetch_path.match(path)
+        if not match:
+            raise ValueError(f"Can't prefetch '{path}', expected a field name with an optional [index]")
+        name, index = match.group(1), match.group(2)
+        for doc in documents:
+            field, value = doc._fields.get(name), doc._data.get(name)
+            if isinstance(field, ListField) and isinstance(field.field, ReferenceField):
+                values = value or []
+                positions = range(len(values)) if index is None else [int(index)] if int(index) < len(values) else []
+                targets += [(doc, name, i, field.field.document_type, values[i]) for i in positions]
+            elif isinstance(field, ReferenceField):
+                targets.append((doc, name, None, field.document_type, value))
+            else:
+                raise ValueError(f"Can't prefetch '{path}', it's not a reference field of {doc._class_name}")
+    targets = [t for t in targets if isinstance(t[4], DBRef)]  # Others are empty or already dereferenced
+
+    idmap = identity_map()
+    missing = defaultdict(set)
+    for _, _, _, document_type, ref in targets:
+        if (document_type._class_name, "id", ref.id) not in idmap:
+            missing[document_type].add(ref.id)
+    for document_type, ids in missing.items():
+        for pk, ref_doc in document_type.objects.in_bulk(list(ids)).items():
+            idmap[(document_type._class_name, "id", pk)] = ref_doc
+
+    replaced_lists = set()
+    for doc, name, index, document_type, ref in targets:
+        ref_doc = idmap.get((document_type._class_name, "id", ref.id))
+        if ref_doc is None:
+            continue  # Broken reference, leave it for normal dereferencing to deal with
+        if index is None:
+            doc._data[name] = ref_doc
+        else:
+            if (id(doc), name) not in replaced_lists:
+                # A new list doesn't mark the document as changed, and flagging it keeps MongoEngine from
+                # dereferencing it again on access
+                replaced_lists.add((id(doc), name))
+                doc._data[name] = BaseList(list(doc._data[name]), doc, name)
+                doc._data[name]._dereferenced = True
+            list.__setitem__(doc._data[name], index, ref_doc)
+    return documents
+
+
 class RegexQueriableStringField(StringField):
     def prepare_query_value(self, op, value):
 
@@ -325,7 +535,19 @@ def list_to_choices(list):
     return [(s.lower(), _(s)) for s in list]
 
 
-FilterOption = namedtuple("FilterOption", "kwargs label")
+# Count is number of results matching the option, if known
+FilterOption = namedtuple("FilterOption", "kwargs label count", defaults=[None])
+
+# Filter option functions may have a facet(field) function returning the stages of a $facet aggregation
+# pipeline that finds options with counts, and a from_facet(field, rows) function creating options from the
+# result. This lets a list compute all it's options in one aggregation, instead of one query per field.
+
+
+def count_facet(group_field, unwind=False):
+    stages = [{"$group": {"_id": f"${group_field}", "count": {"$sum": 1}}}, {"$sort": {"_id": 1}}]
+    if unwind:  # Unwinding a non-list value keeps it as is
+        stages.insert(0, {"$unwind": f"${group_field}"})
+    return stages
 
 
 def numerical_options(field_name, spans=None, labels=None):
@@ -361,6 +583,33 @@ def numerical_options(field_name, spans=None, labels=None):
     def return_function(*args):
         return rv
 
+    def facet(field):
+        # $bucket ranges include their lower boundary, but options include their upper span value, so we
+        # bucket negated values instead. Values higher than all spans go into the default bucket.
+        return [
+            {"$match": {field.db_field: {"$type": "number"}}},
+            {
+                "$bucket": {
+                    "groupBy": {"$multiply": [-1, f"${field.db_field}"]},
+                    "boundaries": sorted(-span for span in spans) + [float("inf")],
+                    "default": "more",
+                    "output": {"count": {"$sum": 1}},
+                }
+            },
+        ]
+
+    def from_facet(field, rows):
+        counts = {row["_id"]: row["count"] for row in rows}
+        more = counts.pop("more", 0)
+        # Options are "less than" so include all buckets below the span
+        options = [
+            opt._replace(count=sum(c for lower, c in counts.items() if lower >= -span)) for opt, span in zip(rv, spans)
+        ]
+        options.append(rv[-1]._replace(count=more))
+        return options
+
+    return_function.facet = facet
+    return_function.from_facet = from_facet
     return return_function
 
 
@@ -382,6 +631,39 @@ def reference_options(field_name, model, id_attr="slug", name_attr="title", extr
             logger.warning(f"Errors in reference option for field_name='{field_name}' and model='{model}'", exc_info=e)
         return rv
 
+    def facet(field):
+        ref_field = getattr(field, "field", field)  # Unwrap ListFields
+        if not isinstance(ref_field, ReferenceField) or ref_field.dbref:
+            return None
+        return count_facet(field.db_field, unwind=True) + [
+            {
+                "$lookup": {
+                    "from": ref_field.document_type._get_collection_name(),
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "doc",
+                }
+            },
+            {"$unwind": "$doc"},
+        ]
+
+    def from_facet(field, rows):
+        document_type = getattr(field, "field", field).document_type
+        rv = []
+        for row in rows:
+            o = document_type._from_son(row["doc"])
+            rv.append(
+                FilterOption(
+                    kwargs={field_name: getattr(o, id_attr, str(o))},
+                    label=getattr(o, name_attr, str(o)),
+                    count=row["count"],
+                )
+            )
+        return rv + extra_options
+
+    return_function.query_dependent = True
+    return_function.facet = facet
+    return_function.from_facet = from_facet
     return return_function
 
 
@@ -391,6 +673,15 @@ def choice_options(field_name, choices):
     def return_function(*args):
         return rv
 
+    def facet(field):
+        return count_facet(field.db_field)
+
+    def from_facet(field, rows):
+        counts = {row["_id"]: row["count"] for row in rows}
+        return [opt._replace(count=counts.get(opt.kwargs[field_name], 0)) for opt in rv]
+
+    return_function.facet = facet
+    return_function.from_facet = from_facet
     return return_function
 
 
@@ -477,6 +768,19 @@ def distinct_options(field_name, model):
             logger.warning(f"Errors in reference option for field_name='{field_name}' and model='{model}'", e)
         return rv
 
+    def facet(field):
+        return count_facet(field.db_field, unwind=True)
+
+    def from_facet(field, rows):
+        return [
+            FilterOption(kwargs={field_name: row["_id"]}, label=row["_id"], count=row["count"])
+            for row in rows
+            if row["_id"] is not None
+        ]
+
+    return_function.query_dependent = True
+    return_function.facet = facet
+    return_function.from_facet = from_facet
     return return_function
 
 
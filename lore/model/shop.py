@@ -2,7 +2,8 @@ import re
 from datetime import date, datetime, timedelta
 from typing import Sequence
 
-from flask import g, request
+from bson import DBRef
+from flask import current_app, g, request
 from flask_babel import get_locale, gettext
 from flask_babel import lazy_gettext as _
 from html2text import html2text
@@ -19,13 +20,17 @@ from mongoengine import (
     IntField,
     ListField,
     MapField,
+    ObjectIdField,
     ReferenceField,
     StringField,
     URLField,
+    signals,
 )
 from mongoengine.errors import DoesNotExist, ValidationError
 from mongoengine.fields import DictField
+from pymongo import UpdateOne
 
+from lore.cache import entitlement_cache
 from lore.model.asset import get_google_urls, guess_content_type
 from lore.model.misc import default_translated_nones, default_translated_strings
 from lore.model.user import Event
@@ -35,6 +40,7 @@ from .asset import FileAccessType, FileAsset
 from .misc import Document  # Enhanced document
 from .misc import (
     Address,
+    IdentityMappedReferenceField,
     Choices,
     choice_options,
     datetime_delta_options,
@@ -47,7 +53,9 @@ from .misc import (
     pick_i18n,
     reference_options,
     set_if,
+    register_sort_keys,
     slugify,
+    SortKeyField,
 )
 from .user import User, user_from_email
 from .world import Publisher, World
@@ -93,16 +101,17 @@ class Price(EmbeddedDocument):
 
 class Product(Document):
     # Allows us to have a deprecated title field in DB that is not reflected here without errors
-    meta = {"strict": False, "indexes": ["product_number"]}
+    meta = {"strict": False, "indexes": ["product_number", "sort_world_title_sv", "-updated"]}
 
     slug = StringField(unique=True, max_length=62)  # URL-friendly name  # needs i18n
     product_number = StringField(max_length=10, sparse=True, unique=True, verbose_name=_("Product Number"))
     project_code = StringField(max_length=10, sparse=True, verbose_name=_("Project Code"))
     title_i18n = MapField(field=StringField(max_length=99), verbose_name=_("Title"))
     description_i18n = MapField(field=StringField(), verbose_name=_("Description"))
-    publisher = ReferenceField(Publisher, reverse_delete_rule=DENY, required=True, verbose_name=_("Publisher"))
+    publisher = IdentityMappedReferenceField(Publisher, reverse_delete_rule=DENY, required=True, verbose_name=_("Publisher"))
     publish_date = StringField(max_length=20, verbose_name=_("Publishing Date"))
-    world = ReferenceField(World, reverse_delete_rule=DENY, verbose_name=_("World"))
+    world = IdentityMappedReferenceField(World, reverse_delete_rule=DENY, verbose_name=_("World"))
+    sort_world_title_sv = SortKeyField("world.title_i18n.sv")  # Denormalized copy to sort by
     family = StringField(max_length=60, verbose_name=_("Product Family"))
     created = DateTimeField(default=datetime.utcnow, verbose_name=_("Created"))
     updated = DateTimeField(default=datetime.utcnow, verbose_name=_("Updated"))
@@ -193,7 +202,7 @@ class Product(Document):
         super(Product, self).delete()
 
     def is_owned_by_current_user(self):
-        return g.user and self in products_owned_by_user(g.user)
+        return bool(g.user) and user_owns_product(g.user, self)
 
     def __str__(self):
         """A string representation suitable for display to end users. Call with !s after variable in f-strings."""
@@ -208,6 +217,7 @@ Product.world.filter_options = reference_options("world", Product, id_attr="pk")
 Product.type.filter_options = choice_options("type", Product.type.choices)
 Product.price.filter_options = numerical_options("price", [0, 50, 100, 200])
 Product.created.filter_options = datetime_delta_options("created", from7to365)
+register_sort_keys(Product)
 
 
 class OrderLine(EmbeddedDocument):
@@ -252,7 +262,7 @@ class Stock(Document):
     with one command and one lock.
     """
 
-    publisher = ReferenceField(Publisher, reverse_delete_rule=DENY, unique=True, verbose_name=_("Publisher"))
+    publisher = IdentityMappedReferenceField(Publisher, reverse_delete_rule=DENY, unique=True, verbose_name=_("Publisher"))
     updated = DateTimeField(default=datetime.utcnow, verbose_name=_("Updated"))
     stock_count = MapField(field=IntField(min_value=-1, default=0))
 
@@ -282,13 +292,14 @@ class Order(Document):
                 "unique": True,
                 "partialFilterExpression": {"external_key": {"$type": "string"}},
             },
+            "-updated",
         ],
     }
 
     title = StringField(max_length=60, verbose_name=_("Title"))  # needs i18n
     external_key = StringField(null=True, verbose_name=_("External Key"))
     user = ReferenceField(User, reverse_delete_rule=DENY, verbose_name=_("User"))
-    publisher = ReferenceField(Publisher, reverse_delete_rule=DENY, verbose_name=_("Publisher"))
+    publisher = IdentityMappedReferenceField(Publisher, reverse_delete_rule=DENY, verbose_name=_("Publisher"))
     session = StringField(verbose_name=_("Session ID"))
     email = EmailField(max_length=60, verbose_name=_("Email"))
     order_lines = ListField(EmbeddedDocumentField(OrderLine))
@@ -430,23 +441,153 @@ Order.updated.filter_options = datetime_delta_options(
 )
 
 
+owning_statuses = [OrderStatus.paid, OrderStatus.shipped]
+
+
+class Entitlement(Document):
+    """The products a user owns through paid or shipped orders, and the files those products give access to,
+    denormalized so that an access check is one lookup by user id. Kept current by signals when orders and products
+    are saved. Writes that bypass signals need update_entitlements() or rebuild_entitlements(). Users without an
+    entitlement, e.g. with orders from before entitlements existed, get one from their orders when first checked."""
+
+    user = ObjectIdField(primary_key=True)
+    products = ListField(ObjectIdField())
+    assets = ListField(ObjectIdField())
+    updated = DateTimeField(default=datetime.utcnow)
+
+
+def _ref_id(value):
+    """Returns the id of a reference, whether a document, DBRef or id, without dereferencing it"""
+    if isinstance(value, DBRef):
+        return value.id
+    return getattr(value, "pk", value)
+
+
+def _downloads_of(product_ids):
+    """Returns the ids of the downloads of each product, as a dict, with one query"""
+    products = Product.objects(id__in=list(product_ids)).only("downloads").as_pymongo()
+    return {p["_id"]: [_ref_id(d) for d in p.get("downloads", [])] for p in products}
+
+
+def _write_entitlements(products_by_user):
+    """Upserts the entitlements of the users in a dict of user id to product ids, in one bulk write"""
+    downloads = _downloads_of(set(pid for pids in products_by_user.values() for pid in pids))
+    ops = []
+    for user_id, product_ids in products_by_user.items():
+        assets = set(aid for pid in product_ids for aid in downloads.get(pid, []))
+        ops.append(
+            UpdateOne(
+                {"_id": user_id},
+                {"$set": {"products": sorted(product_ids), "assets": sorted(assets), "updated": datetime.utcnow()}},
+                upsert=True,
+            )
+        )
+    if ops:
+        Entitlement._get_collection().bulk_write(ops, ordered=False)
+    for user_id in products_by_user:
+        entitlement_cache.delete(user_id)
+    return len(ops)
+
+
+def update_entitlements(*user_ids):
+    """Recomputes the entitlements of users from their orders"""
+    products_by_user = {uid: set() for uid in user_ids if uid}
+    orders = Order.objects(user__in=list(products_by_user.keys()), status__in=owning_statuses)
+    for order in orders.only("user", "order_lines.product").as_pymongo():
+        for ol in order.get("order_lines", []):
+            if ol.get("product"):
+                products_by_user[order["user"]].add(_ref_id(ol["product"]))
+    return _write_entitlements(products_by_user)
+
+
+def rebuild_entitlements():
+    """Recomputes the entitlements of all users from all orders, e.g. after changes that bypassed signals.
+    Returns the number of users with entitlements."""
+    products_by_user = {}
+    orders = Order.objects(user__ne=None, status__in=owning_statuses)
+    for order in orders.only("user", "order_lines.product").as_pymongo():
+        products = products_by_user.setdefault(_ref_id(order["user"]), set())
+        products.update(_ref_id(ol["product"]) for ol in order.get("order_lines", []) if ol.get("product"))
+    Entitlement.objects(user__nin=list(products_by_user.keys())).delete()
+    entitlement_cache.clear()
+    return _write_entitlements(products_by_user)
+
+
+def _on_order_saving(sender, document, **kwargs):
+    # Remember who owned the order before, as they lose what it entitled them to if it's given to another user
+    document._previous_user = None
+    if document.pk and "user" in document._get_changed_fields():
+        previous = Order.objects(id=document.pk).only("user").as_pymongo().first()
+        document._previous_user = previous.get("user") if previous else None
+
+
+def _on_order_saved(sender, document, created=False, **kwargs):
+    changed = set(c.split(".", 1)[0] for c in document._get_changed_fields())
+    previous_user, document._previous_user = getattr(document, "_previous_user", None), None
+    # Either moved into or out of the owning statuses, or changed what or who owns
+    if "status" in changed or (document.status in owning_statuses and (created or changed & {"order_lines", "user"})):
+        update_entitlements(_ref_id(document._data.get("user")), _ref_id(previous_user))
+
+
+def _on_order_deleted(sender, document, **kwargs):
+    if document.status in owning_statuses:
+        update_entitlements(_ref_id(document._data.get("user")))
+
+
+def _on_product_saved(sender, document, created=False, **kwargs):
+    if not created and any(c.split(".", 1)[0] == "downloads" for c in document._get_changed_fields()):
+        entitlements = Entitlement.objects(products=document.id).only("user").as_pymongo()
+        update_entitlements(*[e["_id"] for e in entitlements])
+
+
+signals.pre_save.connect(_on_order_saving, sender=Order)
+signals.post_save.connect(_on_order_saved, sender=Order)
+signals.post_delete.connect(_on_order_deleted, sender=Order)
+signals.post_save.connect(_on_product_saved, sender=Product)
+
+
+def get_entitlement(user, fresh=False):
+    """Returns the (product ids, asset ids) that a user owns, as frozensets. Re-uses recent lookups for the same
+    user unless fresh, for ENTITLEMENT_CACHE_TTL seconds or until this process writes the user's entitlements."""
+    if not user:
+        return frozenset(), frozenset()
+    user_id = _ref_id(user)
+
+    def lookup():
+        e = Entitlement.objects(user=user_id).as_pymongo().first()
+        if e is None:
+            # Not materialized yet, so fall back to the orders, and materialize it from them for the next check
+            update_entitlements(user_id)
+            e = Entitlement.objects(user=user_id).as_pymongo().first() or {}
+        return frozenset(e.get("products", [])), frozenset(e.get("assets", []))
+
+    ttl = current_app.config.get("ENTITLEMENT_CACHE_TTL", 0) if current_app else 0
+    if not ttl:
+        return lookup()
+    if fresh:
+        return entitlement_cache.set(user_id, lookup(), ttl)
+    return entitlement_cache.get_or_set(user_id, lookup, ttl)
+
+
+def _is_entitled(user, index, id):
+    if id in get_entitlement(user)[index]:
+        return True
+    # A miss may be due to a purchase in another process after the lookup was cached, so check again before denying
+    ttl = current_app.config.get("ENTITLEMENT_CACHE_TTL", 0) if current_app else 0
+    return bool(ttl) and id in get_entitlement(user, fresh=True)[index]
+
+
 def products_owned_by_user(user):
-    products = set()
-    if user:
-        orders = Order.objects(user=user, status__in=[OrderStatus.paid, OrderStatus.shipped]).only("order_lines")
-        for order in orders:
-            for order_line in order.order_lines:
-                if order_line.product:
-                    products.add(order_line.product)
-    return products
+    product_ids = get_entitlement(user)[0]
+    return set(Product.objects(id__in=list(product_ids))) if product_ids else set()
+
+
+def user_owns_product(user, product):
+    return _is_entitled(user, 0, product.id)
 
 
 def user_has_asset(user, asset):
-    products = products_owned_by_user(user)
-    for p in products:
-        if p.downloads and asset in p.downloads:
-            return True
-    return False
+    return _is_entitled(user, 1, asset.id)
 
 
 def parse_price(p_string):
@@ -0,0 +1,146 @@
+"""
+    lore.model.task
+    ~~~~~~~~~~~~~~~~
+
+    A small persistent task queue, stored in MongoDB, for work that shouldn't
+    block a request or an import, such as fetching metadata of remote files.
+
+    Functions are registered with @task and queued with enqueue(). A worker,
+    started with `flask run-tasks`, claims queued tasks one at a time with an
+    atomic update, so several workers can share the queue. Failed tasks are
+    retried with exponential backoff until max_attempts, and tasks claimed by
+    a worker that died are claimed again when their lease runs out.
+
+    :copyright: (c) 2014 by Helmgast AB
+"""
+import logging
+import random
+import traceback
+from datetime import datetime, timedelta
+from time import sleep
+
+from flask import current_app
+from mongoengine import DateTimeField, DictField, IntField, StringField
+from mongoengine.queryset import Q
+
+from .misc import Choices, Document
+
+logger = current_app.logger if current_app else logging.getLogger(__name__)
+
+TaskStatus = Choices(queued="Queued", running="Running", done="Done", failed="Failed")
+
+task_functions = {}
+
+backoff_base = 30  # Seconds to wait before the first retry, doubled for each attempt
+backoff_max = 6 * 3600
+lease_time = 600  # Seconds until a running task is considered abandoned by its worker
+
+
+class PermanentError(Exception):
+    """Raised by a task that will fail the same way if retried"""
+
+    pass
+
+
+class Task(Document):
+    meta = {"indexes": [("status", "run_at"), ("name", "key")]}
+
+    name = StringField(required=True)
+    key = StringField()  # Identifies what the task is for, to avoid queueing it twice
+    kwargs = DictField()
+    status = StringField(choices=TaskStatus.to_tuples(), default=TaskStatus.queued)
+    attempts = IntField(default=0)
+    max_attempts = IntField(default=5)
+    run_at = DateTimeField(default=datetime.utcnow)
+    locked_until = DateTimeField()
+    worker = StringField()
+    error = StringField()
+    created = DateTimeField(default=datetime.utcnow)
+    finished = DateTimeField()
+
+    def __repr__(self):
+        return f"{self.__class__}('{self.pk!r}', '{self.name}', '{self.key}', '{self.status}', {self.attempts})"
+
+
+def task(func):
+    """Registers a function so that it can be queued by its name"""
+    task_functions[func.__name__] = func
+    return func
+
+
+def enqueue(name, key=None, delay=0, max_attempts=5, **kwargs):
+    """Queues a registered task to run with kwargs, which need to be storable in MongoDB. If key is given and a
+    task with the same name and key is already waiting, that task is returned instead of queueing another."""
+    if name not in task_functions:
+        raise ValueError(f"No task function registered as {name}")
+    if key:
+        waiting = Task.objects(name=name, key=key, status=TaskStatus.queued).first()
+        if waiting:
+            return waiting
+    return Task(
+        name=name,
+        key=key,
+        kwargs=kwargs,
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    ).save()
+
+
+def backoff(attempts):
+    """Returns seconds to wait before the next attempt, with some jitter so that failed tasks don't retry at once"""
+    delay = min(backoff_base * 2 ** (attempts - 1), backoff_max)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim_task(worker):
+    """Atomically marks the next due task as running by worker and returns it, or None if none is due"""
+    now = datetime.utcnow()
+    due = Q(status=TaskStatus.queued, run_at__lte=now) | Q(status=TaskStatus.running, locked_until__lt=now)
+    return (
+        Task.objects(due)
+        .order_by("run_at")
+        .modify(
+            new=True,
+            set__status=TaskStatus.running,
+            set__worker=worker,
+            set__locked_until=now + timedelta(seconds=lease_time),
+            inc__attempts=1,
+        )
+    )
+
+
+def run_task(t):
+    """Runs a claimed task and records the outcome, queueing it again with backoff if it failed"""
+    func = task_functions.get(t.name)
+    try:
+        if not func:
+            raise PermanentError(f"No task function registered as {t.name}")
+        func(**t.kwargs)
+    except Exception as e:
+        t.error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        if isinstance(e, PermanentError) or t.attempts >= t.max_attempts:
+            logger.warning(f"Task {t!r} failed: {t.error}")
+            t.status, t.finished = TaskStatus.failed, datetime.utcnow()
+        else:
+            wait = backoff(t.attempts)
+            logger.info(f"Task {t!r} failed, retrying in {wait:.0f}s: {t.error}")
+            t.status, t.run_at = TaskStatus.queued, datetime.utcnow() + timedelta(seconds=wait)
+    else:
+        t.status, t.finished, t.error = TaskStatus.done, datetime.utcnow(), None
+    t.locked_until = None
+    t.save()
+    return t.status == TaskStatus.done
+
+
+def work(worker="worker", burst=False, poll_interval=2.0):
+    """Runs due tasks until stopped, or if burst, until none is due. Returns the number of tasks run."""
+    count = 0
+    while True:
+        t = claim_task(worker)
+        if t:
+            run_task(t)
+            count += 1
+        elif burst:
+            return count
+        else:
+            sleep(poll_interval)
@@ -21,6 +21,7 @@ from mongoengine import (
 from mongoengine.base import LazyReference
 from mongoengine.queryset.queryset import QuerySet
 
+from lore.extensions import persist_markdown
 from lore.model.misc import (
     RegexQueriableStringField,
     datetime_delta_options,
@@ -145,7 +146,7 @@ unset = "UNSET"
 
 class Topic(Document):
     meta = {
-        "indexes": ["kind", "names.name", {"fields": ["$names.name", "$occurrences.content"]}],
+        "indexes": ["kind", "names.name", {"fields": ["$names.name", "$occurrences.content"]}, "-updated_at"],
         # 'auto_create_index': True
     }
 
@@ -160,6 +161,7 @@ class Topic(Document):
 
     def clean(self):
         self.updated_at = datetime.utcnow()
+        persist_markdown(*(o.content for o in self.occurrences))
 
     @property  # For convenience
     def name(self):
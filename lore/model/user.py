@@ -47,11 +47,14 @@ from mongoengine import (
     DENY,
     CASCADE,
     Q,
+    signals,
 )
+from pymongo import UpdateOne
 
 import logging
 from flask import current_app
 from mongoengine.fields import MapField
+from lore.model.fingerprint import fingerprint_from_user
 from lore.model.misc import get
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
@@ -95,6 +98,7 @@ class User(Document, BaseUser):
     meta = {
         "indexes": [
             "email",
+            "fingerprint",
             # 'identities.profileData.email', # Cannot index a dynamic field
             # {"fields": ["username",], # Does unique but not for null fields
             #     "unique": True,
@@ -156,11 +160,15 @@ class User(Document, BaseUser):
     auth_keys = ListField(StringField(max_length=100, unique=True), verbose_name=_("Authentication sources"))
     facebook_auth = EmbeddedDocumentField(ExternalAuth)
     event_log = ListField(EmbeddedDocumentField(UserEvent))
+    # The hash written into PDFs downloaded by the user, to find the user from a leaked PDF
+    fingerprint = StringField(max_length=12)
 
     def merge_in_user(self, remove_user):
-        from lore.model.shop import Order  # Do here to avoid circular import
+        from lore.model.shop import Order, update_entitlements  # Do here to avoid circular import
 
         changed_orders = Order.objects(user=remove_user).update(multi=True, user=self)
+        if changed_orders:
+            update_entitlements(self.id, remove_user.id)
         changed_events = Event.objects(user=remove_user).update(multi=True, user=self)
         # TODO also move FileAssets and Articles
         if remove_user.description and not self.description:
@@ -431,6 +439,36 @@ Group.created.filter_options = datetime_delta_options("created", from7to365)
 Group.updated.filter_options = datetime_delta_options("updated", from7to365)
 
 
+def _set_fingerprint(sender, document, **kwargs):
+    # The fingerprint is derived from the id, so new users only get one after their first save
+    if not document.fingerprint and document.id:
+        document.fingerprint = fingerprint_from_user(document.id).decode()
+        User.objects(id=document.id).update_one(set__fingerprint=document.fingerprint)
+
+
+signals.post_save.connect(_set_fingerprint, sender=User)
+
+
+def index_user_fingerprints(batch_size=1000):
+    """Sets the fingerprint of users saved before it was stored. Returns the number of users updated."""
+    collection = User._get_collection()
+    ops = []
+    updated = 0
+    for user in User.objects(fingerprint=None).only("id").no_cache():
+        ops.append(UpdateOne({"_id": user.id}, {"$set": {"fingerprint": fingerprint_from_user(user.id).decode()}}))
+        if len(ops) >= batch_size:
+            updated += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += collection.bulk_write(ops, ordered=False).modified_count
+    return updated
+
+
+def users_by_fingerprint(fingerprints):
+    """Returns a dict of fingerprint to user, for those of the given fingerprints that belong to a user"""
+    return {u.fingerprint: u for u in User.objects(fingerprint__in=list(fingerprints))}
+
+
 def user_from_email(*emails, realname="", create=False, commit=False):
     """Creates or finds a user from one or more emails, such as when importing or inviting users.
     It will try each email in turn until it finds an existing user.
@@ -37,6 +37,8 @@ from .asset import Attachment, FileAsset
 from .misc import (
     EMPTY_ID,
     Address,
+    CachedDocumentMixin,
+    IdentityMappedReferenceField,
     Choices,
     Document,  # Enhanced document
     choice_options,
@@ -47,10 +49,12 @@ from .misc import (
     get,
     pick_i18n,
     reference_options,
+    register_sort_keys,
     shorten,
     slugify,
+    SortKeyField,
 )
-from lore.extensions import configured_langs, default_locale
+from lore.extensions import configured_langs, default_locale, persist_markdown
 from .user import User, user_from_email
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
@@ -86,7 +90,7 @@ def secure_css(css):
     return css
 
 
-class Publisher(Document):
+class Publisher(CachedDocumentMixin, Document):
     meta = {"strict": False}
 
     slug = StringField(unique=True, max_length=62, verbose_name=_("Publisher Domain"))  # URL-friendly name
@@ -97,6 +101,7 @@ class Publisher(Document):
 
     description = StringField(max_length=350, verbose_name=_("Description"))
     created_date = DateTimeField(default=datetime.utcnow, verbose_name=_("Created on"))
+    updated = DateTimeField(verbose_name=_("Updated"))
     creator = ReferenceField(User, reverse_delete_rule=NULLIFY, verbose_name=_("Owner"))
     address = EmbeddedDocumentField(Address, verbose_name=_("Registered address"))
     email = EmailField(max_length=60, min_length=6, verbose_name=_("Email"))
@@ -129,6 +134,9 @@ class Publisher(Document):
     def set_tagline(self):
         raise NotImplementedError()
 
+    def clean(self):
+        self.updated = datetime.utcnow()
+
     def worlds(self):
         return World.objects(publisher=self).order_by("-created_date")
 
@@ -156,7 +164,7 @@ def filter_authorized_by_publisher(publisher=None):
         return Q(id=EMPTY_ID)
 
 
-class World(Document):
+class World(CachedDocumentMixin, Document):
     meta = {"strict": False}
     """
     db.getCollection('world').update(
@@ -173,11 +181,12 @@ class World(Document):
     tagline_i18n = MapField(StringField(min_length=0, max_length=100), verbose_name=_("Tagline"))
 
     # TODO set to required
-    publisher = ReferenceField(Publisher, reverse_delete_rule=DENY, verbose_name=_("Publisher"))
+    publisher = IdentityMappedReferenceField(Publisher, reverse_delete_rule=DENY, verbose_name=_("Publisher"))
 
     creator = ReferenceField(User, reverse_delete_rule=NULLIFY, verbose_name=_("Creator"))
     rule_system = StringField(max_length=60, verbose_name=_("Rule System"))
     created_date = DateTimeField(default=datetime.utcnow, verbose_name=_("Created on"))
+    updated = DateTimeField(verbose_name=_("Updated"))
     status = StringField(choices=PublishStatus.to_tuples(), default=PublishStatus.published, verbose_name=_("Status"))
     contribution = BooleanField(default=False, verbose_name=_("World accepts contributions"))
     external_host = URLField(verbose_name=_("External host URL"))
@@ -203,6 +212,7 @@ class World(Document):
     custom_css = StringField(verbose_name=_("Custom CSS"))
 
     def clean(self):
+        self.updated = datetime.utcnow()
         for key in self.title_i18n.keys():
             self.title_i18n[key] = self.title_i18n[key].replace("&shy;", "\u00AD")
         # self.title = self.title.replace("&shy;", "\u00AD")  # Replaces soft hyphens with the real unicode
@@ -210,6 +220,7 @@ class World(Document):
         if self.creator and self.creator not in self.editors:
             self.editors.append(self.creator)
         self.custom_css = secure_css(self.custom_css)
+        persist_markdown(*self.content_i18n.values(), escape=True)
 
     def __str__(self):
         return self.title
@@ -450,15 +461,27 @@ class RemoteImage:
 
 class Article(Document):
     meta = {
-        "indexes": ["slug", {"fields": ["$title", "$content", "$tags"]}],
+        "indexes": [
+            "slug",
+            {"fields": ["$title", "$content", "$tags"]},
+            "sort_creator_realname",
+            "sort_world_title_sv",
+            "sort_world_title_en",
+            "-updated",
+        ],
         # 'auto_create_index': True
     }
     slug = StringField(unique=True, required=False, max_length=62)
     type = StringField(choices=ArticleTypes.to_tuples(), default=ArticleTypes.default, verbose_name=_("Type"))
-    world = ReferenceField(World, reverse_delete_rule=DENY, verbose_name=_("World"))
-    publisher = ReferenceField(Publisher, reverse_delete_rule=DENY, verbose_name=_("Publisher"))
+    world = IdentityMappedReferenceField(World, reverse_delete_rule=DENY, verbose_name=_("World"))
+    publisher = IdentityMappedReferenceField(Publisher, reverse_delete_rule=DENY, verbose_name=_("Publisher"))
     creator = ReferenceField(User, verbose_name=_("Creator"))
+    # Denormalized copies to sort by
+    sort_creator_realname = SortKeyField("creator.realname")
+    sort_world_title_sv = SortKeyField("world.title_i18n.sv")
+    sort_world_title_en = SortKeyField("world.title_i18n.en")
     created_date = DateTimeField(default=datetime.utcnow, verbose_name=_("Created"))
+    updated = DateTimeField(verbose_name=_("Updated"))
     title = StringField(min_length=1, max_length=60, required=True, verbose_name=_("Title"))  # TODO i18n
     description = StringField(max_length=350, verbose_name=_("Description"))  # TODO i18n
     content = StringField(verbose_name=_("Content"))  # TODO i18n
@@ -489,8 +512,6 @@ class Article(Document):
     custom_css = StringField(verbose_name=_("Custom CSS"))
     shortcut = ReferenceField("Shortcut", verbose_name=_("Shortcut"))
 
-    # modified_date = DateTimeField()
-
     # Changes type by nulling the old field, if it exists,
     # and creating an empty new one, if it exists.
     def change_type(self, new_type):
@@ -524,10 +545,12 @@ class Article(Document):
 
     # Executes before saving
     def clean(self):
+        self.updated = datetime.utcnow()
         self.title = self.title.replace("&shy;", "\u00AD")  # Replaces soft hyphens with the real unicode
         self.slug = slugify(self.title)
         if self.creator and self.creator not in self.editors:
             self.editors.append(self.creator)
+        persist_markdown(self.content)
 
     def is_published(self):
         return self.status == PublishStatus.published and self.created_date <= datetime.utcnow()
@@ -606,6 +629,7 @@ Shortcut.created_date.filter_options = datetime_delta_options(
     "created_date", [timedelta(days=7), timedelta(days=30), timedelta(days=90), timedelta(days=365)]
 )
 Shortcut.register_delete_rule(Article, "shortcut", NULLIFY)
+register_sort_keys(Article)
 
 
 def import_article(row, commit=False):
@@ -0,0 +1,233 @@
+"""
+    lore.pagecache
+    ~~~~~~~~~~~~~~~~
+
+    Caches whole pages for anonymous visitors, e.g. readers and crawlers, for
+    the endpoints given TTLs in PAGE_CACHE_TTL. Their pages only depend on the
+    host, path and query args (the path includes the language and selects the
+    theme), so these make the cache key, plus any request headers named in
+    PAGE_CACHE_VARY. Responses that vary on other headers are not cached.
+
+    Only HTML responses are stored. As views may render JSON for clients that
+    prefer it, the format the client prefers is also part of the key.
+
+    Requests are not served from the cache, and their responses not stored,
+    if the session has a user, a cart or flashed messages, or if the response
+    changes the session or sets cookies. Pages that include the CSRF token of
+    the visitor are not stored either, so pages that may be stored leave it
+    out, and scripts fetch it from the csrf_token endpoint when they need it.
+
+    Each page is tagged with the articles, worlds, publishers and topics that
+    were loaded to render it. Saving or deleting one of them removes the pages
+    tagged with it, and creating one removes all pages that loaded any
+    document of that kind, e.g. lists that should now show it.
+
+    PAGE_CACHE selects where pages are kept: "memory" for an LRU cache in each
+    process, or "mongo" for a collection shared by all processes, where
+    invalidation reaches all processes at once.
+
+    :copyright: (c) 2014 by Helmgast AB
+"""
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from flask import current_app, g, has_request_context, jsonify, request, session
+from flask_wtf.csrf import generate_csrf
+from mongoengine import signals
+from mongoengine.connection import get_db
+from werkzeug.urls import url_encode
+from werkzeug.wrappers import Response
+
+from lore.cache import LRUCache
+
+logger = current_app.logger if current_app else logging.getLogger(__name__)
+
+# Collections of documents that pages are tagged with
+tagged_collections = frozenset(["article", "world", "publisher", "topic"])
+# Session keys that make a visitor not anonymous
+personal_session_keys = ("uid", "cart_id", "_flashes")
+# Headers that are set per response, or would leak from one visitor to another
+uncached_headers = frozenset(["set-cookie", "content-length", "server-timing", "date"])
+# Formats that views negotiate from the Accept header, of which only HTML is stored
+cached_mimetypes = ["text/html", "application/json"]
+
+
+class MemoryPageStore(object):
+    """Keeps pages in an LRU cache in this process. A page is invalidated when any of its tags has changed version
+    since it was stored. Only tags of stored pages have versions, which are dropped when the last page with the tag
+    leaves the cache, so that they are bounded by the pages the cache holds."""
+
+    def __init__(self, maxsize=512):
+        self.cache = LRUCache(maxsize, on_remove=self._release_tags)
+        self.tag_versions = {}
+        self.tag_pages = {}  # Number of stored pages with each tag
+
+    def get(self, key):
+        page = self.cache.get(key)
+        if page and all(self.tag_versions.get(t, 0) == v for t, v in page["tags"].items()):
+            return page
+        return None
+
+    def set(self, key, page, ttl, tags):
+        with self.cache._lock:  # Same lock as _release_tags() is called with
+            page["tags"] = {t: self.tag_versions.setdefault(t, 0) for t in tags}
+            for t in tags:
+                self.tag_pages[t] = self.tag_pages.get(t, 0) + 1
+            self.cache.set(key, page, ttl)
+
+    def _release_tags(self, key, page):
+        for t in page["tags"]:
+            self.tag_pages[t] -= 1
+            if not self.tag_pages[t]:
+                del self.tag_pages[t]
+                del self.tag_versions[t]
+
+    def invalidate(self, tags):
+        with self.cache._lock:
+            for t in tags:
+                if t in self.tag_versions:
+                    self.tag_versions[t] += 1
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class MongoPageStore(object):
+    """Keeps pages in a MongoDB collection shared by all processes, where invalidation removes them"""
+
+    def __init__(self, collection="page_cache"):
+        self.name = collection
+        self._indexed = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def collection(self):
+        collection = get_db()[self.name]
+        if not self._indexed:
+            collection.create_index("tags")
+            collection.create_index("expires", expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def get(self, key):
+        page = self.collection.find_one({"_id": key, "expires": {"$gt": datetime.utcnow()}})
+        if page:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return page
+
+    def set(self, key, page, ttl, tags):
+        page.update(tags=list(tags), expires=datetime.utcnow() + timedelta(seconds=ttl))
+        self.collection.replace_one({"_id": key}, page, upsert=True)
+
+    def invalidate(self, tags):
+        self.collection.delete_many({"tags": {"$in": list(tags)}})
+
+    def stats(self):
+        return {"size": self.collection.estimated_document_count(), "hits": self.hits, "misses": self.misses}
+
+
+page_stores = {"memory": MemoryPageStore, "mongo": MongoPageStore}
+page_store = None
+
+
+def is_anonymous():
+    return not any(k in session for k in personal_session_keys)
+
+
+def page_key(vary):
+    """Returns the cache key of the current request, from its host, path, sorted query args, preferred format and the
+    headers in vary"""
+    args = url_encode(sorted(request.args.items(multi=True)))
+    accepts = request.accept_mimetypes.best_match(cached_mimetypes)
+    headers = "\n".join(f"{h}: {request.headers.get(h, '')}" for h in vary)
+    return hashlib.sha1(f"{request.host}{request.path}?{args}\n{accepts}\n{headers}".encode("utf-8")).hexdigest()
+
+
+def _tag_loaded_document(sender, document, **kwargs):
+    if not has_request_context():
+        return
+    tags = g.get("page_tags", None)
+    if tags is not None and hasattr(sender, "_get_collection_name"):
+        collection = sender._get_collection_name()
+        if collection in tagged_collections and document.pk is not None:
+            tags.add(collection)
+            tags.add(f"{collection}:{document.pk}")
+
+
+def _invalidate_saved_document(sender, document, created=False, **kwargs):
+    collection = sender._get_collection_name() if hasattr(sender, "_get_collection_name") else None
+    if page_store and collection in tagged_collections:
+        # A new document may belong in any page listing documents of its kind
+        page_store.invalidate([collection] if created else [f"{collection}:{document.pk}"])
+
+
+def _invalidate_deleted_document(sender, document, **kwargs):
+    collection = sender._get_collection_name() if hasattr(sender, "_get_collection_name") else None
+    if page_store and collection in tagged_collections:
+        page_store.invalidate([f"{collection}:{document.pk}"])
+
+
+def init_pagecache(app):
+    """Caches pages of the endpoints in PAGE_CACHE_TTL for anonymous visitors, if PAGE_CACHE is set. Has to be
+    called before the blueprints are registered, so that cached pages are served before users are loaded."""
+    global page_store
+    if not app.config.get("PAGE_CACHE", None):
+        return
+    page_store = page_stores[app.config["PAGE_CACHE"]]()
+    ttls = app.config.get("PAGE_CACHE_TTL", {})
+    vary = [h.lower() for h in app.config.get("PAGE_CACHE_VARY", [])]
+    signals.post_init.connect(_tag_loaded_document)
+    signals.post_save.connect(_invalidate_saved_document)
+    signals.post_delete.connect(_invalidate_deleted_document)
+
+    @app.route("/csrf_token")
+    def csrf_token():
+        """Returns the CSRF token of the visitor, for scripts on pages that may be cached"""
+        rv = jsonify(csrf_token=generate_csrf())
+        rv.cache_control.no_store = True
+        return rv
+
+    @app.before_request
+    def serve_cached_page():
+        ttl = ttls.get(request.endpoint, 0)
+        if not ttl or request.method not in ("GET", "HEAD") or "debug" in request.args or not is_anonymous():
+            return None
+        key = page_key(vary)
+        page = page_store.get(key)
+        if page:
+            rv = Response(page["body"], status=page["status"], headers=page["headers"])
+            rv.headers["X-Page-Cache"] = "hit"
+            return rv.make_conditional(request)  # Pages keep the ETag and Last-Modified they were rendered with
+        g.page_cache_key = key
+        g.page_tags = set()
+
+    @app.after_request
+    def store_cached_page(response):
+        key = g.get("page_cache_key", None)
+        if not key:
+            return response
+        response.headers["X-Page-Cache"] = "miss"
+        if (
+            response.status_code != 200
+            or response.mimetype != "text/html"
+            or response.is_streamed
+            or response.direct_passthrough
+            or "Set-Cookie" in response.headers
+            or session.modified
+            or current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token") in g  # The visitor's CSRF token
+            or not is_anonymous()
+            # Not response.cache_control.private, as that keeps shared HTTP caches from mixing up visitors, while
+            # this cache only ever serves the page to anonymous visitors
+            or response.cache_control.no_store
+            or any(h.lower() not in vary and h.lower() != "cookie" for h in response.vary)
+        ):
+            return response
+        # The Cookie header is not part of the key, as pages for anonymous sessions are the same
+        headers = [(k, v) for k, v in response.headers if k.lower() not in uncached_headers]
+        page = {"status": response.status_code, "headers": headers, "body": response.get_data()}
+        page_store.set(key, page, ttls[request.endpoint], g.page_tags)
+        return response
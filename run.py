@@ -223,6 +223,161 @@ def validate_model():
     return is_ok
 
 
+@app.cli.command()
+def backfill_sort_keys():
+    """Sets all denormalized sort keys from the documents they copy, e.g. after changes that bypassed signals"""
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.model import misc
+    from lore.model.asset import FileAsset
+    from lore.model.shop import Product
+    from lore.model.world import Article
+
+    extensions.db.init_app(app)
+    db = get_db()
+    for model in [Article, Product, FileAsset]:
+        app.logger.info(f"Backfilling sort keys of {model.__name__}")
+        print(f"{model.__name__}: updated {misc.backfill_sort_keys(model)} documents")
+
+
+@app.cli.command()
+@click.option("--preset", "-p", "presets", multiple=True, help="Preset to generate, can be repeated (default all)")
+@click.option("--force", is_flag=True, help="Render again even if already cached")
+def generate_image_derivatives(presets, force):
+    """Renders resized images of all image assets into the asset cache, so that they don't have to be rendered on
+    first request. Generates each preset in the original format and in each format of derivative_formats that
+    Pillow can write."""
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.cache import file_cache
+    from lore.model.asset import FileAsset, derivative_formats, image_derivative, image_presets, resizable_formats
+    from PIL import Image
+
+    extensions.db.init_app(app)
+    db = get_db()
+    if not file_cache.enabled:
+        raise click.ClickException("Set ASSET_CACHE_DIR to keep the generated images in")
+    presets = presets or list(image_presets.keys())
+    unknown = set(presets) - set(image_presets.keys())
+    if unknown:
+        raise click.BadParameter(f"Unknown presets {', '.join(unknown)}", param_hint="preset")
+    Image.init()
+    formats = [fmt for fmt in derivative_formats if fmt[1] in Image.SAVE]
+    assets = FileAsset.objects(content_type__in=list(resizable_formats.keys()), file_data__ne=None)
+    generated, failed = 0, 0
+    for asset in assets.only("slug", "content_type", "file_data"):
+        gridfile = asset.file_data.get()
+        if not gridfile:
+            continue
+        for fmt in [resizable_formats[asset.content_type]] + formats:
+            for preset in presets:
+                key = f"{gridfile.md5}.{preset}.{fmt[2]}"
+                if force:
+                    file_cache.delete(key)
+                elif file_cache.get(key):
+                    continue
+                try:
+                    image_derivative(gridfile, preset, fmt).close()
+                    generated += 1
+                except Exception as e:
+                    app.logger.warning(f"Couldn't render {key} of {asset.slug}: {e}")
+                    failed += 1
+    print(f"Generated {generated} images, {failed} failed")
+
+
+@app.cli.command()
+def rebuild_entitlements():
+    """Recomputes which products and files each user owns from their orders, e.g. after changes that bypassed
+    signals"""
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.model import shop
+
+    extensions.db.init_app(app)
+    db = get_db()
+    print(f"Rebuilt entitlements of {shop.rebuild_entitlements()} users")
+
+
+@app.cli.command()
+@click.option("--burst", is_flag=True, help="Exit when no task is due, instead of waiting for more")
+@click.option("--poll", default=2.0, help="Seconds to wait between checks for due tasks")
+def run_tasks(burst, poll):
+    """Runs queued background tasks, e.g. fetching metadata of remote files"""
+    import socket
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.model import asset  # noqa, registers the task functions
+    from lore.model.task import work
+
+    extensions.db.init_app(app)
+    db = get_db()
+    count = work(worker=f"{socket.gethostname()}:{os.getpid()}", burst=burst, poll_interval=poll)
+    print(f"Ran {count} tasks")
+
+
+@app.cli.command()
+def collapse_file_blobs():
+    """Makes file assets with identical files share one copy in GridFS, and counts the file assets using each file"""
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.model.asset import collapse_blobs
+
+    extensions.db.init_app(app)
+    db = get_db()
+    removed, size = collapse_blobs()
+    print(f"Removed {removed} duplicate files, freeing {size / (1024 * 1024):.1f} MB")
+
+
+@app.cli.command()
+@click.option("--output", default="qrcodes.zip", help="Zip file to write the QR codes to")
+@click.option("--format", "formats", default="svg", type=click.Choice(["svg", "png", "both"]), help="Image format")
+@click.option("--scale", default=5, help="Pixels per QR code module")
+def export_qrcodes(output, formats, scale):
+    """Renders QR codes for all shortcuts into a zip file, e.g. for a print run"""
+    import zipfile
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.api.asset import render_qrcode
+    from lore.model.world import Shortcut
+
+    extensions.db.init_app(app)
+    db = get_db()
+    formats = ["svg", "png"] if formats == "both" else [formats]
+    host = app.config["DEFAULT_HOST"]
+    count = 0
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+        for shortcut in Shortcut.objects().only("slug").order_by("slug"):
+            for fmt in formats:
+                data, etag = render_qrcode(host, shortcut.slug, scale, fmt)
+                zf.writestr(f"{shortcut.slug}.{fmt}", data)
+            count += 1
+    print(f"Wrote QR codes for {count} shortcuts to {output}")
+
+
+@app.cli.command()
+@click.option("--file", type=click.File("r"), help="Markdown file to convert, else a generated article")
+@click.option("--number", default=200, help="Conversions to time")
+def benchmark_markdown(file, number):
+    """Times Markdown conversion with a new converter per call against re-using a converter of the thread, without
+    the render cache"""
+    import timeit
+    import markdown
+
+    if file:
+        text = file.read()
+    else:
+        text = "\n\n".join(f"## Part {i}\n\nSome *Eon* text with a [link](/eon/{i}).\n\n- A\n- List" for i in range(20))
+    renderer = app.md
+    # Same as converting before converters were re-used
+    construct = timeit.timeit(lambda: markdown.Markdown(**renderer.kwargs).convert(text), number=number)
+    construct_only = timeit.timeit(lambda: markdown.Markdown(**renderer.kwargs), number=number)
+    reuse = timeit.timeit(lambda: renderer.render(text), number=number)
+    print(f"{len(text)} characters, {number} conversions")
+    print(f"New converter per call: {construct / number * 1000:.2f} ms per call")
+    print(f"  of which construction: {construct_only / number * 1000:.2f} ms")
+    print(f"Re-used converter:      {reuse / number * 1000:.2f} ms per call")
+
+
 @app.cli.command()
 def import_csv():
     from tools import customer_data
@@ -583,6 +738,8 @@ def file_upload(file, title, desc, access):
 @click.option("--user", help="User ID to fingerprint with", required=True)
 def pdf_fingerprint(input, output, user):
     """Will manually fingerprint a PDF file."""
+    from lore.api.pdf import fingerprint_pdf
+
     print("Fingerprinting user %s from file %s into file %s" % (user, input, output))
     with open(output, "wb") as f:
         with open(input, "rb") as f2:
@@ -591,20 +748,44 @@ def pdf_fingerprint(input, output, user):
 
 
 @app.cli.command()
-@click.option("--input", help="PDF file to check for fingerprints")
-def pdf_check(input):
-    """Will scan a PDF for matching fingerprints"""
-    fps = get_fingerprints(input)
-    from lore.model.user import User
+@click.option("--input", help="PDF file, or directory of PDF files, to check for fingerprints", required=True)
+@click.option("--processes", "-p", type=int, help="Number of files to scan in parallel (default number of CPUs)")
+def pdf_check(input, processes):
+    """Will scan PDFs for fingerprints matching users"""
+    from mongoengine.connection import get_db
+    from lore import extensions
+    from lore.api.pdf import fingerprint_kinds, scan_fingerprints_in
+    from lore.model.user import index_user_fingerprints, users_by_fingerprint
 
-    users = list(User.objects().only("id", "username"))
-    # users.append('ripperdoc@gmail.com')
-    # print users
-    for user in users:
-        uid = fingerprint_from_user(user.id)
-        print("User %s with id %s got fp %s" % (user, user.id, uid))
-        for fp in fps:
-            if uid == fp:
-                print("User %s matches fingerprint %s in document %s" % (user, fp, input))
-                exit(1)
-    print("No match for any user in document %s" % (input))
+    extensions.db.init_app(app)
+    db = get_db()
+    if os.path.isdir(input):
+        paths = sorted(
+            os.path.join(root, name)
+            for root, dirs, files in os.walk(input)
+            for name in files
+            if name.lower().endswith(".pdf")
+        )
+    else:
+        paths = [input]
+    updated = index_user_fingerprints()
+    if updated:
+        print(f"Indexed fingerprints of {updated} users")
+    results = scan_fingerprints_in(paths, processes)
+    users = users_by_fingerprint(set(fp for found in results.values() for fp in found))
+    matched = 0
+    for path, found in results.items():
+        matches = [(users[fp], kinds) for fp, kinds in found.items() if fp in users]
+        if not matches:
+            print(f"{path}: no match")
+            continue
+        matched += 1
+        for user, kinds in sorted(matches, key=lambda m: -len(m[1])):
+            # A fingerprint is written in each place, so a match in all of them is the most certain
+            print(
+                f"{path}: {user} ({user.id}), found as {', '.join(sorted(kinds))}, "
+                f"confidence {len(kinds)}/{len(fingerprint_kinds)}"
+            )
+    print(f"Matched users in {matched} of {len(paths)} files")
+    if matched:
+        exit(1)
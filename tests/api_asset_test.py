@@ -0,0 +1,115 @@
+import gridfs
+import pytest
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+
+def gridfile(mongomock, data):
+    fs = gridfs.GridFS(mongomock.get_database("mongoenginetest"))
+    file_id = fs.put(data, filename="test.pdf", content_type="application/pdf", chunkSize=10)
+    return fs.get(file_id)
+
+
+def response_body(rv):
+    return b"".join(rv.response)
+
+
+def test_send_gridfs_file_ranges(app_client, mongomock):
+    from lore.api.asset import send_gridfs_file
+
+    app = app_client.application
+    data = bytes(range(100))
+
+    with app.test_request_context():
+        rv = send_gridfs_file(gridfile(mongomock, data))
+        assert rv.status_code == 200
+        assert rv.headers["Accept-Ranges"] == "bytes"
+        assert response_body(rv) == data
+
+    with app.test_request_context(headers={"Range": "bytes=25-34"}):
+        rv = send_gridfs_file(gridfile(mongomock, data))
+        assert rv.status_code == 206
+        assert rv.headers["Content-Range"] == "bytes 25-34/100"
+        assert response_body(rv) == data[25:35]
+
+    with app.test_request_context(headers={"Range": "bytes=-5"}):
+        assert response_body(send_gridfs_file(gridfile(mongomock, data))) == data[95:]
+
+    with app.test_request_context(headers={"Range": "bytes=0-1,50-59"}):
+        rv = send_gridfs_file(gridfile(mongomock, data))
+        assert rv.status_code == 206
+        assert rv.mimetype == "multipart/byteranges"
+        body = response_body(rv)
+        assert int(rv.headers["Content-Length"]) == len(body)
+        assert b"Content-Range: bytes 50-59/100\r\n\r\n" + data[50:60] in body
+
+    with app.test_request_context(headers={"Range": "bytes=0-9", "If-Range": '"outdated"'}):
+        rv = send_gridfs_file(gridfile(mongomock, data))
+        assert rv.status_code == 200
+        assert response_body(rv) == data
+
+    with app.test_request_context(headers={"Range": "bytes=200-300"}):
+        with pytest.raises(RequestedRangeNotSatisfiable):
+            send_gridfs_file(gridfile(mongomock, data))
+
+
+def test_qrcode(app_client):
+    from io import BytesIO
+    import pyqrcode
+    from PIL import Image
+    from lore.api.asset import qrcode_quiet_zone
+
+    rv = app_client.get("/asset/qr/abc.svg")
+    assert rv.status_code == 200 and rv.mimetype == "image/svg+xml"
+    assert rv.cache_control.max_age == 31536000
+    etag = rv.headers["ETag"]
+    assert app_client.get("/asset/qr/ABC.svg", headers={"If-None-Match": etag}).status_code == 304
+
+    rv = app_client.get("/asset/qr/abc.png?scale=2")
+    img = Image.open(BytesIO(rv.data))
+    url = "HTTPS://%s/+ABC" % app_client.application.config["DEFAULT_HOST"].upper()
+    size = pyqrcode.create(url, error="L").get_png_size(2, qrcode_quiet_zone)
+    assert rv.mimetype == "image/png" and img.size == (size, size)
+    assert img.getpixel((0, 0)) != img.getpixel((8, 8))  # Quiet zone and the corner of a finder pattern
+
+
+def test_send_gridfs_file_cache(app_client, mongomock, tmp_path, monkeypatch):
+    from lore.api.asset import send_gridfs_file
+    from lore.cache import file_cache
+
+    app = app_client.application
+    app.config.update(ASSET_CACHE_DIR=str(tmp_path), ASSET_CACHE_MAX_BYTES=1000)
+    for attr in ("directory", "max_bytes", "max_file_bytes"):
+        monkeypatch.setattr(file_cache, attr, getattr(file_cache, attr))  # Restored after the test
+    file_cache.init_app(app)
+    data = bytes(range(100))
+    gf = gridfile(mongomock, data)
+
+    with app.test_request_context(headers={"Range": "bytes=25-34"}):
+        assert response_body(send_gridfs_file(gf)) == data[25:35]
+    assert file_cache.get(gf.md5) is None  # Ranges of a miss are only read from GridFS
+
+    with app.test_request_context():
+        rv = send_gridfs_file(gf)
+        assert file_cache.get(gf.md5) is None  # Not until the body is sent
+        assert response_body(rv) == data
+    assert file_cache.get(gf.md5)
+
+    with app.test_request_context(headers={"Range": "bytes=25-34"}):
+        assert response_body(send_gridfs_file(gf)) == data[25:35]
+
+
+def test_image_thumb_fallback(app_client, mongomock):
+    from io import BytesIO
+    from PIL import Image
+    from lore.model.asset import FileAsset
+
+    png = BytesIO()
+    Image.new("RGB", (1000, 500), "red").save(png, "PNG")
+    broken = png.getvalue()[:100]  # Has a valid header but can't be decoded
+    asset = FileAsset(slug="broken.png", title="Broken", content_type="image/png")
+    asset.file_data.put(broken, content_type="image/png")
+    asset.save(validate=False)
+
+    rv = app_client.get("/asset/image/thumbs/broken.png?preset=thumb")
+    assert rv.status_code == 200 and rv.mimetype == "image/png"
+    assert rv.data == broken  # The original, as the thumbnail couldn't be rendered
@@ -0,0 +1,52 @@
+from io import BytesIO
+
+from lore.api.pdf import (
+    find_fingerprint_offsets,
+    fingerprint_from_user,
+    fingerprint_pdf,
+    scan_fingerprints_in,
+    splice_fingerprint,
+)
+
+pdf = (
+    bytes(3000)
+    + b"<xmpMM:DocumentID>xmp.did:E9E3ECA55654E311B947ECCF20247A3D</xmpMM:DocumentID>"
+    + bytes(2000)
+    + b"<</FontFamily(Goudy Old Style)/FontFile2 5199 0 R>>"
+    + bytes(1500)
+    + b"trailer\n<</Size 5226/Root 5168 0 R/ID[<DE237A7714166B438254F2E7CAEACB2B><0A856D2F0DE97146B3FC7DBBA75F5CEB>]>>"
+    + bytes(1500)
+)
+
+
+def test_fingerprint_pdf():
+    uid = fingerprint_from_user("user")
+    offsets = find_fingerprint_offsets(BytesIO(pdf))
+    assert [pdf[o : o + 12] for o in offsets] == [b"E9E3ECA55654", b"Goudy Old St", b"DE237A771416"]
+    # Matches across blocks are found as well
+    assert find_fingerprint_offsets(BytesIO(pdf), block_size=1000) == offsets
+
+    fingerprinted = b"".join(fingerprint_pdf(BytesIO(pdf), "user"))
+    assert len(fingerprinted) == len(pdf)
+    assert [fingerprinted[o : o + 12] for o in offsets] == [uid] * 3
+    assert fingerprinted.count(uid) == 3
+
+    # A range that splits a fingerprint gets the part of it within the range
+    start, stop = offsets[0] + 5, offsets[0] + 500
+    chunks = [pdf[i : min(i + 7, stop)] for i in range(start, stop, 7)]
+    assert b"".join(splice_fingerprint(chunks, start, offsets, uid)) == fingerprinted[start:stop]
+
+
+def test_scan_fingerprints(tmp_path):
+    uid = fingerprint_from_user("user").decode()
+    paths = [str(tmp_path / "leaked.pdf"), str(tmp_path / "original.pdf"), str(tmp_path / "empty.pdf")]
+    with open(paths[0], "wb") as f:
+        f.writelines(fingerprint_pdf(BytesIO(pdf), "user"))
+    with open(paths[1], "wb") as f:
+        f.write(pdf)
+    open(paths[2], "wb").close()
+
+    results = scan_fingerprints_in(paths, processes=2)
+    assert results[paths[0]][uid] == {"pdf_id", "doc_id", "font_id"}
+    assert uid not in results[paths[1]]
+    assert results[paths[2]] == {}
@@ -96,3 +96,168 @@ def test_set_form_fields_errors():
     general_errors = set_form_fields_errors(errors, order_form)
     assert order_form.errors == {"shipping_address": {"city": ["invalid"]}}
     assert general_errors == ["title/en/: invalid"]
+
+
+def test_cursor_roundtrip():
+    from datetime import datetime
+    from bson import ObjectId
+    from lore.api.resource import cursor_matcher, decode_cursor, encode_cursor
+
+    pk = ObjectId()
+    created = datetime(2020, 1, 2, 3, 4, 5)
+    token = encode_cursor("created_date", created, pk)
+    assert cursor_matcher.match(token)
+    value, decoded_pk = decode_cursor(token, "created_date")
+    assert value.replace(tzinfo=None) == created
+    assert decoded_pk == pk
+
+
+def test_keyset_value():
+    from lore.api.resource import keyset_value
+
+    class Name:
+        name = "Alpha"
+
+    class Item:
+        names = [Name()]
+        created = None
+
+    assert keyset_value(Item(), "names.0.name") == "Alpha"
+    assert keyset_value(Item(), "names.1.name") is None
+    assert keyset_value(Item(), "created") is None
+
+
+def test_warn_on_unprojected_access(mongomock, monkeypatch):
+    from flask import Flask
+    from mongoengine.base import BaseField
+
+    from lore.api import resource
+    from lore.model.world import Publisher
+
+    app = Flask(__name__)
+    warnings = []
+    monkeypatch.setattr(resource.logger, "warning", warnings.append)
+    original_get = BaseField.__get__
+    Publisher(slug="pub1", title="Pub 1", description="A publisher").save()
+
+    def load_projected():
+        pub = Publisher.objects(slug="pub1").only("slug", "title").first()
+        pub._projected_fields = {"id", "slug", "title"}
+        return pub
+
+    try:
+        with app.test_request_context():
+            resource.warn_on_unprojected_access()
+            pub = load_projected()
+            assert pub.title == "Pub 1"
+            assert not warnings
+            assert pub.description is None  # Not loaded
+            assert len(warnings) == 1
+        with app.test_request_context():
+            assert load_projected().description is None
+            assert len(warnings) == 1  # Only warns in requests that asked for it
+    finally:
+        resource.stop_warning_on_unprojected_access()
+    assert BaseField.__get__ is original_get
+
+
+def test_resource_versions(mongomock):
+    from lore.api.resource import document_version, query_version
+    from lore.model.world import Publisher
+
+    pub = Publisher(slug="pub1", title="Pub 1").save()
+    updated, version = document_version(pub)
+    assert updated == pub.updated and version == (pub.pk, pub.updated)
+    Publisher.objects(slug="pub1").update(unset__updated=True)
+    assert document_version(Publisher.objects(slug="pub1").first()) is None  # Saved before tracking modifications
+
+    pub2 = Publisher(slug="pub2", title="Pub 2").save()
+    updated, version = query_version(Publisher.objects())
+    assert updated.replace(microsecond=0) == pub2.updated.replace(microsecond=0)
+    assert version[2] == 2
+    assert query_version(Publisher.objects(slug="pub3"))[1][2] == 0
+
+    # Cached per query shape until the collection is written to
+    version = query_version(Publisher.objects(slug__ne="pub4"), 60)
+    Publisher.objects(slug="pub1").update(set__title="Renamed")  # Bypasses signals, like a write by another process
+    assert query_version(Publisher.objects(slug__ne="pub4"), 60) == version
+    Publisher(slug="pub3", title="Pub 3").save()
+    assert query_version(Publisher.objects(slug__ne="pub4"), 60)[1][2] == 3
+
+
+def test_not_modified(mongomock):
+    from flask import Flask, g, session
+    from flask_babel import Babel
+    from lore.api.resource import ItemResponse
+    from lore.model.world import Publisher
+
+    class PublishersView:
+        access_policy = None
+        model = Publisher
+        item_template = "world/publisher_item.html"
+
+    app = Flask(__name__)
+    app.secret_key = "test"
+    Babel(app)
+    pub = Publisher(slug="pub1", title="Pub 1").save()
+
+    def response(cart_id=None, **headers):
+        with app.test_request_context("/", headers=headers):
+            g.user = None
+            if cart_id:
+                session["cart_id"] = cart_id
+            r = ItemResponse(PublishersView, [("publisher", pub)])
+            return r.not_modified("text/html"), r
+
+    not_modified, r = response()
+    assert not not_modified and r.status_code == 200
+    etag = r.headers["ETag"]
+    assert etag.startswith("W/") and r.headers["Last-Modified"]
+    assert r.cache_control.private and r.cache_control.no_cache  # Always revalidated, and only by the same client
+    not_modified, r = response(If_None_Match=etag)
+    assert not_modified and r.status_code == 304
+    not_modified, r = response(If_Modified_Since=r.headers["Last-Modified"])
+    assert not_modified
+    not_modified, r = response(cart_id="cart1", If_None_Match=etag)
+    assert not not_modified and "ETag" not in r.headers  # The cart is not part of the version
+
+    pub.title = "Pub 2"
+    pub.save()
+    not_modified, r = response(If_None_Match=etag)
+    assert not not_modified and r.headers["ETag"] != etag
+
+
+def test_not_modified_with_other_content(mongomock):
+    from flask import Flask, g
+    from flask_babel import Babel
+    from lore.api.resource import ListResponse
+    from lore.model.world import Publisher
+
+    class PublishersView:
+        access_policy = None
+        model = Publisher
+        list_template = "world/publisher_list.html"
+
+    app = Flask(__name__)
+    Babel(app)
+    pub = Publisher(slug="pub1", title="Pub 1").save()
+
+    def response(owned, resources=None, **headers):
+        with app.test_request_context("/", headers=headers):
+            g.user = None
+            r = ListResponse(PublishersView, resources or [("publishers", []), ("publisher", pub)])
+            r.my_products = owned  # Content built by the view, which the resources don't version
+            return r.not_modified("text/html"), r
+
+    not_modified, r = response({"world": ["product 1"]})
+    assert not not_modified and "ETag" not in r.headers
+    not_modified, r = response({"world": ["product 1", "product 2"]}, If_Modified_Since="Fri, 01 Jan 2100 00:00:00 GMT")
+    assert not not_modified and r.status_code == 200
+
+    # Documents set by the view don't disable validation, but empty lists of resources do
+    not_modified, r = response(pub, [("publishers", [pub])])
+    assert not not_modified and "ETag" in r.headers
+    not_modified, r = response(pub, [("publishers", [pub])], If_None_Match=r.headers["ETag"])
+    assert not_modified
+    not_modified, r = response(pub, [("publishers", [])])
+    assert "ETag" not in r.headers
@@ -19,3 +19,27 @@ def basic_app_data(app_client, mongomock):
 
 # def test_publishers_view(app_client, basic_app_data):
 #     pass
+
+
+def test_article_list_queries(app_client, query_counter):
+    from flask import url_for
+    from lore.model.user import User
+    from lore.model.world import Publisher, World, Article
+
+    app = app_client.application
+    with app.test_request_context():
+        hg = Publisher(slug="helmgast.se", title="Helmgast AB").save()
+        neo = World(title="Neotech", publisher=hg).save()
+        url = url_for("world.ArticlesView:index", pub_host=hg.slug, world_=neo.slug, _external=True)
+
+    def add_articles(start, end):
+        for i in range(start, end):
+            user = User(username=f"user{i}", email=f"user{i}@test.com", realname=f"User {i}").save()
+            Article(title=f"Article {i}", world=neo, publisher=hg, creator=user).save()
+
+    add_articles(0, 2)
+    queries = query_counter.render(app_client, url)
+    assert queries.count(("user", "find")) == 1  # Creators are prefetched in one query
+    add_articles(2, 8)
+    # References of all articles are fetched in batch, so more articles don't need more queries
+    assert len(query_counter.render(app_client, url)) <= len(queries)
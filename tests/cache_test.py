@@ -0,0 +1,162 @@
+import os
+from time import sleep
+
+import gridfs
+from flask import Flask
+
+from lore.cache import FileCache, LRUCache, cached_count, collection_version
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2, ttl=None)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # Evicts b, as a was used more recently
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get_or_set("d", lambda: 4) == 4
+    assert len(cache) == 2
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl=0.01)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    sleep(0.02)
+    assert cache.get("a", "expired") == "expired"
+
+
+def test_cached_count(mongomock):
+    from lore.model.world import Publisher
+
+    Publisher(slug="pub1", title="Pub 1").save()
+    Publisher(slug="pub2", title="Pub 2").save()
+    assert cached_count(Publisher.objects(), 60) == 2
+    assert cached_count(Publisher.objects(slug="pub1"), 60) == 1
+
+    version = collection_version("publisher")
+    Publisher(slug="pub3", title="Pub 3").save()
+    assert collection_version("publisher") != version
+    assert cached_count(Publisher.objects(slug__in=["pub1", "pub3"]), 60) == 2
+
+
+def test_file_cache(mongomock, tmp_path):
+    app = Flask(__name__)
+    app.config.update(ASSET_CACHE_DIR=str(tmp_path), ASSET_CACHE_MAX_BYTES=250, ASSET_CACHE_MAX_FILE_BYTES=100)
+    cache = FileCache()
+    cache.init_app(app)
+    fs = gridfs.GridFS(mongomock.get_database("mongoenginetest"))
+    files = [fs.get(fs.put(bytes([i]) * 100, chunkSize=30)) for i in range(3)]
+
+    path = cache.fetch(files[0])
+    with open(path, "rb") as f:
+        assert f.read() == bytes([0]) * 100
+    assert cache.fetch(files[0]) == path
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    cache.fetch(files[1])
+    cache.fetch(files[0])
+    cache.fetch(files[2])  # Evicts files[1], as files[0] was used more recently
+    assert cache.stats()["evictions"] == 1
+    assert cache.get(files[1].md5) is None
+    assert cache.get(files[0].md5) and cache.get(files[2].md5)
+
+    # Files already on disk are found after a restart
+    restarted = FileCache()
+    restarted.init_app(app)
+    assert restarted.stats()["bytes"] == 200
+
+    assert cache.fetch(fs.get(fs.put(b"x" * 101))) is None  # Too large to cache
+    cache.delete(files[0].md5)
+    assert cache.get(files[0].md5) is None
+
+    # A miss is cached while it's streamed, unless it's already being cached or the stream is closed early
+    stream = cache.streaming(files[0])
+    first = next(stream)
+    assert b"".join(cache.streaming(files[0])) == bytes([0]) * 100  # Only read from GridFS
+    assert first + b"".join(stream) == bytes([0]) * 100
+    assert cache.get(files[0].md5)
+    cache.delete(files[0].md5)
+    stream = cache.streaming(files[0])
+    next(stream)
+    stream.close()
+    assert cache.get(files[0].md5) is None
+    assert not [name for name in os.listdir(os.path.dirname(cache.path(files[0].md5))) if name.startswith(".tmp")]
+
+
+def test_markdown_renderer(mongomock, monkeypatch):
+    from lore.extensions import MarkdownRenderer
+    from lore.cache import markdown_cache
+
+    app = Flask(__name__)
+    app.config["MARKDOWN_SHARED_MIN_LENGTH"] = 20
+    renderer = MarkdownRenderer(extensions=["tables"])
+    renders = []
+    render = renderer.render
+    monkeypatch.setattr(renderer, "render", lambda text: renders.append(text) or render(text))
+    markdown_cache.clear()
+    with app.app_context():
+        assert renderer.convert("*short*") == renderer.convert("*short*") == "<p><em>short</em></p>"
+        assert renderer.convert("<b>", escape=True) == "<p>&lt;b&gt;</p>"
+        assert len(renders) == 2
+
+        text = "A \"longer\" text, **rendered** once for all processes"
+        html = renderer.convert(text)
+        markdown_cache.clear()  # As in another process
+        assert renderer.convert(text) == html
+        assert len(renders) == 3
+        assert mongomock.get_database("mongoenginetest").rendered_markdown.count_documents({}) == 1
+        assert MarkdownRenderer(extensions=["smarty"]).convert(text) != html
+
+
+def test_markdown_converter_reuse():
+    import threading
+    from lore.extensions import MarkdownRenderer
+
+    assert MarkdownRenderer(stripTopLevelTags=False).converter().stripTopLevelTags is False
+    renderer = MarkdownRenderer()
+    md = renderer.converter()
+    assert renderer.converter() is md
+    assert renderer.render("[Eon][eon]\n\n[eon]: /eon") == '<p><a href="/eon">Eon</a></p>'
+    assert renderer.render("[Eon][eon]") == "<p>[Eon][eon]</p>"  # The reference was reset
+
+    others = []
+    thread = threading.Thread(target=lambda: others.append(renderer.converter()))
+    thread.start()
+    thread.join()
+    assert others[0] is not md
+
+
+def test_fragment_cache(mongomock):
+    from flask import render_template_string
+    from flask_babel import Babel
+    from lore.cache import fragment_cache
+    from lore.extensions import FragmentCacheExtension
+    from lore.model.world import Publisher
+
+    app = Flask(__name__)
+    app.config["FRAGMENT_CACHE_TTL"] = 60
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    Babel(app)
+    template = '{% cache "pubs", tags=["Publisher"] %}{{ pubs()|join(",") }}{% endcache %}'
+    uncached = '{% cache "pubs", 0, tags=["Publisher"] %}{{ pubs()|join(",") }}{% endcache %}'
+    renders = []
+
+    def pubs():
+        renders.append(1)
+        return ["<" + p.slug + ">" for p in Publisher.objects().order_by("slug")]
+
+    fragment_cache.clear()
+    Publisher(slug="pub1", title="Pub 1").save()
+    with app.test_request_context("/"):
+        assert render_template_string(template, pubs=pubs) == "&lt;pub1&gt;"
+        assert render_template_string(template, pubs=pubs) == "&lt;pub1&gt;"
+        assert len(renders) == 1
+        render_template_string(uncached, pubs=pubs)
+        assert len(renders) == 2
+
+        Publisher(slug="pub2", title="Pub 2").save()
+        assert render_template_string(template, pubs=pubs) == "&lt;pub1&gt;,&lt;pub2&gt;"
+        assert len(renders) == 3
@@ -30,3 +30,52 @@ def mocked_responses():
 
     with responses.RequestsMock() as rsps:
         yield rsps
+
+
+class QueryCounter(object):
+    """Records the read queries sent to the mock database while used as a context manager"""
+
+    operations = ["find", "find_one", "aggregate", "count_documents", "estimated_document_count", "distinct"]
+
+    def __init__(self):
+        self.queries = []
+        self.active = False
+        self._depth = 0
+
+    def wrap(self, method):
+        def counted(collection, *args, **kwargs):
+            # Only count the outermost call, as mongomock implements some operations using others
+            if self.active and not self._depth:
+                self.queries.append((collection.name, method.__name__))
+            self._depth += 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                self._depth -= 1
+
+        return counted
+
+    def __enter__(self):
+        self.queries = []
+        self.active = True
+        return self.queries
+
+    def __exit__(self, *exc):
+        self.active = False
+
+    def render(self, client, url, **kwargs):
+        """Renders a page and returns the queries it needed, e.g. to assert the number of queries of a list page"""
+        with self as queries:
+            rv = client.get(url, **kwargs)
+        assert rv.status_code == 200, f"{url} returned {rv.status_code}"
+        return queries
+
+
+@pytest.fixture
+def query_counter(mongomock, monkeypatch):
+    from mongomock.collection import Collection
+
+    counter = QueryCounter()
+    for name in QueryCounter.operations:
+        monkeypatch.setattr(Collection, name, counter.wrap(getattr(Collection, name)))
+    return counter
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+from flask import Flask, g
+from pymongo import monitoring
+
+from lore.dbstats import QueryStats, collector, init_dbstats, query_stats
+
+
+def send_command(request_id, command, reply):
+    name, connection = next(iter(command)), ("localhost", 27017)
+    collector.started(monitoring.CommandStartedEvent(command, "lore", request_id, connection, 1))
+    collector.succeeded(
+        monitoring.CommandSucceededEvent(timedelta(milliseconds=2), reply, name, request_id, connection, 1)
+    )
+
+
+def test_query_stats():
+    app = Flask(__name__)
+    one_batch = {"cursor": {"firstBatch": [{"_id": 1}], "id": 0}, "ok": 1}
+    with app.test_request_context("/articles/"):
+        g.query_stats = QueryStats()
+        for i in range(3):
+            send_command(i, {"find": "user", "filter": {"_id": i}, "lsid": {"id": i}}, one_batch)
+        send_command(3, {"count": "article", "query": {}, "lsid": {"id": 3}}, {"n": 3, "ok": 1})
+
+        stats = g.query_stats
+        assert stats.count == 4
+        assert stats.duration_ms == 8
+        assert stats.docs == 3
+        assert stats.n_plus_one(2) == {"user": 3}
+        assert stats.n_plus_one(3) == {}
+        assert not stats.repeated()
+
+        send_command(4, {"count": "article", "query": {}, "lsid": {"id": 4}}, {"n": 3, "ok": 1})
+        assert list(stats.repeated().values()) == [2]  # Same command, only session differs
+        assert stats.server_timing().startswith("db;dur=10.0;")
+
+    with app.test_request_context("/"):
+        send_command(5, {"count": "article", "query": {}}, {"n": 3, "ok": 1})  # Not collecting, ignored
+
+
+def test_init_dbstats():
+    app = Flask(__name__)
+    init_dbstats(app)
+    assert not app.before_request_funcs  # Not enabled and no debug toolbar
+
+    app = Flask(__name__)
+    app.debug = True
+    init_dbstats(app)
+
+    @app.route("/")
+    def index():
+        return "collecting" if query_stats() is not None else "not collecting"
+
+    client = app.test_client()
+    assert client.get("/").data == b"not collecting"
+    assert client.get("/?debug").data == b"collecting"
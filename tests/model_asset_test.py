@@ -1,7 +1,135 @@
+import hashlib
 import pytest
 import json
 import responses
-from lore.model.asset import sniff_remote_file, FileAsset
+import threading
+from io import BytesIO
+
+import gridfs
+from PIL import Image
+from werkzeug.datastructures import MIMEAccept
+
+from lore.cache import derivative_cache
+from lore.model import asset as asset_model
+from mongoengine import ValidationError
+
+from lore.model.asset import sniff_remote_file, FileAsset, collapse_blobs, derivative_format, image_derivative
+from lore.model.world import Publisher  # noqa, registers the referenced document
+
+
+def test_set_file(mongomock, monkeypatch):
+    png = BytesIO()
+    Image.new("RGB", (300, 200), "blue").save(png, "PNG")
+    png.seek(0)
+    db = mongomock.get_database("mongoenginetest")
+
+    asset = FileAsset()
+    asset.set_file(png, "blue.png")
+    assert (asset.content_type, asset.width, asset.height) == ("image/png", 300, 200)
+    asset.save()
+    assert asset.file_data.read() == png.getvalue()
+    assert asset.md5 == asset.file_data.get().md5
+    assert db.fs.files.count_documents({}) == db.fs.chunks.count_documents({}) == 1
+
+    # Duplicates and invalid files are removed from GridFS again
+    png.seek(0)
+    with pytest.raises(ValidationError):
+        FileAsset().set_file(png, "copy.png")
+    with pytest.raises(ValidationError):
+        FileAsset().set_file(BytesIO(b"\x89PNG\r\n\x1a\n" + bytes(100)), "broken.png")
+    assert db.fs.files.count_documents({}) == db.fs.chunks.count_documents({}) == 1
+
+    # So is a new file of an asset that fails validation after the file was written
+    green = BytesIO()
+    Image.new("RGB", (300, 200), "green").save(green, "PNG")
+    green.seek(0)
+    invalid = FileAsset(title="x" * 100)
+    invalid.set_file(green, "green.png")
+    assert db.fs.files.count_documents({}) == 2
+    with pytest.raises(ValidationError):
+        invalid.save()
+    assert db.fs.files.count_documents({}) == db.fs.chunks.count_documents({}) == 1
+
+    # A replaced file is only released when the asset is saved with the new one
+    blue_id = asset.file_data.grid_id
+    asset.title = "x" * 100
+    green.seek(0)
+    asset.set_file(green, "green.png")
+    with pytest.raises(ValidationError):
+        asset.save()
+    assert asset.file_data.grid_id == blue_id
+    assert db.fs.files.find_one({"_id": blue_id})["refcount"] == 1
+    assert db.fs.files.count_documents({}) == 1
+    asset.title = "Green"
+    green.seek(0)
+    asset.set_file(green, "green.png")
+    asset.save()
+    assert asset.reload().file_data.read() == green.getvalue()
+    assert db.fs.files.count_documents({}) == db.fs.chunks.count_documents({}) == 1
+
+    # Any error reading the image header makes it invalid
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    png.seek(0)
+    with pytest.raises(ValidationError, match="Invalid image"):
+        FileAsset().set_file(png, "bomb.png")
+    assert db.fs.files.count_documents({}) == 1
+
+
+def test_shared_blobs(mongomock):
+    files = mongomock.get_database("mongoenginetest").fs.files
+    fs = gridfs.GridFS(mongomock.get_database("mongoenginetest"))
+
+    def file_asset(title, data, copy=False):
+        fa = FileAsset(title=title, source_filename=title, content_type="text/plain")
+        if copy:  # As stored before files were shared
+            fa.file_data.grid_id = fs.put(data, content_type="text/plain")
+        else:
+            fa.file_data.put(data, content_type="text/plain")
+        return fa.save()
+
+    first, second = file_asset("first.txt", b"shared"), file_asset("second.txt", b"shared")
+    assert first.file_data.grid_id == second.file_data.grid_id
+    assert files.find_one({"_id": first.file_data.grid_id})["refcount"] == 2
+    first.delete()
+    assert second.file_data.read() == b"shared"
+    second.delete()
+    assert files.count_documents({}) == 0
+
+    copies = [file_asset(f"copy{i}.txt", b"copied", copy=True) for i in range(3)]
+    other = file_asset("other.txt", b"other", copy=True)
+    assert files.count_documents({}) == 4
+    assert collapse_blobs() == (2, 2 * len(b"copied"))
+    assert files.count_documents({}) == 2
+    assert set(fa.reload().file_data.grid_id for fa in copies) == {copies[0].file_data.grid_id}
+    assert files.find_one({"_id": copies[0].file_data.grid_id})["refcount"] == 3
+    assert files.find_one({"_id": other.file_data.grid_id})["refcount"] == 1
+
+
+def test_image_derivative(mongomock, monkeypatch):
+    png = BytesIO()
+    Image.new("RGB", (1000, 500), "red").save(png, "PNG")
+    fs = gridfs.GridFS(mongomock.get_database("mongoenginetest"))
+    gridfile = fs.get(fs.put(png.getvalue(), content_type="image/png"))
+
+    webp = derivative_format("image/png", MIMEAccept([("image/webp", 1), ("*/*", 0.8)]))
+    assert webp[0] == "image/webp"
+    assert derivative_format("image/png", MIMEAccept([("*/*", 1)]))[0] == "image/png"
+    assert derivative_format("image/gif", MIMEAccept([("image/webp", 1)])) is None
+
+    derivative_cache.clear()
+    renders = []
+    render = asset_model.render_derivative
+    monkeypatch.setattr(asset_model, "render_derivative", lambda *args: renders.append(args) or render(*args))
+    threads = [threading.Thread(target=image_derivative, args=(gridfile, "card", webp)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(renders) == 1  # The other threads waited for the first render
+
+    img = Image.open(image_derivative(gridfile, "card", webp))
+    assert img.format == "WEBP" and img.size == (800, 400)
+    assert Image.open(image_derivative(gridfile, "thumb", webp)).size == (250, 125)
 
 
 # def test_make_slug():
@@ -68,3 +196,43 @@ from lore.model.asset import sniff_remote_file, FileAsset
 #         responses.GET, 'https://server.com/testfile.png',
 #         body='{}', status=200,
 #         content_type='image/png')
+
+
+def test_fetch_file_metadata(app_client, mongomock, mocked_responses):
+    from lore.model.task import Task, TaskStatus, work
+
+    png = BytesIO()
+    Image.new("RGB", (300, 200), "green").save(png, "PNG")
+    url = "https://files.example.com/images/green.png"
+    mocked_responses.add(responses.GET, url, status=503)
+    mocked_responses.add(responses.GET, url, body=png.getvalue(), content_type="application/octet-stream")
+
+    with app_client.application.test_request_context():
+        app_client.application.config["ASYNC_FILE_METADATA"] = True
+        asset = FileAsset(source_file_url=url)
+        asset.save()  # Doesn't wait for the remote file
+        assert len(mocked_responses.calls) == 0
+        assert (asset.slug, asset.content_type, asset.metadata_status) == ("green.png", "image/png", "pending")
+        task = Task.objects(name="fetch_file_metadata", key=str(asset.id)).get()
+
+        assert work(burst=True) == 1
+        task.reload()
+        assert (task.status, task.attempts) == (TaskStatus.queued, 1)  # Retried later after the 503
+        assert "503" in task.error and task.run_at > task.created
+
+        Task.objects(id=task.id).update_one(set__run_at=task.created)
+        assert work(burst=True) == 1
+        assert task.reload().status == TaskStatus.done
+        asset.reload()
+        assert (asset.width, asset.height, asset.length) == (300, 200, len(png.getvalue()))
+        assert asset.md5 == hashlib.md5(png.getvalue()).hexdigest() and asset.metadata_status is None
+
+        asset.source_file_url = "https://files.example.com/images/green-large.png"
+        asset.save()  # The metadata of the previous URL no longer applies
+        assert asset.length == 0 and asset.md5 != hashlib.md5(png.getvalue()).hexdigest()
+        assert asset.metadata_status == "pending"
+        assert Task.objects(name="fetch_file_metadata", key=str(asset.id), status=TaskStatus.queued).count() == 1
+
+        asset.title = "Green"
+        asset.save()
+        assert asset.reload().metadata_status == "pending"  # Still waiting for the task
@@ -73,3 +73,142 @@ def test_current_url(app_client):
 
 
 # TEST current_url for no request and no request.endpoint
+
+
+def test_options_query_dependent():
+    from lore.model.misc import choice_options, distinct_options, numerical_options, reference_options
+    from lore.model.world import Article
+
+    assert distinct_options("tags", Article).query_dependent
+    assert reference_options("world", Article).query_dependent
+    assert not getattr(choice_options("type", Article.type.choices), "query_dependent", False)
+    assert not getattr(numerical_options("sort_priority", [0, 10]), "query_dependent", False)
+
+
+def test_filter_options_cached(query_counter, monkeypatch):
+    from flask import Flask
+    from flask_babel import Babel
+    from mongomock.collection import Collection
+    from pymongo.errors import OperationFailure
+    from lore.api.resource import FilterableFields, ListResponse
+    from lore.cache import filter_options_cache
+    from lore.model.world import Article
+
+    class ArticlesView:
+        access_policy = None
+        model = Article
+        list_template = "world/article_list.html"
+        filterable_fields = FilterableFields(Article, ["type", "tags"])
+
+    app = Flask(__name__)
+    Babel(app)
+    app.config["FILTER_OPTIONS_TTL"] = 60
+    filter_options_cache.clear()
+    Article(title="A", type="blogpost", tags=["eon", "kult"]).save()
+    Article(title="B", tags=["eon"]).save()
+
+    def get_filter_options(query):
+        with app.test_request_context("/"):
+            return ListResponse(ArticlesView, [("articles", query)]).get_filter_options()
+
+    def counts(query):
+        options = get_filter_options(query)
+        return {name: {opt.kwargs[name]: opt.count for opt in opts if opt.count} for name, opts in options.items()}
+
+    with query_counter as queries:
+        assert counts(Article.objects()) == {"type": {"default": 1, "blogpost": 1}, "tags": {"eon": 2, "kult": 1}}
+        assert queries == [("article", "aggregate")]  # All fields in one $facet
+        counts(Article.objects())
+        assert len(queries) == 1  # Same query shape, so cached
+        assert counts(Article.objects(tags="kult")) == {"type": {"blogpost": 1}, "tags": {"eon": 1, "kult": 1}}
+        assert len(queries) == 2
+
+    Article(title="C", tags=["eon"]).save()
+    with query_counter as queries:
+        assert counts(Article.objects())["tags"] == {"eon": 3, "kult": 1}  # Invalidated by the write
+        assert len(queries) == 1
+
+    def aggregate(*args, **kwargs):
+        raise OperationFailure("$facet not supported")
+
+    monkeypatch.setattr(Collection, "aggregate", aggregate)
+    filter_options_cache.clear()
+    options = get_filter_options(Article.objects())  # Falls back to one query per field, without counts
+    assert sorted(opt.kwargs["tags"] for opt in options["tags"]) == ["eon", "kult"]
+    assert [opt.kwargs["type"] for opt in options["type"]] == [t for t, label in Article.type.choices]
+
+
+def test_numerical_options_from_facet():
+    from lore.model.misc import numerical_options
+
+    options = numerical_options("price", [0, 50, 100])
+    # Buckets are keyed by negated lower boundary, e.g. -50 holds values 0 < x <= 50
+    rows = [{"_id": 0, "count": 2}, {"_id": -50, "count": 3}, {"_id": -100, "count": 4}, {"_id": "more", "count": 1}]
+    counts = [opt.count for opt in options.from_facet(None, rows)]
+    assert counts == [2, 5, 9, 1]
+
+
+def test_slugs_to_ids(mongomock):
+    from lore.model.misc import slugs_to_ids
+    from lore.model.world import Publisher
+
+    pub1 = Publisher(slug="pub1", title="Pub 1").save()
+    pub2 = Publisher(slug="pub2", title="Pub 2").save()
+    assert slugs_to_ids(Publisher, ["pub1", "pub2", "missing"]) == {"pub1": pub1.id, "pub2": pub2.id}
+
+
+def test_prefetch_references(query_counter):
+    from bson import DBRef
+    from lore.model.misc import prefetch_references
+    from lore.model.user import User
+    from lore.model.world import Article
+
+    users = [User(username=f"user{i}", email=f"user{i}@test.com").save() for i in range(3)]
+    for i in range(3):
+        Article(slug=f"article{i}", title=f"Article {i}", creator=users[i], editors=users).save()
+
+    articles = list(Article.objects(slug__startswith="article"))
+    with query_counter as queries:
+        prefetch_references(articles, ["creator", "editors[0]"])
+        assert len(queries) == 1  # All users in one query
+        assert [a.creator.username for a in articles] == ["user0", "user1", "user2"]
+        assert articles[0].editors[0].username == "user0"
+        assert isinstance(articles[0].editors[1], DBRef)  # Not prefetched
+        assert not articles[0]._get_changed_fields()
+    assert len(queries) == 1
+
+    articles = list(Article.objects(slug__startswith="article"))
+    with query_counter as queries:
+        prefetch_references(articles, ["editors"])
+        assert [u.username for u in articles[2].editors] == ["user0", "user1", "user2"]
+    assert len(queries) == 1
+
+    with pytest.raises(ValueError):
+        prefetch_references(articles, ["title"])
+
+
+def test_sort_keys(mongomock):
+    from lore.model.misc import backfill_sort_keys, sort_key_fields
+    from lore.model.user import User
+    from lore.model.world import Article, World
+
+    assert sort_key_fields(Article)["creator.realname"].name == "sort_creator_realname"
+
+    user = User(username="user1", email="user1@test.com", realname="Anna").save()
+    world = World(slug="world1", title_i18n={"sv": "Värld", "en": "World"}).save()
+    article = Article(title="Article 1", creator=user, world=world).save()
+    article.reload()
+    assert (article.sort_creator_realname, article.sort_world_title_sv, article.sort_world_title_en) == (
+        "Anna",
+        "Värld",
+        "World",
+    )
+
+    user.realname = "Bertil"
+    user.save()
+    assert Article.objects(id=article.id).first().sort_creator_realname == "Bertil"
+
+    Article.objects(id=article.id).update(unset__sort_creator_realname=True, unset__sort_world_title_sv=True)
+    assert backfill_sort_keys(Article) > 0
+    article.reload()
+    assert (article.sort_creator_realname, article.sort_world_title_sv) == ("Bertil", "Värld")
@@ -629,4 +629,42 @@ def test_textalk_hook_error_cases(caplog, app_client):
     )
     assert "Unsupported event" in caplog.text
     assert rv.status_code == 200
-    caplog.clear()
\ No newline at end of file
+    caplog.clear()
+
+
+def test_entitlements(mongomock, app_client, db_loaded_product_data):
+    from lore.model.asset import FileAsset
+    from lore.model.shop import Entitlement, rebuild_entitlements, user_has_asset, user_owns_product
+
+    p1 = db_loaded_product_data["kdl-132"]
+    pdf = FileAsset(slug="rockets.pdf", source_filename="rockets.pdf", content_type="application/pdf").save()
+    extra = FileAsset(slug="extra.pdf", source_filename="extra.pdf", content_type="application/pdf").save()
+    p1.downloads = [pdf]
+    p1.save()
+    user = User(email="buyer@test.com").save()
+
+    order = Order(user=user, order_lines=[OrderLine(product=p1)], status=OrderStatus.checkout).save()
+    assert not user_has_asset(user, pdf)
+    order.status = OrderStatus.paid
+    order.save()
+    assert user_owns_product(user, p1)
+    assert user_has_asset(user, pdf) and not user_has_asset(user, extra)
+
+    p1.downloads.append(extra)
+    p1.save()
+    assert user_has_asset(user, extra)
+
+    Entitlement.objects.delete()  # As for orders paid before entitlements were materialized
+    assert user_has_asset(user, extra)
+    assert Entitlement.objects(user=user.id).count() == 1
+    assert rebuild_entitlements() == 1
+    assert user_has_asset(user, extra)
+
+    other = User(email="other@test.com").save()
+    order.user = other
+    order.save()  # The previous owner loses access
+    assert user_owns_product(other, p1) and not user_owns_product(user, p1)
+
+    order.status = OrderStatus.discarded
+    order.save()
+    assert not user_owns_product(other, p1) and not user_has_asset(other, pdf)
@@ -70,3 +70,16 @@ def test_merge_users(mongomock, app_client, db_loaded_user_data):
     assert len(events) == 1
     # log item for U2 was changed to U1
     assert events[0].user == db_loaded_user_data["u1"]
+
+
+def test_user_fingerprints(mongomock, app_client, db_loaded_user_data):
+    from lore.model.fingerprint import fingerprint_from_user
+    from lore.model.user import index_user_fingerprints, users_by_fingerprint
+
+    u1 = db_loaded_user_data["u1"]
+    fingerprint = fingerprint_from_user(u1.id).decode()
+    assert User.objects(id=u1.id).first().fingerprint == fingerprint  # Set when created
+
+    User.objects(id=u1.id).update_one(unset__fingerprint=True)
+    assert index_user_fingerprints() == 1
+    assert users_by_fingerprint([fingerprint, "000000000000"]) == {fingerprint: u1}
@@ -0,0 +1,27 @@
+from flask import g
+
+
+def test_publisher_cached(app_client, mongomock):
+    from lore.model.world import Article, Publisher, World
+
+    publisher = Publisher(slug="pub1", title="Pub 1").save()
+    world = World(title="World 1", publisher=publisher).save()
+    article = Article(title="Article 1", world=world, publisher=publisher).save()
+
+    with app_client.application.test_request_context():
+        by_slug = Publisher.cached(slug="pub1")
+        assert by_slug.title == "Pub 1"
+        assert Publisher.cached(id=str(publisher.id)) is by_slug  # Same instance within request
+        assert Publisher.cached(slug="missing") is None
+        # Dereferencing goes through the same identity map
+        article = Article.objects(id=article.id).first()
+        assert article.publisher is by_slug
+        assert article.world is World.cached(slug=world.slug)
+
+        publisher.title = "Pub 1 renamed"
+        publisher.save()  # Removes publishers from identity map
+        assert Publisher.cached(slug="pub1").title == "Pub 1 renamed"
+
+    with app_client.application.test_request_context():
+        assert "identity_map" not in g
+        assert Publisher.cached(slug="pub1").title == "Pub 1 renamed"
@@ -0,0 +1,112 @@
+import pytest
+from flask import Flask, jsonify, render_template_string, request, session
+from flask_wtf.csrf import CSRFProtect
+from mongoengine import signals
+
+from lore import pagecache
+from lore.pagecache import MemoryPageStore
+from lore.model.world import Article
+
+
+@pytest.fixture
+def reset_pagecache():
+    yield
+    pagecache.page_store = None
+    signals.post_init.disconnect(pagecache._tag_loaded_document)
+    signals.post_save.disconnect(pagecache._invalidate_saved_document)
+    signals.post_delete.disconnect(pagecache._invalidate_deleted_document)
+
+
+def test_page_cache(mongomock, reset_pagecache):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY="test", PAGE_CACHE="memory", PAGE_CACHE_TTL={"article": 60, "negotiated": 60, "form": 60})
+    renders = []
+
+    @app.route("/articles/<slug>")
+    def article(slug):
+        renders.append(slug)
+        return Article.objects(slug=slug).get().content
+
+    @app.route("/negotiated")
+    def negotiated():
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify(format="json")
+        return "html"
+
+    @app.route("/form")
+    def form():
+        session["csrf_token"] = "only for this visitor"
+        return "form"
+
+    pagecache.init_pagecache(app)
+    client = app.test_client()
+    eon = Article(title="Eon", content="Eon").save()
+
+    assert client.get("/articles/eon?a=1&b=2").headers["X-Page-Cache"] == "miss"
+    rv = client.get("/articles/eon?b=2&a=1")
+    assert rv.headers["X-Page-Cache"] == "hit" and rv.data == b"Eon"
+    assert len(renders) == 1
+
+    eon.content = "Eon IV"
+    eon.save()  # Invalidates the pages it was in
+    assert client.get("/articles/eon?a=1&b=2").data == b"Eon IV"
+    assert client.get("/articles/eon?a=1&b=2").headers["X-Page-Cache"] == "hit"
+    kult = Article(title="Kult").save()  # Any page with articles may list it
+    assert client.get("/articles/eon?a=1&b=2").headers["X-Page-Cache"] == "miss"
+    assert len(renders) == 3
+    kult.content = "Kult"
+    kult.save()
+    assert f"article:{kult.pk}" not in pagecache.page_store.tag_versions  # Not in any page
+
+    with client.session_transaction() as s:
+        s["uid"] = "a user"
+    assert "X-Page-Cache" not in client.get("/articles/eon?a=1&b=2").headers
+    assert len(renders) == 4
+
+    client = app.test_client()
+    assert client.get("/negotiated", headers={"Accept": "application/json"}).mimetype == "application/json"
+    assert client.get("/negotiated").headers["X-Page-Cache"] == "miss"  # JSON was not stored
+    assert client.get("/negotiated").data == b"html"
+    rv = client.get("/negotiated", headers={"Accept": "application/json"})
+    assert rv.headers["X-Page-Cache"] == "miss" and rv.mimetype == "application/json"
+
+    client.get("/form")
+    assert client.get("/form").headers["X-Page-Cache"] == "miss"  # Not stored, as it wrote to the session
+
+
+def test_page_cache_csrf_token(reset_pagecache):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY="test", PAGE_CACHE="memory", PAGE_CACHE_TTL={"token_page": 60, "page": 60})
+    CSRFProtect(app)
+
+    @app.route("/token_page")
+    def token_page():
+        return render_template_string("{{ csrf_token() }}")
+
+    @app.route("/page")
+    def page():
+        # As in _root.html, pages that may be cached let scripts fetch the token instead
+        return render_template_string("{% if g.page_cache_key %}fetched{% else %}{{ csrf_token() }}{% endif %}")
+
+    pagecache.init_pagecache(app)
+    visitor, other_visitor = app.test_client(), app.test_client()
+    token = visitor.get("/token_page").data
+    assert visitor.get("/token_page").data == token  # A returning visitor, whose session is unchanged
+    rv = other_visitor.get("/token_page")
+    assert rv.headers["X-Page-Cache"] == "miss" and rv.data != token
+
+    assert visitor.get("/page").headers["X-Page-Cache"] == "miss"
+    assert other_visitor.get("/page").headers["X-Page-Cache"] == "hit"
+    assert visitor.get("/csrf_token").json["csrf_token"] != other_visitor.get("/csrf_token").json["csrf_token"]
+
+
+def test_memory_page_store_tags():
+    store = MemoryPageStore(maxsize=2)
+    store.set("a", {}, 60, {"article", "article:1"})
+    store.set("b", {}, 60, {"article", "article:2"})
+    store.invalidate(["article:1"])
+    assert store.get("a") is None and store.get("b")
+    store.set("c", {}, 60, {"world"})  # Evicts a, the least recently used
+    assert set(store.tag_versions) == {"article", "article:2", "world"}
+    store.set("b", {}, 60, {"world"})  # Replaces b
+    assert set(store.tag_versions) == {"world"}
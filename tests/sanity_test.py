@@ -215,6 +215,7 @@ def test_all_routes(app_client, db_basic_data):
             "world.ArticlesView:random": 302,
             "admin.ShortcutsView:index": 403,
             "admin.ShortcutsView:get": 403,
+            "admin.cache_stats": 403,
             "auth.callback": 400,
             "assets.FileAssetsView:get": 403 if input.get("session.uid", None) else 401,
             "auth.logout": 302,
@@ -1,26 +1,29 @@
 from flask_debugtoolbar.panels import DebugPanel
-from mongoengine.context_managers import query_counter
-from flask import render_template
+from flask import current_app, render_template
+
+from lore.dbstats import query_stats
 
 _ = lambda x: x
 
 
 class MongoengineToolbar(DebugPanel):
+    """Shows the database commands of the request, as collected by lore.dbstats"""
 
     name = "MongoEngine"
     has_content = True
     has_resource = True
 
     def __init__(self, jinja_env, context={}):
-        self.query_counter = query_counter()
-        self.queries = []
+        self.stats = None
         super(MongoengineToolbar, self).__init__(jinja_env, context)
 
     def nav_title(self):
         return _("Mongo")
 
     def nav_subtitle(self):
-        return f"{len(self.queries)} queries made"
+        if self.stats is None:
+            return "Not collecting"
+        return f"{self.stats.count} queries in {self.stats.duration_ms:.1f} ms"
 
     def title(self):
         return _("Mongoengine")
@@ -29,27 +32,33 @@ class MongoengineToolbar(DebugPanel):
         return ""
 
     def process_request(self, request):
-        self.query_counter._turn_on_profiling()
+        self.stats = None
 
     def process_response(self, request, response):
-        self.query_counter._resets_profiling()
-        self.queries = list(self.query_counter.db.system.profile.find())
+        self.stats = query_stats()
 
     def content(self):
-        for q in self.queries:
-            q["command"] = {k: v for k, v in q["command"].items() if k not in ["lsid", "$readPreference", "$db"]}
-        # rows = (
-        #     (_("Total queries"), self.query_counter),
-        #     # (_('System CPU time'), '%0.3f msec' % stime),
-        #     # (_('Total CPU time'), '%0.3f msec' % (utime + stime)),
-        #     # (_('Elapsed time'), '%0.3f msec' % self.total_time),
-        #     # (_('Context switches'), '%d voluntary, %d involuntary' % (vcsw, ivcsw)),
-        #     # # ('Memory use', '%d max RSS, %d shared, %d unshared' % (rss, srss, urss + usrss)),
-        #     # # ('Page faults', '%d no i/o, %d requiring i/o' % (minflt, majflt)),
-        #     # # ('Disk operations', '%d in, %d out, %d swapout' % (blkin, blkout, swap)),
-        # )
-
-        # context = self.context.copy()
-        # context.update({"rows": rows})
-
-        return render_template("includes/mongoengine_panel.html", rows=self.queries)
+        stats = self.stats
+        if stats is None:
+            return render_template("includes/mongoengine_panel.html", rows=[], summary=None)
+        repeated = stats.repeated()
+        summary = {
+            "count": stats.count,
+            "duration_ms": stats.duration_ms,
+            "docs": stats.docs,
+            "repeated": sum(n - 1 for n in repeated.values()),
+            "n_plus_one": stats.n_plus_one(current_app.config.get("DB_STATS_N_PLUS_ONE", 10)),
+        }
+        rows = [
+            {
+                "collection": c.collection,
+                "name": c.name,
+                "duration_ms": c.duration_ms,
+                "docs": c.docs,
+                "repeats": repeated.get(c.fingerprint, 1),
+                "failed": c.failed,
+                "command": c.command,
+            }
+            for c in stats.commands
+        ]
+        return render_template("includes/mongoengine_panel.html", rows=rows, summary=summary)